@@ -0,0 +1,38 @@
+import logging
+
+logger = logging.getLogger("PrintServer.Admission")
+
+# Configuration
+MAX_QUEUED_JOBS = 5000  # Outstanding jobs across every device before uploads are refused
+MAX_QUEUED_BYTES = 2 * 1024 ** 3  # Outstanding document bytes across every device
+DEVICE_MAX_QUEUED_JOBS = 500  # Outstanding jobs for one device (or waiting for any device)
+DEVICE_MAX_QUEUED_BYTES = 512 * 1024 ** 2  # Outstanding document bytes for one device
+
+
+# Budgets on outstanding (pending or leased) work, checked before a job is
+# accepted, so a burst of uploads while kiosks are offline is refused rather
+# than piling up. Loads come from the job queue's outstanding(), which is the
+# source of truth, so nothing here needs resyncing after a restart.
+class AdmissionControl:
+    def __init__(self, max_jobs=MAX_QUEUED_JOBS, max_bytes=MAX_QUEUED_BYTES,
+                 device_max_jobs=DEVICE_MAX_QUEUED_JOBS, device_max_bytes=DEVICE_MAX_QUEUED_BYTES):
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.device_max_jobs = device_max_jobs
+        self.device_max_bytes = device_max_bytes
+
+    # Function to check whether one more job of size bytes fits. With no
+    # device_id only the totals are checked. Returns None when it fits, or
+    # the name of the budget it would exceed.
+    def check(self, loads, size, device_id=None):
+        if sum(jobs for jobs, _ in loads.values()) + 1 > self.max_jobs:
+            return 'jobs'
+        if sum(queued for _, queued in loads.values()) + size > self.max_bytes:
+            return 'bytes'
+        if device_id is not None:
+            jobs, queued = loads.get(device_id, (0, 0))
+            if jobs + 1 > self.device_max_jobs:
+                return 'device_jobs'
+            if queued + size > self.device_max_bytes:
+                return 'device_bytes'
+        return None
@@ -1,9 +1,8 @@
 from flask import Flask, request, render_template, redirect, url_for
 import os
-import cups
-import tempfile
-from PyPDF2 import PdfReader, PdfWriter
-from io import BytesIO
+
+from page_ranges import prepare_document, PageRangeError
+from cups_printing import CupsConnection, PrinterUnavailable, cups_options, submit_document
 
 app = Flask(__name__)
 
@@ -12,43 +11,18 @@ UPLOAD_FOLDER = './uploads'
 ALLOWED_EXTENSIONS = {'pdf'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# CUPS connection
-conn = cups.Connection()
-printer_name = conn.getDefault()
-print(printer_name)
+# CUPS connection, opened with the first print job so the kiosk starts while CUPS is still coming up
+printer = CupsConnection()
 
 # Function to check allowed file types
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# Function to handle PDF processing and page selection
+# Function to handle PDF processing and page selection. Returns the document
+# to print and the CUPS page-ranges to apply; raises PageRangeError for a
+# selection that does not fit the document.
 def process_pdf(file_path, selected_pages, num_copies, layout, pages_per_sheet):
-    reader = PdfReader(file_path)
-    writer = PdfWriter()
-
-    # Handle selected pages
-    if selected_pages:
-        pages = []
-        for page_range in selected_pages.split(','):
-            if '-' in page_range:
-                start, end = map(int, page_range.split('-'))
-                pages.extend(range(start - 1, end))  # Pages are zero-indexed
-            else:
-                pages.append(int(page_range) - 1)
-
-        for page_num in pages:
-            writer.add_page(reader.pages[page_num])
-    else:
-        # If no pages are selected, print the entire document
-        for page_num in range(len(reader.pages)):
-            writer.add_page(reader.pages[page_num])
-
-    # Create temporary file to store the new PDF with selected pages and options
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-    with open(temp_file.name, 'wb') as f:
-        writer.write(f)
-
-    return temp_file.name
+    return prepare_document(file_path, selected_pages, pages_per_sheet)
 
 # Home route
 @app.route('/')
@@ -74,20 +48,22 @@ def upload_file():
         pages_per_sheet = int(request.form.get('pages_per_sheet', 1))  # Default 1 page per sheet
 
         # Process the PDF based on the selected options
-        processed_pdf_path = process_pdf(filename, selected_pages, num_copies, layout, pages_per_sheet)
+        try:
+            document, page_ranges = process_pdf(filename, selected_pages, num_copies, layout, pages_per_sheet)
+        except PageRangeError as e:
+            return str(e), 400
 
         # Send the processed PDF file to the printer
-        printer_name = conn.getDefault()  # Get the default printer
-        print(printer_name)
+        # One submission whatever the number of copies; CUPS makes the copies
+        print_options = {'num_copies': num_copies, 'layout': layout, 'pages_per_sheet': pages_per_sheet}
         try:
-            for _ in range(num_copies):
-                conn.printFile(printer_name, processed_pdf_path, "Print Job", {})
+            printer.run(lambda conn, printer_name: submit_document(
+                conn, printer_name, document, "Print Job", cups_options(print_options, page_ranges)))
+        except PrinterUnavailable as e:
+            return f"Printer is not available, please try again shortly ({str(e)})", 503
         except Exception as e:
             return f"Error while printing: {str(e)}", 500
 
-        # Clean up temporary file after printing
-        os.remove(processed_pdf_path)
-
         return "File uploaded, processed, and printing started!"
     return "Invalid file format", 400
 
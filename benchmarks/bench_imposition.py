@@ -0,0 +1,92 @@
+# Time to lay a job out on its sheets in poll.py's process stage, the first
+# time (imposition, plus rasterization when Ghostscript is installed) and
+# on a repeat, when the result comes from the spool cache. This is the work
+# the CUPS filter chain would otherwise do on the Pi while the printer waits.
+#
+#   python benchmarks/bench_imposition.py --pages 40 --runs 3
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_cups
+
+sys.modules['cups'] = fake_cups
+
+# Cases for a document of the given length; the subset is the first quarter
+# and a run from halfway ("1-10, 21-31" for 40 pages)
+def cases(pages):
+    quarter = max(1, pages // 4)
+    subset = f"1-{quarter}, {pages // 2 + 1}-{min(pages, pages // 2 + quarter + 1)}"
+    return [
+        ("2-up", {"pages_per_sheet": 2, "layout": "portrait"}),
+        ("4-up", {"pages_per_sheet": 4, "layout": "portrait"}),
+        ("9-up, landscape", {"pages_per_sheet": 9, "layout": "landscape"}),
+        ("subset, 4-up", {"pages_per_sheet": 4, "layout": "portrait", "selected_pages": subset}),
+    ]
+
+
+# A PDF whose pages draw something, so imposition has content to move
+def write_pdf(path, pages):
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>",
+               "<< /Type /Pages /Kids [%s] /Count %d >>" % (' '.join(f"{3 + 2 * n} 0 R" for n in range(pages)),
+                                                           pages)]
+    for n in range(pages):
+        content = "".join(f"0 0 0 rg {x} {y} 20 10 re f " for x in range(40, 560, 40) for y in range(40, 800, 40))
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {4 + 2 * n} 0 R >>")
+        objects.append(f"<< /Length {len(content)} >>\nstream\n{content}\nendstream")
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n{body}\nendobj\n".encode()
+    xref = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    data += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    data += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    if args.pages < 1:
+        parser.error("--pages must be at least 1")
+
+    os.chdir(tempfile.mkdtemp(prefix="bench_imposition_"))
+    import poll
+    logging.disable(logging.CRITICAL)
+    poll.PREPROCESS = 'raster'
+    poll.printer.attributes()
+    if poll.current_raster_device() is None:
+        poll.PREPROCESS = 'impose'
+
+    write_pdf("doc.pdf", args.pages)
+    print(f"{args.pages}-page document, PREPROCESS={poll.PREPROCESS!r}, {args.runs} runs\n")
+    print(f"{'case':<18}{'first ms':>10}{'cached ms':>11}{'output KB':>11}")
+    for number, (name, options) in enumerate(cases(args.pages)):
+        first = cached = 0
+        for run in range(args.runs):
+            command = {"command_id": f"bench{number}", "pdf_hash": f"{number}{run:063d}",
+                       "page_count": args.pages, "print_options": options}
+            start = time.perf_counter()
+            document, _, _ = poll.process_command(command, "doc.pdf")
+            first += time.perf_counter() - start
+            start = time.perf_counter()
+            poll.process_command(command, "doc.pdf")
+            cached += time.perf_counter() - start
+        print(f"{name:<18}{first / args.runs * 1000:>10.1f}{cached / args.runs * 1000:>11.2f}"
+              f"{os.path.getsize(document) / 1024:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
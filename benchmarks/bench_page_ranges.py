@@ -0,0 +1,90 @@
+# Time and temporary disk written per job for page selection, comparing the
+# old path (copy every selected page into a new PDF on disk) with
+# page_ranges.prepare_document (leave the file alone and hand CUPS a
+# page-ranges option, rewriting in memory only for N-up subsets).
+#
+#   python benchmarks/bench_page_ranges.py --pages 500 --runs 5
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyPDF2 import PdfReader, PdfWriter
+
+from page_ranges import prepare_document, parse_page_ranges
+
+# Cases for a document of the given length: every page, then a selection
+# of the first tenth, a run from a fifth of the way in and one late page
+# ("1-50, 101-151, 400" for 500 pages)
+def cases(pages):
+    tenth = max(1, pages // 10)
+    subset = f"1-{tenth}, {pages // 5 + 1}-{min(pages, pages // 5 + tenth + 1)}, {max(1, pages * 4 // 5)}"
+    return [
+        ("all pages", "", 1),
+        ("subset, 1-up", subset, 1),
+        ("subset, 2-up", subset, 2),
+    ]
+
+
+def write_pdf(path, pages):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=595, height=842)
+    with open(path, 'wb') as f:
+        writer.write(f)
+
+
+# The page-selection path poll.py and app.py used before page_ranges.prepare_document
+def legacy(file_path, selected_pages, pages_per_sheet, page_count):
+    reader = PdfReader(file_path)
+    writer = PdfWriter()
+    for start, end in parse_page_ranges(selected_pages, len(reader.pages)):
+        for page_num in range(start - 1, end):
+            writer.add_page(reader.pages[page_num])
+    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
+    with open(temp_file.name, 'wb') as f:
+        writer.write(f)
+    written = os.path.getsize(temp_file.name)
+    os.remove(temp_file.name)
+    return written
+
+
+# The server sends the page count with each command, so the client passes it along
+def current(file_path, selected_pages, pages_per_sheet, page_count):
+    prepare_document(file_path, selected_pages, pages_per_sheet, page_count)
+    return 0  # Nothing is written to disk; N-up subsets are kept in memory
+
+
+def measure(func, file_path, selected_pages, pages_per_sheet, page_count, runs):
+    written = 0
+    start = time.perf_counter()
+    for _ in range(runs):
+        written = func(file_path, selected_pages, pages_per_sheet, page_count)
+    return (time.perf_counter() - start) / runs, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=500)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    if args.pages < 1:
+        parser.error("--pages must be at least 1")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "doc.pdf")
+        write_pdf(path, args.pages)
+        print(f"{args.pages}-page document, {os.path.getsize(path) // 1024} KB, {args.runs} runs per case\n")
+        print(f"{'case':<16}{'legacy ms':>12}{'temp KB':>10}{'new ms':>10}{'temp KB':>10}")
+        for name, selected_pages, pages_per_sheet in cases(args.pages):
+            old_time, old_written = measure(legacy, path, selected_pages, pages_per_sheet, args.pages, args.runs)
+            new_time, new_written = measure(current, path, selected_pages, pages_per_sheet, args.pages, args.runs)
+            print(f"{name:<16}{old_time * 1000:>12.1f}{old_written // 1024:>10}"
+                  f"{new_time * 1000:>10.1f}{new_written // 1024:>10}")
+
+
+if __name__ == '__main__':
+    main()
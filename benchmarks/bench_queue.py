@@ -0,0 +1,76 @@
+# Enqueue / dequeue / complete throughput of the job queue backends with a
+# large history of finished jobs already in the table.
+#
+#   python benchmarks/bench_queue.py --history 100000 --jobs 5000
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from job_queue import create_queue
+
+DEVICES = [f"pi_printer_{n:03d}" for n in range(8)]
+
+
+def make_command():
+    return {"command_id": str(uuid.uuid4()), "type": "print", "pdf_hash": "0" * 64,
+            "pdf_size": 1024, "print_options": {}}
+
+
+def seed_history(queue, count):
+    now = time.time()
+    for n in range(count):
+        command = make_command()
+        device_id = DEVICES[n % len(DEVICES)]
+        queue.enqueue(command, device_id, file="history.pdf", now=now - 3600)
+        queue.dequeue(device_id, now=now - 3600)
+        queue.complete(command["command_id"], n % 10 != 0, now=now - 3500)
+
+
+def run(queue, jobs):
+    commands = [make_command() for _ in range(jobs)]
+
+    start = time.perf_counter()
+    for n, command in enumerate(commands):
+        queue.enqueue(command, DEVICES[n % len(DEVICES)], file="bench.pdf")
+    enqueue_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dequeued = 0
+    # Drain in small batches the way polling devices would
+    while dequeued < jobs:
+        for device_id in DEVICES:
+            dequeued += len(queue.dequeue(device_id))
+    dequeue_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for command in commands:
+        queue.complete(command["command_id"], True, "ok")
+    complete_time = time.perf_counter() - start
+
+    return {"enqueue/s": jobs / enqueue_time, "dequeue/s": jobs / dequeue_time,
+            "complete/s": jobs / complete_time}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", type=int, default=100000)
+    parser.add_argument("--jobs", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for url in ("memory://", f"sqlite:///{tmp}/bench.db"):
+            queue = create_queue(url)
+            start = time.perf_counter()
+            seed_history(queue, args.history)
+            print(f"{url.split(':')[0]}: seeded {args.history} finished jobs in {time.perf_counter() - start:.1f}s")
+            for name, rate in run(queue, args.jobs).items():
+                print(f"  {name:<12} {rate:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# Cold-start benchmark: how long server.py takes to accept connections, and
+# how long a freshly started poll.py client (benchmarks/sim_client.py) takes
+# to poll and receive a job waiting for it -- once with CUPS up, and once
+# with CUPS unreachable for the first --cups-after seconds, as after a boot
+# where cupsd comes up late. In the second case the client must still poll
+# and fetch straight away, and print once CUPS can be reached.
+#
+# Exits non-zero if the client's first poll takes longer than --budget.
+#
+#   python benchmarks/bench_startup.py --cups-after 5 --budget 3
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from end_to_end import wait_for_port
+from load_test import BOUNDARY, Client, free_port, upload_body
+
+LOG_TIME_FORMAT = '%Y-%m-%d %H:%M:%S,%f'
+
+
+def make_pdf():
+    from io import BytesIO
+    from PyPDF2 import PdfWriter
+    writer = PdfWriter()
+    writer.add_blank_page(width=595, height=842)
+    buffer = BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+# Function to find when the client first logged a line containing text, or None
+def first_logged(log_path, text):
+    try:
+        with open(log_path) as f:
+            for line in f:
+                if text in line:
+                    return datetime.strptime(line[:23], LOG_TIME_FORMAT).timestamp()
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def first_printed(cups_log):
+    try:
+        with open(cups_log) as f:
+            line = f.readline()
+    except FileNotFoundError:
+        return None
+    return json.loads(line)["submitted_at"] if line.endswith('\n') else None
+
+
+# Function to start a client with a job already waiting for it and time its
+# first poll, first command received and first print, in seconds from launch
+def run_client(client_dir, port, cups_after, timeout):
+    os.makedirs(client_dir)
+    cups_log = os.path.join(client_dir, "printed.jsonl")
+    log_path = os.path.join(client_dir, "printer_client.log")
+    started = time.time()
+    client = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "sim_client.py"), "--server", f"http://127.0.0.1:{port}",
+         "--device-id", "startup_kiosk", "--cups-log", cups_log, "--cups-after", str(cups_after)],
+        cwd=client_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = started + timeout
+        while time.time() < deadline and first_printed(cups_log) is None:
+            if client.poll() is not None:
+                raise RuntimeError(f"Client exited with status {client.returncode}")
+            time.sleep(0.05)
+    finally:
+        client.terminate()
+        client.wait()
+
+    def since_start(at):
+        return at - started if at is not None else float('nan')
+    return (since_start(first_logged(log_path, "Polling server for commands")),
+            since_start(first_logged(log_path, "Received command")),
+            since_start(first_printed(cups_log)))
+
+
+# Function to start a fresh server, queue one job and time a client's start
+# against it. Returns (server seconds to accept connections, client timings).
+def run_case(workdir, cups_after, timeout):
+    port = free_port()
+    server_dir = os.path.join(workdir, "server")
+    os.makedirs(server_dir)
+    env = dict(os.environ, PRINT_SERVER_MODE="production", PORT=str(port),
+               PRINT_QUEUE_URL=f"sqlite:///{server_dir}/queue.db")
+    started = time.time()
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, "server.py")], cwd=server_dir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        server_seconds = time.time() - started
+        status, data = Client(port, timeout=30).request("POST", "/upload", upload_body(make_pdf()), {
+            "Content-Type": f"multipart/form-data; boundary={BOUNDARY}"})
+        if status != 200:
+            raise RuntimeError(f"Upload failed: {status} {data[:200]!r}")
+        return server_seconds, run_client(os.path.join(workdir, "client"), port, cups_after, timeout)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cups-after", type=float, default=5, help="seconds CUPS is unreachable in the late case")
+    parser.add_argument("--budget", type=float, default=3, help="most seconds from launch to the client's first poll")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--keep", action="store_true", help="keep the working directories")
+    args = parser.parse_args()
+
+    print(f"{'case':<20}{'server s':>10}{'first poll s':>14}{'job received s':>16}{'printed s':>11}")
+    worst = 0
+    for case, cups_after in [("CUPS up", 0), (f"CUPS after {args.cups_after:g} s", args.cups_after)]:
+        workdir = tempfile.mkdtemp(prefix="bench_startup_")
+        try:
+            server_seconds, (first_poll, received, printed) = run_case(workdir, cups_after, args.timeout)
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+        worst = max(worst, first_poll) if first_poll == first_poll else float('inf')
+        print(f"{case:<20}{server_seconds:>10.2f}{first_poll:>14.2f}{received:>16.2f}{printed:>11.2f}")
+
+    within = worst <= args.budget
+    print(f"\nslowest first poll {worst:.2f} s, budget {args.budget:g} s: {'ok' if within else 'OVER BUDGET'}")
+    sys.exit(0 if within else 1)
+
+
+if __name__ == '__main__':
+    main()
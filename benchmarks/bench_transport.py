@@ -0,0 +1,206 @@
+# Bytes on the wire, connections opened and client CPU for an idle polling
+# client and for reporting results, comparing the old one-requests.post-per-
+# call client with poll.py's pooled, compressed, conditional transport.
+#
+# server.py runs in a subprocess on localhost with an in-memory queue. The
+# client reaches it through a counting proxy that, like the hosting
+# provider's front end, keeps the device's connection open even though the
+# origin (Werkzeug's development server) closes its side after every
+# response. Idle polls use wait=0 so
+# they return at once, and are scaled to an hour of 25 s long-polls. Runs
+# over plain HTTP, so the TLS handshake each new connection costs on the real
+# link is not in the byte counts -- see the connection column.
+#
+#   python benchmarks/bench_transport.py --polls 200 --reports 50
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import logging
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+LONG_POLL_WAIT = 25
+CAPABILITIES = {"number_up": [1, 2, 4, 6, 9, 16], "max_copies": 9999}
+
+
+def serve(port):
+    workdir = tempfile.mkdtemp(prefix="bench_transport_")
+    os.chdir(workdir)
+    os.environ["PRINT_QUEUE_URL"] = "memory://"
+    sys.path.insert(0, ROOT_DIR)
+    import server
+    from werkzeug.serving import make_server
+    logging.disable(logging.CRITICAL)
+    make_server("127.0.0.1", port, server.app, threaded=True).serve_forever()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# Front end between client and server, counting the bytes and connections
+# the client sees. Each request is forwarded on a fresh origin connection
+# (the origin closes after every response); the client's connection stays
+# open unless the client closes it.
+class CountingProxy:
+    def __init__(self, upstream_port):
+        self.upstream_port = upstream_port
+        self.sent = self.received = self.connections = 0
+        self._lock = threading.Lock()
+        self._listener = socket.socket()
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(("127.0.0.1", 0))
+        self._listener.listen(16)
+        self.port = self._listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def reset(self):
+        with self._lock:
+            self.sent = self.received = self.connections = 0
+
+    def _count(self, counter, size):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + size)
+
+    def _accept(self):
+        while True:
+            client, _ = self._listener.accept()
+            self._count("connections", 1)
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        # Requests are not pipelined: once the origin has started answering,
+        # new client data is the next request and needs a new origin connection
+        upstream = None
+        try:
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                self._count("sent", len(data))
+                if upstream is None or upstream["answered"].is_set():
+                    if upstream is not None:
+                        upstream["closed"].wait(5)
+                    upstream = {"socket": socket.create_connection(("127.0.0.1", self.upstream_port)),
+                                "answered": threading.Event(), "closed": threading.Event()}
+                    threading.Thread(target=self._relay, args=(upstream, client), daemon=True).start()
+                upstream["socket"].sendall(data)
+        except OSError:
+            pass
+        finally:
+            client.close()
+
+    def _relay(self, upstream, client):
+        try:
+            while True:
+                data = upstream["socket"].recv(65536)
+                if not data:
+                    break
+                upstream["answered"].set()
+                data = data.replace(b"Connection: close\r\n", b"")
+                self._count("received", len(data))
+                client.sendall(data)
+        except OSError:
+            pass
+        finally:
+            upstream["socket"].close()
+            upstream["closed"].set()
+
+
+# The client as it was before poll.py had a transport: a fresh requests.post per call
+def legacy_poll(requests, base_url):
+    payload = {"device_id": "bench_device", "capabilities": CAPABILITIES}
+    response = requests.post(f"{base_url}/api/check_commands", json=payload, timeout=10)
+    return response.json()
+
+
+def legacy_reports(requests, base_url, count):
+    for n in range(count):
+        payload = {"device_id": "bench_device", "command_id": f"cmd{n}", "success": True,
+                   "message": f"Print job submitted with ID: {n}"}
+        requests.post(f"{base_url}/api/check_commands/report", json=payload, timeout=10)
+
+
+def measure(proxy, func):
+    proxy.reset()
+    start = time.thread_time()
+    func()
+    cpu = time.thread_time() - start
+    time.sleep(0.2)  # Let the proxy finish counting
+    return proxy.sent, proxy.received, proxy.connections, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--polls", type=int, default=200)
+    parser.add_argument("--reports", type=int, default=50)
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve)
+        return
+
+    server_port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(server_port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", server_port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        proxy = CountingProxy(server_port)
+        base_url = f"http://127.0.0.1:{proxy.port}"
+
+        os.chdir(tempfile.mkdtemp(prefix="bench_transport_client_"))
+        import fake_cups
+        sys.modules["cups"] = fake_cups
+        import requests
+        import poll
+        from transport import ServerTransport
+        logging.disable(logging.CRITICAL)
+        poll.transport = ServerTransport(base_url)
+
+        def new_polls():
+            for _ in range(args.polls):
+                poll.poll_server(False)
+
+        def old_polls():
+            for _ in range(args.polls):
+                legacy_poll(requests, base_url)
+
+        results = [
+            ("idle, before", measure(proxy, old_polls), args.polls),
+            ("idle, after", measure(proxy, new_polls), args.polls),
+            ("reports, before", measure(proxy, lambda: legacy_reports(requests, base_url, args.reports)), None),
+            ("reports, after", measure(proxy, lambda: poll.report_command_results(
+                [(f"cmd{n}", True, f"Print job submitted with ID: {n}") for n in range(args.reports)])), None),
+        ]
+
+        polls_per_hour = 3600 / LONG_POLL_WAIT
+        print(f"{args.polls} idle polls (scaled to {polls_per_hour:.0f} long-polls per idle hour), "
+              f"{args.reports} reports\n")
+        print(f"{'case':<18}{'up KB':>10}{'down KB':>10}{'conns':>8}{'CPU ms':>10}")
+        for name, (sent, received, connections, cpu), polls in results:
+            scale = polls_per_hour / polls if polls else 1
+            print(f"{name:<18}{sent * scale / 1024:>10.1f}{received * scale / 1024:>10.1f}"
+                  f"{connections * scale:>8.0f}{cpu * scale * 1000:>10.1f}")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
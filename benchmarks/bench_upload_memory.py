@@ -0,0 +1,96 @@
+# Peak Python heap per upload, measured with tracemalloc, for the streaming
+# upload path versus the old save / read back / base64 path.
+#
+#   python benchmarks/bench_upload_memory.py --sizes 1 4 16 64
+import argparse
+import base64
+import os
+import sys
+import tempfile
+import tracemalloc
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BOUNDARY = "benchboundary"
+
+
+# Write a multipart/form-data body holding a PDF of roughly size_mb to disk
+def write_body(path, size_mb):
+    filler = b"% filler line to pad the document out to size\n"
+    with open(path, 'wb') as f:
+        f.write(f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"upi_method\"\r\n\r\nsuccess\r\n".encode())
+        f.write(f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"doc.pdf\"\r\n"
+                "Content-Type: application/pdf\r\n\r\n".encode())
+        f.write(b"%PDF-1.4\n1 0 obj << /Type /Page >> endobj\n")
+        for _ in range(size_mb * 1024 * 1024 // len(filler)):
+            f.write(filler)
+        f.write(b"trailer << >>\n%%EOF\n")
+        f.write(f"\r\n--{BOUNDARY}--\r\n".encode())
+
+
+def environ_for(path, stream):
+    return {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": "/upload",
+        "CONTENT_TYPE": f"multipart/form-data; boundary={BOUNDARY}",
+        "CONTENT_LENGTH": str(os.path.getsize(path)),
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "5000",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": stream,
+    }
+
+
+def measure(fn):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 4, 16, 64], help="upload sizes in MB")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_upload_")
+    os.chdir(workdir)
+    os.environ.setdefault("PRINT_QUEUE_URL", "memory://")
+
+    import flask
+    import server
+    logging.disable(logging.CRITICAL)
+    server.app.config['MAX_CONTENT_LENGTH'] = None
+
+    def streaming(path):
+        with open(path, 'rb') as stream:
+            with server.app.request_context(environ_for(path, stream)):
+                writer = flask.request.files['file'].stream
+                writer.commit()
+
+    def legacy(path):
+        with open(path, 'rb') as stream:
+            request = flask.Request(environ_for(path, stream))
+            saved = os.path.join(workdir, "legacy.pdf")
+            request.files['file'].save(saved)
+            with open(saved, 'rb') as f:
+                pdf_data = base64.b64encode(f.read()).decode('utf-8')
+            os.remove(saved)
+            request.close()
+            return pdf_data
+
+    print(f"{'size':>6} {'streaming peak':>16} {'legacy peak':>14}")
+    for size_mb in args.sizes:
+        path = os.path.join(workdir, f"body_{size_mb}.bin")
+        write_body(path, size_mb)
+        stream_peak = measure(lambda: streaming(path))
+        legacy_peak = measure(lambda: legacy(path))
+        print(f"{size_mb:>4}MB {stream_peak / 1024:>14.0f}KB {legacy_peak / 1024 / 1024:>12.1f}MB")
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
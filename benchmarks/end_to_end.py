@@ -0,0 +1,419 @@
+# End-to-end benchmark of the upload-to-print path. Starts server.py and any
+# number of poll.py clients (benchmarks/sim_client.py) on this machine, each
+# client printing to a fake CUPS printer that takes a simulated time per
+# sheet. A workload of mixed document sizes, page ranges, copy counts and
+# N-up layouts is replayed through /upload at its arrival times. The report
+# covers upload latency, time to first page (upload start to the first
+# sheet leaving the printer), jobs/s, server RSS and client CPU.
+#
+# Workloads are generated from a seed, or replayed from a file saved by an
+# earlier run, so runs on different commits see the same jobs. --json
+# appends each run's results, tagged with the git commit, as one JSON line.
+#
+#   python benchmarks/end_to_end.py --clients 4 --jobs 200 --rate 5 --json e2e_results.jsonl
+#   python benchmarks/end_to_end.py --save-workload mixed.json --jobs 500
+#   python benchmarks/end_to_end.py --workload mixed.json --mode development
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from load_test import Client, free_port, percentile
+
+BOUNDARY = "endtoendboundary"
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+SAMPLE_INTERVAL = 0.5  # Seconds between RSS and CPU samples
+
+# Workload mix: (value, weight)
+PAGE_COUNTS = [(1, 30), (2, 20), (5, 20), (10, 15), (30, 10), (100, 5)]
+COPY_COUNTS = [(1, 70), (2, 15), (3, 10), (10, 5)]
+PAGES_PER_SHEET = [(1, 80), (2, 15), (4, 5)]
+SCANNED_FRACTION = 0.1  # Share of documents that are page images, hundreds of KB a page
+RANGED_FRACTION = 0.3  # Share of multi-page jobs printing only some pages
+MAX_DOCUMENT_KB = 15 * 1024  # Under server.py's 16 MB upload limit
+
+
+def weighted(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights)[0]
+
+
+# Function to generate a workload: jobs arriving as a Poisson process at
+# rate per second, each a distinct document
+def make_workload(jobs, rate, seed):
+    rng = random.Random(seed)
+    workload = []
+    at = 0.0
+    for _ in range(jobs):
+        at += rng.expovariate(rate)
+        pages = weighted(rng, PAGE_COUNTS)
+        scanned = rng.random() < SCANNED_FRACTION
+        selected_pages = ""
+        if pages > 1 and rng.random() < RANGED_FRACTION:
+            first = rng.randint(1, pages)
+            selected_pages = f"{first}-{rng.randint(first, pages)}"
+        workload.append({
+            "at": round(at, 3),
+            "pages": pages,
+            "size_kb": min(MAX_DOCUMENT_KB, pages * (rng.randint(200, 800) if scanned else rng.randint(2, 20))),
+            "selected_pages": selected_pages,
+            "num_copies": weighted(rng, COPY_COUNTS),
+            "pages_per_sheet": weighted(rng, PAGES_PER_SHEET),
+            "layout": "portrait"
+        })
+    return workload
+
+
+# A PDF of blank pages padded with incompressible data to the job's size.
+# The title makes every job's document distinct, so none is served from a
+# client's spool cache.
+def make_pdf(job, number):
+    from PyPDF2 import PdfWriter
+    writer = PdfWriter()
+    for _ in range(job["pages"]):
+        writer.add_blank_page(width=595, height=842)
+    writer.add_metadata({"/Title": f"end_to_end job {number}"})
+    if job["size_kb"]:
+        writer.add_attachment("filler.bin", os.urandom(job["size_kb"] * 1024))
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def upload_body(pdf, job):
+    fields = {"upi_method": "success", "selected_pages": job["selected_pages"],
+              "num_copies": job["num_copies"], "pages_per_sheet": job["pages_per_sheet"],
+              "layout": job["layout"]}
+    body = "".join(f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n{value}\r\n"
+                   for name, value in fields.items())
+    return (body + f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"doc.pdf\"\r\n"
+            "Content-Type: application/pdf\r\n\r\n").encode() + pdf + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+# Function to find a process and all of its descendants
+def process_tree(pid):
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+    return tree
+
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += int(fields[11]) + int(fields[12])  # utime, stime
+        except (OSError, IndexError, ValueError):
+            pass
+    return total / CLOCK_TICKS
+
+
+def rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+# Samples the server's memory and the clients' CPU (their PDF worker
+# processes included) in the background
+class Sampler:
+    def __init__(self, server_pid, client_pids):
+        self.server_pid = server_pid
+        self.client_pids = client_pids
+        self.server_rss_peak = 0
+        self.server_rss = 0
+        self.client_cpu = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        self.server_rss = rss_bytes(self.server_pid)
+        self.server_rss_peak = max(self.server_rss_peak, self.server_rss)
+        for pid in self.client_pids:
+            # A worker that has exited takes its CPU time with it, so keep the highest reading
+            self.client_cpu[pid] = max(self.client_cpu.get(pid, 0), cpu_seconds(process_tree(pid)))
+
+    def _run(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+# Function to read the documents the clients' printers have printed, by command ID
+def read_printed(paths):
+    printed = {}
+    for path in paths:
+        try:
+            with open(path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            continue
+        batch_positions = {}
+        for line in lines:
+            try:
+                document = json.loads(line)
+            except ValueError:
+                continue  # Still being written
+            # Titles are "Print Job <id>", or "Print Jobs <id> <id>..." for a
+            # batch, whose documents are printed in the order of their IDs
+            command_ids = document["title"].split()[2:]
+            position = batch_positions.get(document["job_id"], 0)
+            batch_positions[document["job_id"]] = position + 1
+            if position < len(command_ids):
+                printed.setdefault(command_ids[position], document)
+    return printed
+
+
+def wait_for_port(port, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server did not start on port {port}")
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def summarize(values):
+    return {"count": len(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99), "max": max(values) if values else float('nan')}
+
+
+def run(args, workload):
+    workdir = tempfile.mkdtemp(prefix="end_to_end_")
+    print(f"Generating {len(workload)} documents in {workdir}")
+    documents = []
+    for number, job in enumerate(workload):
+        path = os.path.join(workdir, "docs", f"{number}.pdf")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(make_pdf(job, number))
+        documents.append(path)
+
+    port = free_port()
+    server_dir = os.path.join(workdir, "server")
+    os.makedirs(server_dir)
+    env = dict(os.environ, PRINT_SERVER_MODE=args.mode, PORT=str(port),
+               PRINT_QUEUE_URL=f"sqlite:///{server_dir}/queue.db")
+    processes = [subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, "server.py")], cwd=server_dir,
+                                  env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)]
+    try:
+        wait_for_port(port)
+        cups_logs = []
+        for n in range(args.clients):
+            client_dir = os.path.join(workdir, f"client_{n:03d}")
+            os.makedirs(client_dir)
+            cups_logs.append(os.path.join(client_dir, "printed.jsonl"))
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.join(BENCH_DIR, "sim_client.py"), "--server", f"http://127.0.0.1:{port}",
+                 "--device-id", f"sim_{n:03d}", "--cups-log", cups_logs[-1],
+                 "--seconds-per-page", str(args.seconds_per_page),
+                 "--first-page-seconds", str(args.first_page_seconds)],
+                cwd=client_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+        # Jobs are routed to devices the server has heard from, so wait for all of them
+        monitor = Client(port, timeout=30)
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            status, data = monitor.request("GET", "/api/devices")
+            if status == 200 and len(json.loads(data)["devices"]) == args.clients:
+                break
+            time.sleep(0.2)
+        else:
+            raise RuntimeError("Not every client checked in with the server")
+
+        sampler = Sampler(processes[0].pid, [p.pid for p in processes[1:]])
+        sampler.start()
+        baseline_cpu = dict(sampler.client_cpu)
+
+        uploads = {}  # command_id -> upload start
+        upload_latencies = []
+        upload_errors = []
+        local = threading.local()
+
+        def upload(number):
+            if not hasattr(local, "client"):
+                local.client = Client(port, timeout=300)
+            with open(documents[number], 'rb') as f:
+                body = upload_body(f.read(), workload[number])
+            start = time.time()
+            try:
+                status, data = local.client.request("POST", "/upload", body, {
+                    "Content-Type": f"multipart/form-data; boundary={BOUNDARY}"})
+            except OSError as e:
+                upload_errors.append(str(e))
+                local.client.close()
+                return
+            if status != 200:
+                upload_errors.append(f"{status} {data[:200]!r}")
+                return
+            upload_latencies.append(time.time() - start)
+            uploads[json.loads(data)["command_id"]] = start
+
+        # Replay the workload at its arrival times
+        print(f"Replaying {len(workload)} jobs over {workload[-1]['at']:.0f} s to {args.clients} clients "
+              f"({args.mode} mode)")
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=args.uploaders) as executor:
+            for number, job in enumerate(workload):
+                delay = started + job["at"] - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(upload, number)
+        for error in upload_errors[:3]:
+            print(f"Upload failed: {error}")
+
+        # Wait until every job has printed or failed
+        deadline = time.time() + args.timeout
+        failed = set()
+        while time.time() < deadline:
+            printed = read_printed(cups_logs)
+            status, data = monitor.request("GET", "/api/commands?status=failed&limit=1000")
+            if status == 200:
+                failed = {c["id"] for c in json.loads(data)["commands"]} & set(uploads)
+            pending = set(uploads) - set(printed) - failed
+            last_sheet = max((printed[c]["completed_at"] for c in uploads if c in printed), default=0)
+            if not pending and time.time() >= last_sheet:
+                break
+            time.sleep(0.5)
+        sampler.stop()
+        printed = {c: d for c, d in read_printed(cups_logs).items() if c in uploads}
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    finished_at = max((d["completed_at"] for d in printed.values()), default=started)
+    client_cpu = sum(sampler.client_cpu[pid] - baseline_cpu.get(pid, 0) for pid in sampler.client_cpu)
+    return {
+        "jobs": len(workload),
+        "uploaded": len(uploads),
+        "upload_errors": len(upload_errors),
+        "printed": len(printed),
+        "failed": len(failed),
+        "unfinished": len(set(uploads) - set(printed) - failed),
+        "sheets": sum(d["sheets"] for d in printed.values()),
+        "elapsed_seconds": finished_at - started,
+        "jobs_per_second": len(printed) / max(finished_at - started, 1e-9),
+        "upload_latency_seconds": summarize(upload_latencies),
+        "time_to_first_page_seconds": summarize([d["first_page_at"] - uploads[c] for c, d in printed.items()]),
+        "server_rss_peak_bytes": sampler.server_rss_peak,
+        "server_rss_end_bytes": sampler.server_rss,
+        "client_cpu_seconds": client_cpu,
+        "client_cpu_seconds_per_job": client_cpu / max(len(printed), 1)
+    }
+
+
+def report(results):
+    print(f"\njobs={results['jobs']} uploaded={results['uploaded']} printed={results['printed']} "
+          f"failed={results['failed']} unfinished={results['unfinished']} "
+          f"upload_errors={results['upload_errors']} sheets={results['sheets']}")
+    print(f"{'':<22}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, key in (("upload latency", "upload_latency_seconds"),
+                      ("time to first page", "time_to_first_page_seconds")):
+        stats = results[key]
+        print(f"{name:<22}{stats['count']:>8}" + "".join(f"{stats[p] * 1000:>10.1f}"
+                                                          for p in ("p50", "p95", "p99", "max")))
+    print(f"\nthroughput           {results['jobs_per_second']:.2f} jobs/s over {results['elapsed_seconds']:.1f} s")
+    print(f"server RSS           {results['server_rss_peak_bytes'] / 1024 ** 2:.1f} MB peak, "
+          f"{results['server_rss_end_bytes'] / 1024 ** 2:.1f} MB at end")
+    print(f"client CPU           {results['client_cpu_seconds']:.2f} s total, "
+          f"{results['client_cpu_seconds_per_job'] * 1000:.1f} ms per job")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["development", "production"], default="production")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=5, help="mean job arrivals per second")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workload", help="replay a workload saved with --save-workload")
+    parser.add_argument("--save-workload", help="write the generated workload here and exit")
+    parser.add_argument("--uploaders", type=int, default=8, help="most uploads in flight at once")
+    parser.add_argument("--seconds-per-page", type=float, default=0.01, help="simulated print time per sheet")
+    parser.add_argument("--first-page-seconds", type=float, default=0.0,
+                        help="simulated warm-up of an idle printer")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for jobs after the last upload")
+    parser.add_argument("--json", help="append the results to this file as one JSON line")
+    parser.add_argument("--keep", action="store_true", help="keep the documents, logs and queue afterwards")
+    args = parser.parse_args()
+
+    if args.workload:
+        with open(args.workload) as f:
+            workload = json.load(f)
+    else:
+        workload = make_workload(args.jobs, args.rate, args.seed)
+    if args.save_workload:
+        with open(args.save_workload, 'w') as f:
+            json.dump(workload, f, indent=1)
+        print(f"Saved {len(workload)} jobs to {args.save_workload}")
+        return
+
+    results = run(args, workload)
+    report(results)
+    if args.json:
+        commit, dirty = git_commit()
+        with open(args.json, 'a') as f:
+            f.write(json.dumps({"benchmark": "end_to_end", "commit": commit, "dirty": dirty,
+                                "timestamp": datetime.now().isoformat(timespec='seconds'),
+                                "config": vars(args), "results": results}) + "\n")
+    sys.exit(1 if results["failed"] or results["unfinished"] or results["upload_errors"] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# Stand-in for the pycups module used by the benchmark and fault-injection
+# harnesses. Install it with sys.modules['cups'] = fake_cups before importing
+# poll.py or app.py.
+#
+# Submitted documents go to one simulated printer that prints them in order,
+# seconds_per_page per sheet after a warm-up of first_page_seconds when it
+# was idle. Both default to 0, so everything prints the moment it arrives.
+import itertools
+import json
+import math
+import re
+import threading
+import time
+
+from page_ranges import PageRangeError, count_pages, parse_page_ranges
+
+PRINTER_NAME = "FakePrinter"
+PAGE_PATTERN = re.compile(rb"/Type\s*/Page(?![A-Za-z])")  # Page objects, counted without parsing the PDF
+
+
+# Function to count the sheets a submission prints, the way CUPS would apply its options
+def count_sheets(data, options):
+    pages = len(PAGE_PATTERN.findall(data)) or 1
+    if options.get('page-ranges'):
+        try:
+            pages = count_pages(parse_page_ranges(options['page-ranges'], pages))
+        except PageRangeError:
+            pass
+    per_sheet = int(options.get('number-up', 1))
+    return math.ceil(pages / per_sheet) * int(options.get('copies', 1))
+
+
+class IPPError(Exception):
+    pass
+
+
+class Connection:
+    # Every submission across all connections, in order:
+    # (job_id, printer, filename, title, options, submitted_at)
+    jobs = []
+    # Every document printed, in order, with its sheets and simulated print times
+    documents = []
+    seconds_per_job = 0.0  # Simulated time the spooler takes to accept a job
+    seconds_per_page = 0.0  # Simulated time the printer takes per sheet
+    first_page_seconds = 0.0  # Simulated warm-up before the first sheet when the printer was idle
+    log_path = None  # When set, every printed document is also appended here as a JSON line
+    available_at = 0.0  # Time before which connecting fails, as when cupsd is still starting
+    _printer_free_at = 0.0
+    _ids = itertools.count(1)
+    _lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        if time.time() < self.available_at:
+            raise RuntimeError("failed to connect to server")
+
+    def getDefault(self):
+        return PRINTER_NAME
+
+    def getPrinters(self):
+        return {PRINTER_NAME: {"printer-state": 3, "printer-is-accepting-jobs": True}}
+
+    def getPrinterAttributes(self, name=None, uri=None, requested_attributes=None):
+        return {"number-up-supported": [1, 2, 4, 6, 9, 16], "copies-supported": (1, 9999),
+                "document-format-supported": ["application/pdf", "image/pwg-raster"]}
+
+    def printFile(self, printer, filename, title, options):
+        return self.printFiles(printer, [filename], title, options)
+
+    def printFiles(self, printer, filenames, title, options):
+        if self.seconds_per_job:
+            time.sleep(self.seconds_per_job)
+        contents = []
+        for filename in filenames:
+            with open(filename, 'rb') as f:
+                contents.append(f.read())
+        with self._lock:
+            job_id = next(self._ids)
+            for filename, data in zip(filenames, contents):
+                self._print(job_id, printer, filename, title, options, data)
+        return job_id
+
+    # Function to queue a document on the simulated printer. Called with _lock held.
+    @classmethod
+    def _print(cls, job_id, printer, filename, title, options, data):
+        now = time.time()
+        sheets = count_sheets(data, options)
+        started_at = cls._printer_free_at if cls._printer_free_at > now else now + cls.first_page_seconds
+        completed_at = started_at + sheets * cls.seconds_per_page
+        Connection._printer_free_at = completed_at
+        cls.jobs.append((job_id, printer, filename, title, dict(options), now))
+
+        document = {"job_id": job_id, "title": title, "sheets": sheets, "submitted_at": now,
+                    "started_at": started_at, "first_page_at": started_at + cls.seconds_per_page,
+                    "completed_at": completed_at}
+        cls.documents.append(document)
+        if cls.log_path:
+            with open(cls.log_path, 'a') as f:
+                f.write(json.dumps(document) + '\n')
+
+    # Streamed submissions: createJob, startDocument, writeRequestData..., finishDocument
+    def createJob(self, printer, title, options):
+        with self._lock:
+            job_id = next(self._ids)
+        self._open_job = [job_id, printer, title, dict(options), []]
+        return job_id
+
+    def startDocument(self, printer, job_id, doc_name, format, last_document):
+        pass
+
+    def writeRequestData(self, buffer, length):
+        self._open_job[4].append(buffer[:length])
+
+    def finishDocument(self, printer):
+        if self.seconds_per_job:
+            time.sleep(self.seconds_per_job)
+        job_id, printer, title, options, buffers = self._open_job
+        data = b"".join(buffers)
+        with self._lock:
+            self._print(job_id, printer, f"<stream {len(data)} bytes>", title, options, data)
+        self._open_job = None
+
+    # Jobs are pending until the printer reaches them, processing while
+    # their sheets come out, and completed once the last one has
+    def getJobs(self, which_jobs='not-completed', my_jobs=False, limit=-1, first_job_id=-1,
+                requested_attributes=None):
+        now = time.time()
+        by_job = {}
+        with self._lock:
+            for document in self.documents:
+                if document["job_id"] >= first_job_id:
+                    by_job.setdefault(document["job_id"], []).append(document)
+
+        jobs = {}
+        for job_id, documents in by_job.items():
+            title = documents[0]["title"]
+            started_at = documents[0]["started_at"]
+            completed_at = documents[-1]["completed_at"]
+            if now >= completed_at:
+                state = 9
+            elif now >= started_at:
+                state = 5
+            else:
+                state = 3
+            if which_jobs == 'not-completed' and state == 9:
+                continue
+            printed = sum(d["sheets"] if now >= d["completed_at"] else
+                          int((now - d["started_at"]) / self.seconds_per_page) if now >= d["started_at"] else 0
+                          for d in documents)
+            jobs[job_id] = {"job-id": job_id, "job-name": title, "job-state": state, "job-state-reasons": "none",
+                            "job-impressions-completed": printed, "time-at-processing": int(started_at),
+                            "time-at-completed": int(completed_at) if state == 9 else 0}
+        return jobs
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.jobs = []
+            cls.documents = []
+            Connection._printer_free_at = 0.0
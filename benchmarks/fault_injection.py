@@ -0,0 +1,380 @@
+# Fault-injection harness for exactly-once printing.
+#
+# Runs server.py (through the Flask test client) and poll.py in one process
+# against a fake CUPS connection and a transport that randomly drops requests
+# and responses. Clients "crash" before printing, right after a document has
+# reached CUPS, after that but before its result is recorded, and before
+# reporting. With --pipeline the clients run their PrintPipeline and resume
+# their spool after a crash, as main_loop does; with --devices 2 the first
+# client now and then stops checking in for long enough that the server
+# takes it for silent and rebalances its queue onto the other. Every job must
+# end up printed exactly once; the script exits non-zero otherwise.
+#
+#   python benchmarks/fault_injection.py --jobs 2000 --drop 0.2 --crash 0.05
+#   python benchmarks/fault_injection.py --jobs 500 --pipeline --devices 2
+import argparse
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import logging
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import requests
+import fake_cups
+from compression import decompress
+from cups_printing import CupsConnection, JobTracker
+from pipeline import PrintPipeline
+from spool import CommandSpool, SpoolCache
+
+sys.modules['cups'] = fake_cups
+
+LIVENESS_TIMEOUT = 0.3  # Seconds without a check-in before the server takes a device for silent
+SILENCE_SECONDS = 0.6  # How long a device stays silent
+
+
+class SimulatedCrash(BaseException):
+    pass
+
+
+# Mimics the parts of requests.Response that poll.py uses, decoding
+# compressed bodies the way requests does. With cut set, a streamed body
+# breaks off that far through, like a link dropping mid-download.
+class FakeResponse:
+    def __init__(self, response, cut=None):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.cut = cut
+
+    def _data(self):
+        data = self._response.get_data()
+        encoding = self.headers.get("Content-Encoding")
+        return decompress(data, encoding, max_size=1 << 30) if encoding else data
+
+    def json(self):
+        return json.loads(self._data())
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} error", response=self)
+
+    def iter_content(self, chunk_size=1):
+        data = self._data()
+        end = int(len(data) * self.cut) if self.cut is not None else len(data)
+        for start in range(0, end, chunk_size):
+            yield data[start:min(start + chunk_size, end)]
+        if end < len(data):
+            raise requests.exceptions.ChunkedEncodingError("Simulated connection drop mid-download")
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+# Stands in for the transport's requests.Session, routing poll.py's HTTP
+# calls to the server's test client and losing some of them
+class FlakyTransport:
+    def __init__(self, client, base_url, drop_rate, rng):
+        self.headers = {}
+        self.client = client
+        self.base_url = base_url
+        self.drop_rate = drop_rate
+        self.rng = rng
+        self.dropped = Counter()
+
+    def _path(self, url):
+        return url[len(self.base_url):]
+
+    def _maybe_drop(self, stage, url):
+        if self.rng.random() < self.drop_rate / 2:
+            self.dropped[stage] += 1
+            raise requests.exceptions.ConnectionError(f"Simulated {stage} loss for {url}")
+
+    def post(self, url, data=None, headers=None, timeout=None, **kwargs):
+        self._maybe_drop("request", url)
+        response = self.client.post(self._path(url), data=data, headers={**self.headers, **(headers or {})})
+        self._maybe_drop("response", url)
+        return FakeResponse(response)
+
+    def get(self, url, stream=False, timeout=None, **kwargs):
+        self._maybe_drop("request", url)
+        response = self.client.get(self._path(url), headers={**self.headers, **kwargs.get("headers", {})})
+        cut = None
+        if stream and self.rng.random() < self.drop_rate / 2:
+            self.dropped["mid-download"] += 1
+            cut = self.rng.random()
+        return FakeResponse(response, cut)
+
+
+def make_pdf(pages, number):
+    from PyPDF2 import PdfWriter
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=595, height=842)
+    writer.add_metadata({"/Title": f"fault injection {number}"})  # Distinct, so every job is downloaded
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+# One poll.py client. Each gets its own copy of the module, with its state
+# in a directory of its own, so two devices can run side by side. Its steps
+# may crash it; a crashed client is restarted on its next turn with only
+# what it had written to disk.
+class Device:
+    def __init__(self, number, workdir, transport, args, rng, crashes):
+        self.name = f"poll_{number}"
+        self.directory = os.path.join(workdir, f"device_{number}")
+        self.args = args
+        self.rng = rng
+        self.crashes = crashes
+        self.crashed = False
+        self.silent_until = 0
+        self.pipeline = None
+        self.dead_threads = set()  # Pipeline threads of crashed runs, which must not carry on
+
+        os.makedirs(self.directory)
+        spec = importlib.util.spec_from_file_location(self.name, os.path.join(ROOT_DIR, "poll.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[self.name] = module  # Forked process pool workers find the module here
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            spec.loader.exec_module(module)
+        finally:
+            os.chdir(cwd)
+        self.module = module
+
+        folder = os.path.join(self.directory, "downloads")
+        module.DEVICE_ID = f"fault_device_{number}"
+        module.DOWNLOAD_RETRY_INTERVAL = 0
+        module.UPLOAD_FOLDER = folder
+        module.DONE_LOG_PATH = os.path.join(folder, "completed_commands.json")
+        module.SPOOL_PATH = os.path.join(folder, "spooled_commands.json")
+        module.TRACKED_JOBS_PATH = os.path.join(folder, "tracked_jobs.json")
+        module.PROGRESS_PATH = os.path.join(folder, "progress_outbox.json")
+        module.spool_cache = SpoolCache(os.path.join(folder, "spool"))
+        module.printer = CupsConnection(cache_path=os.path.join(folder, "printer_attributes.json"))
+        if not transport.headers:
+            transport.headers.update(module.transport.session.headers)
+        module.transport.base_url = transport.base_url
+        module.transport.session = transport
+
+        fetch_command = module.fetch_command
+        submit_document = module.submit_document
+        submit_documents = module.submit_documents
+        record_done = module.record_done
+        report_command_results = module.report_command_results
+
+        def crashing_fetch(*a, **kw):
+            self.maybe_crash("before print")
+            return fetch_command(*a, **kw)
+
+        def crashing_submit(*a, **kw):
+            self.maybe_crash(None)
+            job_id = submit_document(*a, **kw)
+            self.maybe_crash("after submit")
+            return job_id
+
+        def crashing_submit_many(*a, **kw):
+            self.maybe_crash(None)
+            job_id = submit_documents(*a, **kw)
+            self.maybe_crash("after submit")
+            return job_id
+
+        def crashing_record(*a, **kw):
+            self.maybe_crash("before record")
+            return record_done(*a, **kw)
+
+        def crashing_report(*a, **kw):
+            self.maybe_crash("before report")
+            return report_command_results(*a, **kw)
+
+        module.fetch_command = crashing_fetch
+        module.submit_document = crashing_submit
+        module.submit_documents = crashing_submit_many
+        module.record_done = crashing_record
+        module.report_command_results = crashing_report
+        self.restart()
+
+    # Function to crash at a step, by chance. Threads of a run that has
+    # already crashed stop at their next step, as the process would have
+    # died. With point None only that check is made.
+    def maybe_crash(self, point):
+        if threading.current_thread() in self.dead_threads:
+            raise SimulatedCrash()
+        if point is not None and self.rng.random() < self.args.crash:
+            self.crashes[point] += 1
+            self.crashed = True
+            raise SimulatedCrash()
+
+    # Function to start the client afresh from its files on disk
+    def restart(self):
+        module = self.module
+        if self.pipeline is not None:
+            self.dead_threads.update(self.pipeline._threads)
+            self.pipeline._pool.shutdown(wait=False, cancel_futures=True)
+            time.sleep(0.05)  # Let the old threads reach their next step and stop
+        module.done_log = module.load_done_log()
+        module.command_spool = CommandSpool(module.SPOOL_PATH)
+        module.job_tracker = JobTracker(CupsConnection(), module.TRACKED_JOBS_PATH)
+        module.trace_ids = {}
+        module.progress_outbox = module.load_progress_outbox()
+        module.spool_dropped = False
+        self.crashed = False
+        if self.args.pipeline:
+            self.pipeline = PrintPipeline(module.pipeline_fetch, module.process_command, module.submit_prints,
+                                          module.finish_commands, module.cleanup_files,
+                                          batch_size=module.BATCH_MAX_JOBS)
+            module.resume_spool(self.pipeline)
+
+    # Function to run one pass of the client's main loop
+    def turn(self):
+        if self.crashed:
+            self.restart()
+        if time.time() < self.silent_until:
+            return
+        module = self.module
+        try:
+            capacity = self.pipeline.capacity() if self.pipeline is not None else None
+            status_code, data = module.poll_server(False, capacity)
+            if status_code == 200:
+                module.flush_unreported()
+                if self.pipeline is not None and module.spool_dropped:
+                    module.resume_spool(self.pipeline)
+                module.run_commands(data.get("commands", []), self.pipeline)
+            module.track_jobs()
+        except requests.exceptions.RequestException:
+            pass
+        except SimulatedCrash:
+            self.crashed = True
+
+    def stop(self):
+        if self.pipeline is not None:
+            self.pipeline.stop()
+
+
+# Function to count the CUPS jobs each command went out in. A batched
+# submission is titled "Print Jobs <id> <id> ..." and logs one entry per
+# document, so each (CUPS job, command) pair is counted once.
+def count_prints():
+    submissions = {(job_id, command_id) for job_id, _, _, title, _, _ in fake_cups.Connection.jobs
+                   for command_id in title.split()[2:]}
+    return Counter(command_id for _, command_id in submissions)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=2000)
+    parser.add_argument("--drop", type=float, default=0.2, help="probability an HTTP exchange is lost")
+    parser.add_argument("--crash", type=float, default=0.05, help="probability of a client crash per step")
+    parser.add_argument("--batch", type=int, default=50, help="uploads between polls")
+    parser.add_argument("--pipeline", action="store_true", help="run the clients' print pipeline")
+    parser.add_argument("--devices", type=int, choices=(1, 2), default=1)
+    parser.add_argument("--silence", type=float, default=0.05,
+                        help="probability per round that the first of two devices goes silent")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds before the run is given up as stuck")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix="fault_injection_")
+    os.chdir(workdir)
+    os.environ["PRINT_QUEUE_URL"] = f"sqlite:///{workdir}/queue.db"
+
+    import server
+    logging.disable(logging.CRITICAL)
+
+    server.LEASE_SECONDS = 0.05
+    server.BLOB_CHUNK_SIZE = 1024  # Several checksummed chunks per document, so downloads resume mid-way
+    server.REBALANCE_INTERVAL = 0
+    server.scheduler.liveness_timeout = LIVENESS_TIMEOUT
+    client = server.app.test_client()
+    transport = FlakyTransport(client, "http://fault-injection", args.drop, rng)
+
+    crashes = Counter()
+    devices = [Device(number, workdir, transport, args, rng, crashes) for number in range(args.devices)]
+
+    # Threads of crashed pipeline runs die with SimulatedCrash, or with errors
+    # from their shut-down process pool; neither is worth a traceback
+    def excepthook(hook_args):
+        if not any(hook_args.thread in device.dead_threads for device in devices) \
+                and hook_args.exc_type is not SimulatedCrash:
+            threading.__excepthook__(hook_args)
+    threading.excepthook = excepthook
+
+    uploaded = []
+    start = time.perf_counter()
+
+    def upload_batch():
+        for _ in range(min(args.batch, args.jobs - len(uploaded))):
+            response = client.post("/upload", data={
+                "file": (io.BytesIO(make_pdf(rng.choice((1, 3, 10)), len(uploaded))), "doc.pdf"),
+                "num_copies": "1",
+                "upi_method": "success"
+            }, content_type="multipart/form-data")
+            assert response.status_code == 200, response.get_data()
+            uploaded.append(response.get_json())
+
+    rounds = 0
+    silences = 0
+    stuck = False
+    while True:
+        rounds += 1
+        upload_batch()
+        if len(devices) > 1 and time.time() >= devices[0].silent_until and rng.random() < args.silence:
+            devices[0].silent_until = time.time() + SILENCE_SECONDS
+            silences += 1
+        for device in devices:
+            device.turn()
+
+        if len(uploaded) == args.jobs:
+            statuses = [c["status"] for c in server.job_queue.list_commands()]
+            if len(statuses) == args.jobs and all(s in ("completed", "failed") for s in statuses):
+                break
+            if time.perf_counter() - start > args.timeout:
+                stuck = True
+                break
+            time.sleep(server.LEASE_SECONDS)
+
+    for device in devices:
+        if not device.crashed:
+            device.stop()
+
+    elapsed = time.perf_counter() - start
+    commands = server.job_queue.list_commands()
+    prints = count_prints()
+    lost = [c["id"] for c in commands if prints[c["id"]] == 0]
+    duplicates = [command_id for command_id, count in prints.items() if count > 1]
+    failed = [c["id"] for c in commands if c["status"] != "completed"]
+    by_device = Counter(c["device_id"] for c in commands)
+
+    mode = "pipeline" if args.pipeline else "serial"
+    print(f"jobs={args.jobs} mode={mode} devices={args.devices} rounds={rounds} elapsed={elapsed:.1f}s")
+    print(f"dropped: {dict(transport.dropped)}  crashes: {dict(crashes)}  silences: {silences}")
+    print(f"jobs per device: {dict(by_device)}")
+    if stuck:
+        print(f"unfinished: {dict(Counter(c['status'] for c in commands if c['status'] not in ('completed', 'failed')))}")
+    print(f"printed={len(prints)} lost={len(lost)} duplicates={len(duplicates)} failed={len(failed)}"
+          + (" STUCK" if stuck else ""))
+    sys.exit(1 if lost or duplicates or failed or stuck else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+# Load test for server.py: thousands of simulated devices polling while
+# uploads of large PDFs run concurrently. Starts the server in a subprocess
+# (development mode, production mode, or both in turn) and reports latency
+# percentiles per endpoint once a warm-up period has passed.
+#
+# Most devices short-poll (wait=0) on a jittered interval so their latency
+# measures how quickly the server answers; --long-poll-devices hold 25 s
+# long-polls, tying up server threads the way idle kiosks do.
+#
+#   python benchmarks/load_test.py --mode both --devices 2000 --uploaders 8 --duration 30
+import argparse
+import http.client
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+BOUNDARY = "loadtestboundary"
+
+threading.stack_size(256 * 1024)  # Thousands of device threads
+
+
+def make_pdf(size_mb):
+    from PyPDF2 import PdfWriter
+    writer = PdfWriter()
+    writer.add_blank_page(width=595, height=842)
+    if size_mb:
+        writer.add_attachment("filler.bin", os.urandom(size_mb * 1024 * 1024))
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def upload_body(pdf):
+    return (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"upi_method\"\r\n\r\nsuccess\r\n"
+            f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"doc.pdf\"\r\n"
+            "Content-Type: application/pdf\r\n\r\n").encode() + pdf + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.latencies[name].append(seconds)
+
+    def error(self, name):
+        with self._lock:
+            self.errors[name] += 1
+
+    def reset(self):
+        with self._lock:
+            self.latencies.clear()
+            self.errors.clear()
+
+
+# A keep-alive HTTP connection that reconnects when the server closes it
+class Client:
+    def __init__(self, port, timeout):
+        self.port = port
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body=body, headers=headers or {})
+                response = self.conn.getresponse()
+                data = response.read()
+                if response.getheader("Connection", "").lower() == "close":
+                    self.close()
+                return response.status, data
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def device(port, device_id, wait, interval, stop, stats):
+    client = Client(port, timeout=wait + 30)
+    name = "check_commands (long-poll)" if wait else "check_commands"
+    # Spread the first polls out so devices do not arrive in lockstep
+    if stop.wait(random.uniform(0, interval)):
+        return
+    while not stop.is_set():
+        body = json.dumps({"device_id": device_id, "wait": wait})
+        start = time.perf_counter()
+        try:
+            status, data = client.request("POST", "/api/check_commands", body,
+                                          {"Content-Type": "application/json"})
+        except (OSError, http.client.HTTPException):
+            if stop.is_set():
+                return  # Cut off by the server shutting down
+            stats.error(name)
+            client.close()
+            stop.wait(1)
+            continue
+        if status != 200:
+            stats.error(name)
+            stop.wait(1)
+            continue
+        stats.record(name, time.perf_counter() - start)
+
+        reply = json.loads(data)
+        for command in reply.get("commands", []):
+            start = time.perf_counter()
+            try:
+                status, _ = client.request("POST", "/api/check_commands/report", json.dumps({
+                    "device_id": device_id, "command_id": command["command_id"],
+                    "success": True, "message": "printed"}), {"Content-Type": "application/json"})
+                if status == 200:
+                    stats.record("report", time.perf_counter() - start)
+                else:
+                    stats.error("report")
+            except (OSError, http.client.HTTPException):
+                stats.error("report")
+                client.close()
+
+        if reply.get("retry_after"):
+            stats.record("long-poll refused", 0)
+            stop.wait(float(reply["retry_after"]))
+        elif not wait:
+            stop.wait(random.uniform(interval / 2, interval * 1.5))
+
+
+def uploader(port, body, interval, stop, stats):
+    client = Client(port, timeout=120)
+    headers = {"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"}
+    while not stop.wait(random.uniform(interval / 2, interval * 1.5)):
+        start = time.perf_counter()
+        try:
+            status, _ = client.request("POST", "/upload", body, headers)
+        except (OSError, http.client.HTTPException):
+            if stop.is_set():
+                return
+            stats.error("upload")
+            client.close()
+            continue
+        if status == 200:
+            stats.record("upload", time.perf_counter() - start)
+        else:
+            stats.error("upload")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run(mode, args, body):
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="load_test_")
+    env = dict(os.environ, PRINT_SERVER_MODE=mode, PORT=str(port),
+               PRINT_QUEUE_URL=f"sqlite:///{workdir}/queue.db")
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, "server.py")], cwd=workdir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(200):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        stats = Stats()
+        stop = threading.Event()
+        threads = []
+        for n in range(args.devices):
+            wait = args.wait if n < args.long_poll_devices else 0
+            threads.append(threading.Thread(target=device, daemon=True,
+                                            args=(port, f"device_{n:05d}", wait, args.interval, stop, stats)))
+        for _ in range(args.uploaders):
+            threads.append(threading.Thread(target=uploader, args=(port, body, args.upload_interval, stop, stats),
+                                            daemon=True))
+        for thread in threads:
+            thread.start()
+
+        # Measure once every device has connected and settled into its cycle
+        time.sleep(args.warmup)
+        stats.reset()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=1)
+        return stats
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def report(mode, stats, duration):
+    print(f"\n{mode} mode")
+    print(f"{'endpoint':<28}{'count':>8}{'errors':>8}{'req/s':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name in sorted(set(stats.latencies) | set(stats.errors)):
+        values = stats.latencies[name]
+        print(f"{name:<28}{len(values):>8}{stats.errors[name]:>8}{len(values) / duration:>8.1f}"
+              f"{percentile(values, 0.5) * 1000:>10.1f}{percentile(values, 0.99) * 1000:>10.1f}"
+              f"{max(values or [float('nan')]) * 1000:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["development", "production", "both"], default="both")
+    parser.add_argument("--devices", type=int, default=2000)
+    parser.add_argument("--long-poll-devices", type=int, default=200)
+    parser.add_argument("--wait", type=float, default=25, help="long-poll wait requested by long-polling devices")
+    parser.add_argument("--interval", type=float, default=10, help="seconds between short polls per device")
+    parser.add_argument("--uploaders", type=int, default=8)
+    parser.add_argument("--upload-mb", type=int, default=15)
+    parser.add_argument("--upload-interval", type=float, default=5, help="seconds between uploads per uploader")
+    parser.add_argument("--warmup", type=float, default=15, help="seconds run before measuring starts")
+    parser.add_argument("--duration", type=float, default=30)
+    args = parser.parse_args()
+
+    body = upload_body(make_pdf(args.upload_mb))
+    print(f"{args.devices} devices ({args.long_poll_devices} long-polling), {args.uploaders} uploaders "
+          f"of {len(body) / 1024 / 1024:.1f} MB, {args.duration:.0f} s per mode")
+    for mode in (["development", "production"] if args.mode == "both" else [args.mode]):
+        report(mode, run(mode, args, body), args.duration)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# One simulated kiosk for end_to_end.py: poll.py's main loop, unchanged,
+# against a fake CUPS printer. Runs in the current directory, which holds
+# its downloads, spool and log, and appends every document it prints to
+# --cups-log as a JSON line.
+#
+#   python benchmarks/sim_client.py --server http://127.0.0.1:5000 --device-id sim_000 \
+#       --cups-log printed.jsonl --seconds-per-page 0.1
+import argparse
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_cups
+
+sys.modules['cups'] = fake_cups
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server", required=True)
+    parser.add_argument("--device-id", required=True)
+    parser.add_argument("--cups-log", required=True)
+    parser.add_argument("--seconds-per-page", type=float, default=0.0)
+    parser.add_argument("--first-page-seconds", type=float, default=0.0)
+    parser.add_argument("--cups-after", type=float, default=0.0, help="seconds before CUPS can be reached")
+    args = parser.parse_args()
+
+    fake_cups.Connection.log_path = os.path.abspath(args.cups_log)
+    fake_cups.Connection.seconds_per_page = args.seconds_per_page
+    fake_cups.Connection.first_page_seconds = args.first_page_seconds
+    fake_cups.Connection.available_at = time.time() + args.cups_after
+
+    import poll
+    from transport import ServerTransport
+
+    poll.DEVICE_ID = args.device_id
+    poll.SERVER_BASE_URL = args.server
+    poll.transport = ServerTransport(args.server)
+    poll.TRACK_INTERVAL = min(poll.TRACK_INTERVAL, 1)
+    poll.main_loop()
+
+
+if __name__ == '__main__':
+    main()
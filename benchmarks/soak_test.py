@@ -0,0 +1,119 @@
+# Soak test for server.py's admission control: uploads as fast as the
+# uploaders can send them, with no device collecting anything, so the queue
+# fills to its budgets and stays there. Jobs expire after --ttl seconds,
+# which lets a trickle of new uploads back in. The server's RSS is sampled
+# throughout and must stay flat once the queue is full.
+#
+#   python benchmarks/soak_test.py --duration 600 --uploaders 16 --max-jobs 2000
+import argparse
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from end_to_end import rss_bytes, wait_for_port
+from load_test import BOUNDARY, Client, free_port, upload_body
+
+
+def make_pdf(size_kb, number):
+    from PyPDF2 import PdfWriter
+    writer = PdfWriter()
+    writer.add_blank_page(width=595, height=842)
+    writer.add_metadata({"/Title": f"soak document {number}"})
+    writer.add_attachment("filler.bin", os.urandom(size_kb * 1024))
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def uploader(port, bodies, stop, outcomes):
+    client = Client(port, timeout=120)
+    headers = {"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"}
+    number = 0
+    while not stop.is_set():
+        number += 1
+        try:
+            status, _ = client.request("POST", "/upload", bodies[number % len(bodies)], headers)
+        except OSError:
+            if stop.is_set():
+                return
+            outcomes["error"] += 1
+            client.close()
+            continue
+        outcomes[status] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=300)
+    parser.add_argument("--uploaders", type=int, default=16)
+    parser.add_argument("--upload-kb", type=int, default=256)
+    parser.add_argument("--documents", type=int, default=50, help="distinct documents uploaded in turn")
+    parser.add_argument("--max-jobs", type=int, default=2000, help="server's PRINT_MAX_QUEUED_JOBS")
+    parser.add_argument("--max-mb", type=int, default=2048, help="server's PRINT_MAX_QUEUED_MB")
+    parser.add_argument("--ttl", type=int, default=60, help="server's PRINT_JOB_TTL_SECONDS")
+    parser.add_argument("--sample", type=float, default=5, help="seconds between RSS samples")
+    parser.add_argument("--warmup", type=float, default=60, help="seconds before RSS is expected to level off")
+    parser.add_argument("--max-growth-mb", type=float, default=20,
+                        help="largest rise in RSS after the warm-up that still counts as flat")
+    args = parser.parse_args()
+
+    bodies = [upload_body(make_pdf(args.upload_kb, n)) for n in range(args.documents)]
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="soak_test_")
+    env = dict(os.environ, PRINT_SERVER_MODE="production", PORT=str(port),
+               PRINT_QUEUE_URL=f"sqlite:///{workdir}/queue.db", PRINT_MAX_QUEUED_JOBS=str(args.max_jobs),
+               PRINT_MAX_QUEUED_MB=str(args.max_mb), PRINT_JOB_TTL_SECONDS=str(args.ttl))
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, "server.py")], cwd=workdir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        stop = threading.Event()
+        outcomes = Counter()
+        threads = [threading.Thread(target=uploader, args=(port, bodies, stop, outcomes), daemon=True)
+                   for _ in range(args.uploaders)]
+        for thread in threads:
+            thread.start()
+
+        print(f"{args.uploaders} uploaders of {len(bodies[0]) / 1024:.0f} KB, budget {args.max_jobs} jobs / "
+              f"{args.max_mb} MB, TTL {args.ttl} s, no devices\n")
+        print(f"{'seconds':>8}{'RSS MB':>9}{'accepted':>10}{'refused':>9}{'errors':>8}")
+        start = time.time()
+        samples = []
+        while time.time() - start < args.duration:
+            time.sleep(args.sample)
+            elapsed = time.time() - start
+            rss = rss_bytes(server.pid) / 1024 ** 2
+            samples.append((elapsed, rss))
+            print(f"{elapsed:>8.0f}{rss:>9.1f}{outcomes[200]:>10}{outcomes[429]:>9}"
+                  f"{sum(v for k, v in outcomes.items() if k not in (200, 429)):>8}")
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+    finally:
+        server.terminate()
+        server.wait()
+
+    settled = [rss for elapsed, rss in samples if elapsed >= args.warmup]
+    if not settled:
+        print("\nRun was shorter than the warm-up; nothing to judge")
+        sys.exit(1)
+    growth = max(settled) - settled[0]
+    flat = growth <= args.max_growth_mb
+    print(f"\nRSS after warm-up: {settled[0]:.1f} MB -> peak {max(settled):.1f} MB "
+          f"(+{growth:.1f} MB), {'flat' if flat else 'GROWING'}")
+    print(f"accepted={outcomes[200]} refused={outcomes[429]} "
+          f"other={sum(v for k, v in outcomes.items() if k not in (200, 429))}")
+    sys.exit(0 if flat and outcomes[429] else 1)
+
+
+if __name__ == '__main__':
+    main()
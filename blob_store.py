@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import logging
+
+logger = logging.getLogger("PrintServer.BlobStore")
+
+# Configuration
+CHUNK_SIZE = 64 * 1024  # Bytes copied per read when storing a blob
+CHUNKS_SUFFIX = '.chunks'  # Sidecar file holding a blob's chunk digests
+
+_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# Function to check that a string looks like a SHA-256 hex digest
+def is_valid_hash(blob_hash):
+    return bool(blob_hash) and bool(_HASH_RE.match(blob_hash))
+
+
+# Content-addressed storage for uploaded documents.
+# Every blob lives at <root>/<first two hex digits>/<sha256>, so the same
+# document uploaded twice is only stored once.
+class BlobStore:
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, blob_hash):
+        return os.path.join(self.root, blob_hash[:2], blob_hash)
+
+    def exists(self, blob_hash):
+        return is_valid_hash(blob_hash) and os.path.isfile(self.path_for(blob_hash))
+
+    def size(self, blob_hash):
+        return os.path.getsize(self.path_for(blob_hash))
+
+    # Copy a readable stream into the store, hashing it on the way.
+    # Returns (blob_hash, size, created) where created is False for a duplicate.
+    def put_stream(self, stream):
+        writer = self.writer()
+        try:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+            return writer.commit()
+        finally:
+            writer.close()
+
+    # Open a writer that streams straight into the store
+    def writer(self, inspector=None):
+        return BlobWriter(self, inspector)
+
+    # Move a fully written temporary file to its content address
+    def commit(self, temp_path, blob_hash, size):
+        final_path = self.path_for(blob_hash)
+        if os.path.isfile(final_path):
+            os.remove(temp_path)
+            os.utime(final_path)  # Newly in use again, so collect() leaves it be
+            logger.info(f"Blob {blob_hash[:12]} already stored, skipping duplicate")
+            return blob_hash, size, False
+
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(temp_path, final_path)
+        logger.info(f"Stored blob {blob_hash[:12]} ({size} bytes)")
+        return blob_hash, size, True
+
+    def delete(self, blob_hash):
+        try:
+            os.remove(self.path_for(blob_hash))
+        except FileNotFoundError:
+            return False
+        try:
+            os.remove(self.path_for(blob_hash) + CHUNKS_SUFFIX)
+        except FileNotFoundError:
+            pass
+        return True
+
+    # SHA-256 of each chunk_size piece of a blob, so a download can be
+    # checked chunk by chunk. Worked out once and kept beside the blob.
+    def chunk_digests(self, blob_hash, chunk_size):
+        sidecar = self.path_for(blob_hash) + CHUNKS_SUFFIX
+        try:
+            with open(sidecar) as f:
+                manifest = json.load(f)
+            if manifest["chunk_size"] == chunk_size:
+                return manifest["sha256"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        digests = []
+        with open(self.path_for(blob_hash), 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                digests.append(hashlib.sha256(chunk).hexdigest())
+        temp_path = f"{sidecar}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({"chunk_size": chunk_size, "sha256": digests}, f)
+        os.replace(temp_path, sidecar)
+        return digests
+
+    # Delete blobs not in keep, and abandoned partial uploads, last written
+    # more than grace_seconds ago. The grace period covers documents stored
+    # but not yet queued (uploads in flight). Returns the number removed.
+    def collect(self, keep, grace_seconds, now=None):
+        cutoff = (now or time.time()) - grace_seconds
+        removed = 0
+        for entry in os.scandir(self.root):
+            for blob in (os.scandir(entry.path) if entry.is_dir() else [entry]):
+                blob_hash = blob.name.split('.', 1)[0]  # Chunk digests go with their blob
+                if blob_hash in keep or not (is_valid_hash(blob_hash) or blob.name.endswith(".part")):
+                    continue
+                try:
+                    if blob.stat().st_mtime < cutoff:
+                        os.remove(blob.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        if removed:
+            logger.info(f"Removed {removed} unused blobs")
+        return removed
+
+
+# Writable file-like object that lands data directly in the blob store.
+# It hashes (and optionally inspects) each chunk as it is written, so a
+# document is never held in memory or read back after it is saved. Used as
+# the upload stream for multipart requests; anything not committed is
+# deleted when the writer is closed.
+class BlobWriter:
+    def __init__(self, store, inspector=None):
+        self.store = store
+        self.inspector = inspector
+        self.size = 0
+        self.blob_hash = None
+        self._digest = hashlib.sha256()
+        fd, self.temp_path = tempfile.mkstemp(dir=store.root, suffix=".part")
+        self._file = os.fdopen(fd, 'w+b')
+
+    def write(self, chunk):
+        self._digest.update(chunk)
+        if self.inspector is not None:
+            self.inspector.update(chunk)
+        self.size += len(chunk)
+        return self._file.write(chunk)
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def flush(self):
+        self._file.flush()
+
+    # Finish the stream without storing it. Returns (blob_hash, size); the
+    # data stays at temp_path until the writer is closed.
+    def finish(self):
+        if not self._file.closed:
+            if self.inspector is not None:
+                self.inspector.finish()
+            self._file.close()
+        return self._digest.hexdigest(), self.size
+
+    # Finish the stream and move it to its content address
+    def commit(self):
+        blob_hash, size = self.finish()
+        self.blob_hash, size, created = self.store.commit(self.temp_path, blob_hash, size)
+        return self.blob_hash, size, created
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        if self.blob_hash is None and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
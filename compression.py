@@ -0,0 +1,63 @@
+# HTTP body compression shared by the server and the polling client.
+# gzip is always available; zstd is used when the optional zstandard
+# package is installed on both ends.
+import gzip
+import io
+import zlib
+
+# Configuration
+COMPRESS_MIN_BYTES = 512  # Bodies smaller than this are sent as-is; compression would not pay for its headers
+MAX_DECOMPRESSED_BYTES = 1024 * 1024  # Largest JSON body accepted after decompression
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class CompressionError(ValueError):
+    pass
+
+
+# Encodings this side can decode, best first
+def supported_encodings():
+    return ['zstd', 'gzip'] if zstandard else ['gzip']
+
+
+# Function to pick the best encoding offered in an Accept-Encoding header, or None
+def choose_encoding(accept_encoding):
+    offered = {part.split(';', 1)[0].strip().lower() for part in (accept_encoding or '').split(',')}
+    for encoding in supported_encodings():
+        if encoding in offered:
+            return encoding
+    return None
+
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if encoding == 'zstd' and zstandard:
+        return zstandard.ZstdCompressor().compress(data)
+    raise CompressionError(f"Unsupported encoding: {encoding}")
+
+
+# Function to decompress a request body, refusing anything that expands past
+# max_size so a small compressed body cannot exhaust memory
+def decompress(data, encoding, max_size=MAX_DECOMPRESSED_BYTES):
+    try:
+        if encoding == 'gzip':
+            result = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS).decompress(data, max_size + 1)
+        elif encoding == 'zstd' and zstandard:
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)) as reader:
+                result = reader.read(max_size + 1)
+        else:
+            raise CompressionError(f"Unsupported encoding: {encoding}")
+    except CompressionError:
+        raise
+    except Exception as e:
+        # zlib.error or zstandard.ZstdError
+        raise CompressionError(f"Corrupt {encoding} body: {str(e)}")
+
+    if len(result) > max_size:
+        raise CompressionError("Decompressed body is too large")
+    return result
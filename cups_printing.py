@@ -0,0 +1,389 @@
+# Helpers for handing documents to CUPS, shared by poll.py and app.py
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger("PrinterClient.Cups")
+
+# Configuration
+WRITE_CHUNK_SIZE = 64 * 1024  # Bytes sent per writeRequestData call
+THROUGHPUT_WINDOW = 20  # Completed jobs the pages-per-minute estimate is taken over
+SUBMITTED_HISTORY = 1000  # Commands whose CUPS job is remembered after the job has finished
+RECONNECT_INTERVAL = 2  # Base seconds between attempts to reach CUPS after a failure
+MAX_RECONNECT_INTERVAL = 60  # Upper bound for the reconnect backoff
+PRINTER_ATTRIBUTES = ['number-up-supported', 'copies-supported', 'document-format-supported']
+
+_FALSE_VALUES = (False, 0, 'false', 'False', '0', 'off', 'no')
+
+# IPP job-state values
+JOB_STATES = {3: 'pending', 4: 'held', 5: 'processing', 6: 'stopped', 7: 'canceled', 8: 'aborted', 9: 'completed'}
+FINAL_JOB_STATES = ('canceled', 'aborted', 'completed')
+JOB_ATTRIBUTES = ['job-id', 'job-state', 'job-state-reasons', 'job-impressions-completed',
+                  'time-at-processing', 'time-at-completed']
+
+
+class PrinterUnavailable(Exception):
+    pass
+
+
+# Connection to CUPS, opened on first use rather than at import, so a client
+# started before CUPS (or the printer) is up keeps running and connects once
+# it can. A failed call drops the connection and the next call reconnects,
+# since a pycups connection does not recover from cupsd restarting; attempts
+# after a failure back off, so callers may ask as often as they like and
+# get PrinterUnavailable straight away in between.
+#
+# Calls are serialized, so one CupsConnection can be shared between threads,
+# but a thread that must not wait behind a long submission (such as the
+# JobTracker) should have one of its own.
+class CupsConnection:
+    def __init__(self, printer_name=None, cache_path=None,
+                 retry_interval=RECONNECT_INTERVAL, max_retry_interval=MAX_RECONNECT_INTERVAL):
+        self.requested_printer = printer_name  # None prints to the default, or the first printer found
+        self.printer_name = None
+        self.cache_path = cache_path  # Where the printer's attributes are kept between runs
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self._conn = None
+        self._failures = 0
+        self._next_attempt = 0
+        self._error = None
+        self._attributes = None
+        self._attributes_current = False  # Attributes read over the current connection
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        import cups
+        conn = cups.Connection()
+        printer_name = self.requested_printer or conn.getDefault()
+        if not printer_name:
+            printers = conn.getPrinters()
+            if not printers:
+                raise PrinterUnavailable("No printers available")
+            printer_name = next(iter(printers))
+            logger.info(f"No default printer found, using: {printer_name}")
+        return conn, printer_name
+
+    @property
+    def connected(self):
+        return self._conn is not None
+
+    # Function to return (connection, printer name), connecting if need be.
+    # Raises PrinterUnavailable while CUPS cannot be reached.
+    def get(self):
+        with self._lock:
+            if self._conn is not None:
+                return self._conn, self.printer_name
+            now = time.monotonic()
+            if now < self._next_attempt:
+                raise PrinterUnavailable(self._error)
+            try:
+                conn, printer_name = self._connect()
+            except Exception as e:
+                self._failures += 1
+                self._next_attempt = now + min(self.max_retry_interval,
+                                               self.retry_interval * 2 ** (self._failures - 1))
+                error = f"Cannot reach CUPS: {str(e)}"
+                if error != self._error:
+                    logger.warning(error)
+                self._error = error
+                raise PrinterUnavailable(error) from e
+
+            if self._failures:
+                logger.info(f"Connected to CUPS after {self._failures} failed attempt(s)")
+            logger.info(f"Printing to: {printer_name}")
+            self._conn, self.printer_name = conn, printer_name
+            self._failures, self._error = 0, None
+            self._attributes_current = False
+            return conn, printer_name
+
+    # Function to call action(conn, printer_name) on the connection and
+    # return its result. Errors from the action are raised to the caller.
+    def run(self, action):
+        with self._lock:
+            conn, printer_name = self.get()
+            try:
+                return action(conn, printer_name)
+            except Exception:
+                self._conn = None
+                raise
+
+    # Function to wait up to timeout seconds for CUPS to be reachable. Returns
+    # whether it is.
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.get()
+                return True
+            except PrinterUnavailable:
+                now = time.monotonic()
+                if now >= deadline:
+                    return False
+                time.sleep(min(max(self._next_attempt - now, 0.1), deadline - now))
+
+    # Function to return the printer's attributes, {} while none are known.
+    # They are read from CUPS once per connection and kept at cache_path, so
+    # after a restart the last known ones serve until CUPS answers. A busy
+    # connection is not waited for, and with connect=False CUPS is never
+    # contacted (e.g. in a worker process).
+    def attributes(self, connect=True):
+        if connect and not self._attributes_current and self._lock.acquire(blocking=False):
+            try:
+                attributes = self.run(lambda conn, printer_name: conn.getPrinterAttributes(
+                    printer_name, requested_attributes=PRINTER_ATTRIBUTES))
+                self._attributes = {name: attributes[name] for name in PRINTER_ATTRIBUTES if name in attributes}
+                self._attributes_current = True
+                self._save_attributes()
+            except PrinterUnavailable:
+                pass
+            except Exception as e:
+                logger.warning(f"Could not read printer attributes: {str(e)}")
+            finally:
+                self._lock.release()
+        if self._attributes is None:
+            self._attributes = self._load_attributes()
+        return self._attributes or {}
+
+    def _load_attributes(self):
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning("Ignoring unreadable printer attributes cache")
+            return None
+
+    def _save_attributes(self):
+        if not self.cache_path:
+            return
+        temp_path = f"{self.cache_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self._attributes, f)
+        os.replace(temp_path, self.cache_path)
+
+
+# Function to translate a job's print options into CUPS job attributes.
+# Copies and collation are left to CUPS so any number of copies is a single
+# submission; collate defaults to on, so copies come out as complete sets.
+# A document already laid out on its sheets (see imposition.py) gets no
+# orientation or number-up, which would lay it out a second time.
+def cups_options(print_options, page_ranges=None, laid_out=False):
+    copies = max(1, int(print_options.get('num_copies', 1) or 1))
+    pages_per_sheet = int(print_options.get('pages_per_sheet', 1) or 1)
+
+    options = {'copies': str(copies)}
+    if not laid_out:
+        options['orientation-requested'] = '4' if print_options.get('layout') == 'landscape' else '3'
+    if copies > 1:
+        options['collate'] = 'false' if print_options.get('collate', True) in _FALSE_VALUES else 'true'
+    if pages_per_sheet > 1 and not laid_out:
+        options['number-up'] = str(pages_per_sheet)
+    if page_ranges:
+        options['page-ranges'] = page_ranges
+    return options
+
+
+# Function to submit a document to CUPS and return the job ID. A file path is
+# spooled with printFile; an in-memory PDF (bytes) is streamed into the job
+# over IPP so it never has to be written to a temporary file.
+def submit_document(conn, printer_name, document, title, options):
+    if isinstance(document, str):
+        return conn.printFile(printer_name, document, title, options)
+
+    job_id = conn.createJob(printer_name, title, options)
+    conn.startDocument(printer_name, job_id, title, 'application/pdf', 1)
+    data = memoryview(document)
+    for offset in range(0, len(data), WRITE_CHUNK_SIZE):
+        chunk = data[offset:offset + WRITE_CHUNK_SIZE]
+        conn.writeRequestData(bytes(chunk), len(chunk))
+    conn.finishDocument(printer_name)
+    return job_id
+
+
+# Function to submit several documents with the same options as one CUPS job
+# and return its ID. Documents must be file paths; a single document, or one
+# held in memory, goes through submit_document.
+def submit_documents(conn, printer_name, documents, title, options):
+    if len(documents) == 1:
+        return submit_document(conn, printer_name, documents[0], title, options)
+    return conn.printFiles(printer_name, list(documents), title, options)
+
+
+# Function to describe a CUPS job state for the job's status message
+def describe_job_state(state, pages, reasons):
+    reasons = ', '.join(r for r in reasons if r != 'none')
+    if state == 'completed':
+        return f"Printed {pages} page{'s' if pages != 1 else ''}" if pages else "Printed"
+    if state == 'processing':
+        return f"Printing, {pages} page{'s' if pages != 1 else ''} done" if pages else "Printing"
+    if state == 'aborted':
+        return f"Print job aborted by CUPS: {reasons or 'unknown reason'}"
+    if state == 'canceled':
+        return "Print job canceled"
+    return f"Print job {state}: {reasons}" if reasons else f"Print job {state}"
+
+
+# Follows submitted CUPS jobs until they finish, so a job is reported as
+# printed only once CUPS says so. All tracked jobs are read with a single
+# getJobs request per pass, rather than one request per job. The tracked jobs
+# are saved to disk, so they are still followed after the client restarts.
+# Completed jobs also give the printer's real speed in pages per minute.
+#
+# Which CUPS job each recent command went out as is saved too, and noted
+# before the submission starts, so a command whose result was lost in a
+# crash after it reached CUPS is not printed a second time.
+#
+# Give it a CupsConnection of its own, so reading job states never waits
+# behind a submission.
+class JobTracker:
+    def __init__(self, printer, path, window=THROUGHPUT_WINDOW):
+        self.printer = printer
+        self.path = path
+        self._lock = threading.Lock()
+        self._jobs = {}  # Map of job_id -> {"commands": [[command_id, expected pages]], "state", "pages"}
+        self._submitted = OrderedDict()  # Map of command_id -> job_id, or None while being submitted
+        self._recent = deque(maxlen=window)  # (pages, seconds) of recently completed jobs
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if "jobs" not in data:
+                data = {"jobs": data}  # Saved before submissions were remembered
+            self._jobs = {int(job_id): job for job_id, job in data["jobs"].items()}
+            self._submitted = OrderedDict((command_id, job_id) for command_id, job_id in data.get("submitted", []))
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError, AttributeError):
+            self._jobs = {}
+            self._submitted = OrderedDict()
+
+    def _save(self):
+        while len(self._submitted) > SUBMITTED_HISTORY:
+            self._submitted.popitem(last=False)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({"jobs": self._jobs, "submitted": list(self._submitted.items())}, f)
+        os.replace(temp_path, self.path)
+
+    # Note that commands are about to be handed to CUPS, before it is asked
+    def begin(self, command_ids):
+        with self._lock:
+            for command_id in command_ids:
+                self._submitted[command_id] = None
+            self._save()
+
+    # Forget commands whose submission failed, so they can be tried again
+    def abandon(self, command_ids):
+        with self._lock:
+            for command_id in command_ids:
+                self._submitted.pop(command_id, None)
+            self._save()
+
+    # Start following a submitted job. commands is [(command_id, expected pages)],
+    # several for a batched submission.
+    def track(self, job_id, commands):
+        with self._lock:
+            self._jobs[int(job_id)] = {"commands": [list(c) for c in commands], "state": 'pending', "pages": 0}
+            for command_id, _ in commands:
+                self._submitted[command_id] = int(job_id)
+            self._save()
+
+    # Function to find the CUPS job a command was already submitted as, or
+    # None if it never reached CUPS. A command whose submission was cut off
+    # before its job id was saved is looked for in CUPS by job name; that
+    # only works while CUPS keeps the job in its history.
+    def submitted_job(self, command_id):
+        with self._lock:
+            if command_id not in self._submitted:
+                return None
+            job_id = self._submitted[command_id]
+        if job_id is not None:
+            return job_id
+
+        jobs = self.printer.run(lambda conn, _: conn.getJobs(which_jobs='all',
+                                                             requested_attributes=['job-id', 'job-name']))
+        job_id = next((job_id for job_id, attributes in jobs.items()
+                       if command_id in str(attributes.get('job-name') or '').split()), None)
+        with self._lock:
+            if job_id is None:
+                self._submitted.pop(command_id, None)
+            else:
+                self._submitted[command_id] = job_id
+            self._save()
+        return job_id
+
+    def tracking(self, command_id):
+        with self._lock:
+            return any(command_id == c[0] for job in self._jobs.values() for c in job["commands"])
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    # Function to read the state of every tracked job. Returns a list of
+    # (command_id, state, pages printed, message) for jobs that changed.
+    def poll(self):
+        with self._lock:
+            job_ids = list(self._jobs)
+        if not job_ids:
+            return []
+
+        jobs = self.printer.run(lambda conn, _: conn.getJobs(which_jobs='all', first_job_id=min(job_ids),
+                                                             requested_attributes=JOB_ATTRIBUTES))
+        updates = []
+        with self._lock:
+            for job_id in job_ids:
+                job = self._jobs.get(job_id)
+                attributes = jobs.get(job_id)
+                if job is None:
+                    continue
+                if attributes is None:
+                    # CUPS only forgets a job once it is over, when it keeps no job history
+                    state, pages, reasons = 'completed', job["pages"], []
+                else:
+                    state = JOB_STATES.get(attributes.get('job-state'), 'pending')
+                    pages = int(attributes.get('job-impressions-completed') or 0)
+                    reasons = attributes.get('job-state-reasons') or []
+                    if isinstance(reasons, str):
+                        reasons = [reasons]
+                if state == job["state"] and pages == job["pages"]:
+                    continue
+
+                job.update(state=state, pages=pages)
+                commands = job["commands"]
+                for command_id, expected in commands:
+                    # A batched job's pages cannot be split between its documents
+                    command_pages = pages if len(commands) == 1 else (expected if state == 'completed' else 0)
+                    updates.append((command_id, state, command_pages,
+                                    describe_job_state(state, command_pages, reasons)))
+
+                if state in FINAL_JOB_STATES:
+                    del self._jobs[job_id]
+                    if state == 'completed' and attributes:
+                        self._record_throughput(attributes, pages or sum(c[1] for c in commands))
+            if updates:
+                self._save()
+        return updates
+
+    def _record_throughput(self, attributes, pages):
+        started = attributes.get('time-at-processing') or 0
+        finished = attributes.get('time-at-completed') or 0
+        if pages and started and finished > started:
+            self._recent.append((pages, finished - started))
+
+    # Pages per minute over recently completed jobs, or None before any has completed
+    def pages_per_minute(self):
+        with self._lock:
+            seconds = sum(s for _, s in self._recent)
+            if not seconds:
+                return None
+            return round(sum(p for p, _ in self._recent) * 60 / seconds, 1)
@@ -0,0 +1,143 @@
+# Client-side page layout for slow kiosk printers: N-up imposition and
+# orientation done once in a worker process, and optionally rasterization
+# to the printer's native format, so the CUPS filter chain on the Pi has
+# nothing left to do at print time.
+import shutil
+import subprocess
+from io import BytesIO
+
+from page_ranges import parse_page_ranges
+
+# Configuration
+RASTER_RESOLUTION = 300  # Dots per inch of pre-rasterized jobs
+RASTER_TIMEOUT = 300  # Seconds Ghostscript may take to rasterize one job
+SHEET_MARGIN = 12  # Points left blank around the edge of an imposed sheet
+
+# Native formats we can rasterize to, best first: IPP document-format -> Ghostscript device
+RASTER_DEVICES = [('image/pwg-raster', 'pwgraster'), ('image/urf', 'urfrgb')]
+
+
+class ImpositionError(Exception):
+    pass
+
+
+# Function to pick the Ghostscript device for a printer's native raster
+# format, given its document-format-supported. None when there is no
+# format in common or Ghostscript is not installed.
+def raster_device(formats_supported):
+    if not shutil.which('gs'):
+        return None
+    for document_format, device in RASTER_DEVICES:
+        if document_format in (formats_supported or []):
+            return device
+    return None
+
+
+# Function to choose how N pages sit on a sheet: (columns, rows, rotated, scale).
+# Every grid of N cells is tried with pages upright and turned a quarter,
+# and the layout that prints them largest wins -- e.g. 2-up on a portrait
+# sheet stacks two turned pages, as CUPS does.
+def _layout(pages_per_sheet, page_width, page_height, sheet_width, sheet_height):
+    best = None
+    for columns in range(1, pages_per_sheet + 1):
+        if pages_per_sheet % columns:
+            continue
+        rows = pages_per_sheet // columns
+        cell_width = (sheet_width - 2 * SHEET_MARGIN) / columns
+        cell_height = (sheet_height - 2 * SHEET_MARGIN) / rows
+        for rotated in (False, True):
+            width, height = (page_height, page_width) if rotated else (page_width, page_height)
+            scale = min(cell_width / width, cell_height / height)
+            if best is None or scale > best[3] + 1e-9:
+                best = (columns, rows, rotated, scale)
+    return best
+
+
+# Function to wrap a page as a Form XObject, so a sheet can place it with a
+# single "cm ... Do" instead of having its content stream parsed and rewritten
+def _page_form(writer, page):
+    from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, FloatObject, NameObject
+
+    if page.get('/Rotate') and hasattr(page, 'transfer_rotation_to_content'):
+        page.transfer_rotation_to_content()
+    box = page.mediabox
+    contents = page.get_contents()
+    form = DecodedStreamObject()
+    form.set_data(contents.get_data() if contents is not None else b"")
+    form = form.flate_encode()
+    form.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Form'),
+        NameObject('/BBox'): ArrayObject([FloatObject(v) for v in (box.left, box.bottom, box.right, box.top)]),
+        NameObject('/Resources'): page.get('/Resources', DictionaryObject()).get_object().clone(writer)
+    })
+    return writer._add_object(form)
+
+
+# Function to lay the selected pages of a PDF out N to a sheet, on sheets
+# the size of the first page turned to the requested orientation. Returns
+# the new PDF as bytes.
+def impose_pdf(file_path, selected_pages, pages_per_sheet=1, landscape=False, page_count=None):
+    from PyPDF2 import PageObject, PdfReader, PdfWriter, Transformation
+    from PyPDF2.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+    reader = PdfReader(file_path)
+    ranges = parse_page_ranges(selected_pages, page_count or len(reader.pages))
+    pages = [reader.pages[number - 1] for start, end in ranges for number in range(start, end + 1)]
+    if not pages:
+        raise ImpositionError("No pages to impose")
+
+    first = pages[0].mediabox
+    short_side, long_side = sorted((float(first.width), float(first.height)))
+    sheet_width, sheet_height = (long_side, short_side) if landscape else (short_side, long_side)
+    pages_per_sheet = max(1, int(pages_per_sheet or 1))
+
+    writer = PdfWriter()
+    for offset in range(0, len(pages), pages_per_sheet):
+        sheet = PageObject.create_blank_page(width=sheet_width, height=sheet_height)
+        forms = DictionaryObject()
+        content = []
+        for slot, page in enumerate(pages[offset:offset + pages_per_sheet]):
+            name = f'/P{slot}'
+            forms[NameObject(name)] = _page_form(writer, page)
+            box = page.mediabox
+            width, height = float(box.width), float(box.height)
+            columns, rows, rotated, scale = _layout(pages_per_sheet, width, height, sheet_width, sheet_height)
+            cell_width = (sheet_width - 2 * SHEET_MARGIN) / columns
+            cell_height = (sheet_height - 2 * SHEET_MARGIN) / rows
+            column, row = slot % columns, slot // columns
+
+            # Move the page to the origin, turn it if needed, then scale it
+            # into its cell (filled left to right, top to bottom), centred
+            transform = Transformation().translate(-float(box.left), -float(box.bottom))
+            if rotated:
+                transform = transform.rotate(90).translate(height, 0)
+                width, height = height, width
+            left = SHEET_MARGIN + column * cell_width + (cell_width - width * scale) / 2
+            bottom = sheet_height - SHEET_MARGIN - (row + 1) * cell_height + (cell_height - height * scale) / 2
+            matrix = transform.scale(scale).translate(left, bottom).ctm
+            content.append(f"q {' '.join(f'{v:.4f}' for v in matrix)} cm {name} Do Q")
+
+        stream = DecodedStreamObject()
+        stream.set_data('\n'.join(content).encode())
+        sheet[NameObject('/Resources')] = DictionaryObject({NameObject('/XObject'): forms})
+        sheet[NameObject('/Contents')] = writer._add_object(stream)
+        writer.add_page(sheet)
+
+    buffer = BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+# Function to rasterize a PDF to a printer-native format with Ghostscript
+def rasterize_pdf(pdf_path, output_path, device, resolution=RASTER_RESOLUTION, page_ranges=None):
+    command = ['gs', '-q', '-dSAFER', '-dBATCH', '-dNOPAUSE', f'-sDEVICE={device}', f'-r{resolution}',
+               f'-sOutputFile={output_path}']
+    if page_ranges:
+        command.append(f'-sPageList={page_ranges}')
+    try:
+        subprocess.run(command + [pdf_path], check=True, capture_output=True, timeout=RASTER_TIMEOUT)
+    except subprocess.CalledProcessError as e:
+        raise ImpositionError(f"Ghostscript failed: {e.stderr.decode(errors='replace').strip()}")
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise ImpositionError(f"Could not rasterize: {str(e)}")
@@ -0,0 +1,621 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import logging
+from collections import deque
+from datetime import datetime
+
+logger = logging.getLogger("PrintServer.JobQueue")
+
+# Configuration
+DEFAULT_LEASE_SECONDS = 300  # How long a dispatched job stays leased to a device
+UNASSIGNED = "default"  # Queue key for jobs not yet routed to a device
+DEFAULT_PAGE_SIZE = 100  # Records returned per page of history or changes
+DEFAULT_DEQUEUE_LIMIT = 10  # Most commands one dequeue hands a device
+
+PENDING = "pending"
+LEASED = "leased"
+COMPLETED = "completed"
+FAILED = "failed"
+SUBMITTED = "submitted"  # Handed to the printer; the device reports how printing goes
+PRINTING = "printing"
+EXPIRED = "expired"  # Not collected by any device in time; given up on without an ack
+FINISHED_STATES = (COMPLETED, FAILED, SUBMITTED, PRINTING, EXPIRED)  # Lease over, no longer outstanding
+TRACKED_STATES = (SUBMITTED, PRINTING, COMPLETED)  # States the printer's progress may still change
+_FINISHED_PLACEHOLDERS = ', '.join('?' * len(FINISHED_STATES))
+
+
+# Function to pick the status a device's ack moves a job to
+def _ack_status(success, tracked):
+    if not success:
+        return FAILED
+    return SUBMITTED if tracked else COMPLETED
+
+
+# Function to format an epoch timestamp the way the API always has
+def _iso(timestamp):
+    return datetime.fromtimestamp(timestamp).isoformat() if timestamp else None
+
+
+# Function to build the status record exposed by /api/commands
+def _status_record(command_id, device_id, status, created_at, file, pdf_hash,
+                   message=None, completed_at=None, pages=None, version=None):
+    record = {
+        "id": command_id,
+        "device_id": "pending assignment" if device_id == UNASSIGNED else device_id,
+        "timestamp": _iso(created_at),
+        "status": status,
+        "file": file,
+        "pdf_hash": pdf_hash,
+        "pages": pages,
+        "version": version
+    }
+    if message is not None:
+        record["message"] = message
+    if completed_at:
+        record["completed_at"] = _iso(completed_at)
+    return record
+
+
+# Function to create a queue backend from a URL such as
+# "sqlite:///print_queue.db" or "memory://"
+def create_queue(url):
+    if url.startswith("memory://"):
+        return MemoryJobQueue()
+    if url.startswith("sqlite:///"):
+        return SQLiteJobQueue(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported queue URL: {url}")
+
+
+# In-memory backend. Nothing survives a restart, so it is meant for tests
+# and local experiments.
+class MemoryJobQueue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}        # Map of command_id -> job dict
+        self._pending = {}     # Map of device_id -> deque of command_ids
+        self._leased = {}      # Map of device_id -> set of leased command_ids
+        self._devices = {}     # Map of device_id -> last seen timestamp
+        self._version = 0      # Bumped on every change to a job; each job records the version it last changed in
+
+    def touch_device(self, device_id, now=None):
+        with self._lock:
+            self._devices[device_id] = now or time.time()
+
+    def devices(self):
+        with self._lock:
+            return dict(self._devices)
+
+    def enqueue(self, command, device_id=UNASSIGNED, file=None, pages=1, pinned=False, now=None):
+        now = now or time.time()
+        with self._lock:
+            self._jobs[command["command_id"]] = {
+                "command": command,
+                "device_id": device_id,
+                "status": PENDING,
+                "created_at": now,
+                "file": file,
+                "pdf_hash": command.get("pdf_hash"),
+                "lease_expires": None,
+                "completed_at": None,
+                "message": None,
+                "attempts": 0,
+                "pages": pages,
+                "size": command.get("pdf_size") or 0,
+                "pinned": pinned,
+                "version": self._bump()
+            }
+            self._pending.setdefault(device_id, deque()).append(command["command_id"])
+
+    def _bump(self):
+        self._version += 1
+        return self._version
+
+    # Claim up to limit pending jobs for a device (plus unassigned ones) under
+    # a lease. Jobs whose lease on this device has expired without an ack are
+    # redelivered first; a leased job is never handed to another device.
+    def dequeue(self, device_id, lease_seconds=DEFAULT_LEASE_SECONDS, now=None, limit=DEFAULT_DEQUEUE_LIMIT):
+        now = now or time.time()
+        claimed = []
+        with self._lock:
+            version = self._version + 1
+            leased = self._leased.setdefault(device_id, set())
+            expired = sorted((c for c in leased if self._jobs[c]["lease_expires"] <= now),
+                             key=lambda c: self._jobs[c]["created_at"])
+            for command_id in expired[:limit]:
+                job = self._jobs[command_id]
+                job.update(lease_expires=now + lease_seconds, attempts=job["attempts"] + 1, version=version)
+                claimed.append(job)
+                logger.warning(f"Lease on {command_id} expired, redelivering to {device_id}")
+
+            for key in (device_id, UNASSIGNED):
+                queue = self._pending.get(key)
+                while queue and len(claimed) < limit:
+                    command_id = queue.popleft()
+                    job = self._jobs.get(command_id)
+                    if job is None or job["status"] != PENDING or job["device_id"] != key:
+                        continue
+                    job.update(device_id=device_id, status=LEASED, lease_expires=now + lease_seconds,
+                               attempts=job["attempts"] + 1, version=version)
+                    leased.add(command_id)
+                    claimed.append(job)
+            if claimed:
+                self._version = version
+        claimed.sort(key=lambda job: job["created_at"])
+        return [job["command"] for job in claimed]
+
+    # Extend the lease on each of command_ids still leased to a device, even
+    # one that has run out, and return the ids the device still holds. A
+    # device resuming its spool prints only those.
+    def renew(self, device_id, command_ids, lease_seconds=DEFAULT_LEASE_SECONDS, now=None):
+        now = now or time.time()
+        held = []
+        with self._lock:
+            for command_id in command_ids:
+                job = self._jobs.get(command_id)
+                if job is not None and job["status"] == LEASED and job["device_id"] == device_id:
+                    job["lease_expires"] = now + lease_seconds
+                    held.append(command_id)
+        return held
+
+    # Acknowledge a job. Acks for jobs that are already finished are accepted
+    # but do not overwrite the first result. A successful ack with
+    # tracked=True leaves the job SUBMITTED until the device reports that it
+    # has printed. When device_id is given, acks from any other device, or
+    # for a job not delivered yet, are rejected.
+    def complete(self, command_id, success, message="", now=None, tracked=False, device_id=None):
+        with self._lock:
+            job = self._jobs.get(command_id)
+            if job is None or (device_id is not None and job["device_id"] != device_id):
+                return False
+            if job["status"] in FINISHED_STATES:
+                return True
+            if job["status"] != LEASED:
+                return False
+            self._leased.get(job["device_id"], set()).discard(command_id)
+            job.update(status=_ack_status(success, tracked), message=message,
+                       completed_at=now or time.time(), lease_expires=None, version=self._bump())
+            return True
+
+    # Record the printer's progress on an acknowledged job. Returns False when
+    # the job is unknown or not in a state progress applies to (e.g. its ack
+    # has not arrived yet).
+    def update_print_state(self, command_id, status, message, now=None):
+        with self._lock:
+            job = self._jobs.get(command_id)
+            if job is None or job["status"] not in TRACKED_STATES:
+                return False
+            if job["status"] != status or job["message"] != message:
+                job.update(status=status, message=message, version=self._bump())
+                if status != PRINTING:
+                    job["completed_at"] = now or time.time()
+            return True
+
+    def get_status(self, command_id):
+        with self._lock:
+            job = self._jobs.get(command_id)
+            return self._record(command_id, job) if job else None
+
+    def list_commands(self):
+        with self._lock:
+            return [self._record(command_id, job) for command_id, job in self._jobs.items()]
+
+    # One page of history, newest first, optionally filtered by status and
+    # device. before is the id of the last record of the previous page.
+    def query_commands(self, status=None, device_id=None, limit=DEFAULT_PAGE_SIZE, before=None):
+        with self._lock:
+            jobs = sorted(self._jobs.items(), key=lambda item: (item[1]["created_at"], item[0]), reverse=True)
+            if before in self._jobs:
+                cursor = (self._jobs[before]["created_at"], before)
+                jobs = [(c, job) for c, job in jobs if (job["created_at"], c) < cursor]
+            jobs = [(c, job) for c, job in jobs
+                    if (status is None or job["status"] == status)
+                    and (device_id is None or job["device_id"] == device_id)]
+            return [self._record(command_id, job) for command_id, job in jobs[:limit]]
+
+    def current_version(self):
+        with self._lock:
+            return self._version
+
+    # Jobs changed since a version, oldest change first, and the version to
+    # ask from next. Jobs changed together are never split across two pages.
+    def changes(self, since, limit=DEFAULT_PAGE_SIZE):
+        with self._lock:
+            jobs = sorted((job["version"], command_id) for command_id, job in self._jobs.items()
+                          if job["version"] > since)
+            if len(jobs) > limit:
+                last = jobs[limit - 1][0]
+                jobs = [entry for entry in jobs if entry[0] <= last]
+            version = jobs[-1][0] if jobs else max(since, self._version)
+            return [self._record(command_id, self._jobs[command_id]) for _, command_id in jobs], version
+
+    # Outstanding (pending or leased) jobs and pages per device
+    def device_loads(self):
+        with self._lock:
+            loads = {}
+            for job in self._jobs.values():
+                if job["status"] in (PENDING, LEASED):
+                    jobs, pages = loads.get(job["device_id"], (0, 0))
+                    loads[job["device_id"]] = (jobs + 1, pages + job["pages"])
+            return loads
+
+    # Outstanding (pending or leased) jobs and document bytes per device
+    def outstanding(self):
+        with self._lock:
+            totals = {}
+            for job in self._jobs.values():
+                if job["status"] in (PENDING, LEASED):
+                    jobs, size = totals.get(job["device_id"], (0, 0))
+                    totals[job["device_id"]] = (jobs + 1, size + job["size"])
+            return totals
+
+    # Hashes of the documents outstanding jobs still need
+    def referenced_blobs(self):
+        with self._lock:
+            return {job["pdf_hash"] for job in self._jobs.values() if job["status"] in (PENDING, LEASED)}
+
+    # Give up on jobs no device has collected within ttl_seconds of upload:
+    # pending ones, and leased ones whose lease has run out. Returns the
+    # records of the jobs expired.
+    def expire(self, ttl_seconds, message, now=None):
+        now = now or time.time()
+        cutoff = now - ttl_seconds
+        expired = []
+        with self._lock:
+            version = self._version + 1
+            for command_id, job in self._jobs.items():
+                if job["created_at"] >= cutoff:
+                    continue
+                if job["status"] == LEASED and job["lease_expires"] <= now:
+                    self._leased.get(job["device_id"], set()).discard(command_id)
+                elif job["status"] != PENDING:
+                    continue
+                job.update(status=EXPIRED, message=message, completed_at=now, lease_expires=None, version=version)
+                expired.append(self._record(command_id, job))
+            if expired:
+                self._version = version
+        return expired
+
+    # Move unpinned pending jobs off a device. Leased jobs stay put even once
+    # their lease has expired: the device may still be printing them, so
+    # they are only redelivered to it or expired. route(command, pages) names
+    # the new device or returns None to leave the job where it is. Returns
+    # the number of jobs moved.
+    def reassign(self, from_device, route, now=None):
+        moved = 0
+        with self._lock:
+            for command_id in list(self._pending.get(from_device, ())):
+                job = self._jobs.get(command_id)
+                if job is None or job["pinned"] or job["device_id"] != from_device or job["status"] != PENDING:
+                    continue
+                target = route(job["command"], job["pages"])
+                if target is None or target == from_device:
+                    continue
+                job.update(device_id=target, status=PENDING, lease_expires=None, version=self._bump())
+                self._pending.setdefault(target, deque()).append(command_id)
+                moved += 1
+        return moved
+
+    def pending_counts(self):
+        with self._lock:
+            counts = {}
+            for device_id, queue in self._pending.items():
+                count = sum(1 for command_id in queue
+                            if command_id in self._jobs and self._jobs[command_id]["status"] == PENDING)
+                if count:
+                    counts[device_id] = count
+            return counts
+
+    # Drop finished jobs older than the retention window
+    def compact(self, retention_seconds, now=None):
+        cutoff = (now or time.time()) - retention_seconds
+        with self._lock:
+            expired = [command_id for command_id, job in self._jobs.items()
+                       if job["status"] in FINISHED_STATES and job["completed_at"] < cutoff]
+            for command_id in expired:
+                del self._jobs[command_id]
+        return len(expired)
+
+    def _record(self, command_id, job):
+        return _status_record(command_id, job["device_id"], job["status"], job["created_at"],
+                              job["file"], job["pdf_hash"], job["message"], job["completed_at"], job["pages"],
+                              job["version"])
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    command_id TEXT PRIMARY KEY,
+    device_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    file TEXT,
+    pdf_hash TEXT,
+    created_at REAL NOT NULL,
+    lease_expires REAL,
+    completed_at REAL,
+    message TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    pages INTEGER NOT NULL DEFAULT 1,
+    pinned INTEGER NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_device_status ON jobs (device_id, status, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_completed ON jobs (status, completed_at);
+CREATE TABLE IF NOT EXISTS devices (
+    device_id TEXT PRIMARY KEY,
+    last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Columns added after the first release, created on databases that predate them
+_MIGRATIONS = {
+    "attempts": "ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+    "pages": "ALTER TABLE jobs ADD COLUMN pages INTEGER NOT NULL DEFAULT 1",
+    "pinned": "ALTER TABLE jobs ADD COLUMN pinned INTEGER NOT NULL DEFAULT 0",
+    "version": "ALTER TABLE jobs ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+    "size": "ALTER TABLE jobs ADD COLUMN size INTEGER NOT NULL DEFAULT 0"
+}
+
+# Indexes on migrated columns, created once the columns exist
+_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_jobs_version ON jobs (version)",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created_at, command_id)"
+]
+
+_STATUS_COLUMNS = "command_id, device_id, status, created_at, file, pdf_hash, message, completed_at, pages, version"
+
+
+# SQLite backend in WAL mode. Jobs survive restarts and the debug reloader,
+# and several worker processes can share the same database file.
+class SQLiteJobQueue:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connect()
+        self._local.db.executescript(_SCHEMA)
+        self._migrate()
+
+    # One connection per thread; sqlite3 connections must not be shared.
+    # Writers take the lock up front so two workers can never claim the same row.
+    def _connect(self, write=True):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return _Transaction(db, "BEGIN IMMEDIATE" if write else "BEGIN")
+
+    def _migrate(self):
+        with self._connect() as db:
+            columns = {row[1] for row in db.execute("PRAGMA table_info(jobs)")}
+            for column, statement in _MIGRATIONS.items():
+                if column not in columns:
+                    db.execute(statement)
+            for statement in _INDEXES:
+                db.execute(statement)
+            db.execute("INSERT OR IGNORE INTO counters (name, value) SELECT 'version', COALESCE(MAX(version), 0) FROM jobs")
+
+    # Bump the change counter inside a write transaction. Every job changed in
+    # the transaction is stamped with the new value.
+    def _bump(self, db):
+        db.execute("UPDATE counters SET value = value + 1 WHERE name = 'version'")
+        return db.execute("SELECT value FROM counters WHERE name = 'version'").fetchone()[0]
+
+    def touch_device(self, device_id, now=None):
+        with self._connect() as db:
+            db.execute("INSERT INTO devices (device_id, last_seen) VALUES (?, ?) "
+                       "ON CONFLICT(device_id) DO UPDATE SET last_seen = excluded.last_seen",
+                       (device_id, now or time.time()))
+
+    def devices(self):
+        with self._connect(write=False) as db:
+            return dict(db.execute("SELECT device_id, last_seen FROM devices").fetchall())
+
+    def enqueue(self, command, device_id=UNASSIGNED, file=None, pages=1, pinned=False, now=None):
+        with self._connect() as db:
+            db.execute("INSERT INTO jobs (command_id, device_id, status, payload, file, pdf_hash, created_at, "
+                       "pages, pinned, version, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       (command["command_id"], device_id, PENDING, json.dumps(command), file,
+                        command.get("pdf_hash"), now or time.time(), pages, int(pinned), self._bump(db),
+                        command.get("pdf_size") or 0))
+
+    # Claim up to limit pending jobs for a device; see MemoryJobQueue
+    def dequeue(self, device_id, lease_seconds=DEFAULT_LEASE_SECONDS, now=None, limit=DEFAULT_DEQUEUE_LIMIT):
+        now = now or time.time()
+        with self._connect() as db:
+            rows = db.execute("SELECT command_id, payload, status FROM jobs "
+                              "WHERE (device_id IN (?, ?) AND status = ?) "
+                              "OR (device_id = ? AND status = ? AND lease_expires <= ?) "
+                              "ORDER BY status = ? DESC, device_id = ? DESC, created_at LIMIT ?",
+                              (device_id, UNASSIGNED, PENDING, device_id, LEASED, now,
+                               LEASED, device_id, limit)).fetchall()
+            if rows:
+                version = self._bump(db)
+                db.executemany("UPDATE jobs SET device_id = ?, status = ?, lease_expires = ?, "
+                               "attempts = attempts + 1, version = ? WHERE command_id = ?",
+                               [(device_id, LEASED, now + lease_seconds, version, row[0]) for row in rows])
+        for command_id, _, status in rows:
+            if status == LEASED:
+                logger.warning(f"Lease on {command_id} expired, redelivering to {device_id}")
+        return [json.loads(row[1]) for row in rows]
+
+    # Extend the leases a device still holds; see MemoryJobQueue
+    def renew(self, device_id, command_ids, lease_seconds=DEFAULT_LEASE_SECONDS, now=None):
+        now = now or time.time()
+        held = []
+        with self._connect() as db:
+            for command_id in command_ids:
+                cursor = db.execute("UPDATE jobs SET lease_expires = ? WHERE command_id = ? AND device_id = ? "
+                                    "AND status = ?", (now + lease_seconds, command_id, device_id, LEASED))
+                if cursor.rowcount:
+                    held.append(command_id)
+        return held
+
+    # Acknowledge a job; see MemoryJobQueue
+    def complete(self, command_id, success, message="", now=None, tracked=False, device_id=None):
+        with self._connect() as db:
+            row = db.execute("SELECT device_id, status FROM jobs WHERE command_id = ?", (command_id,)).fetchone()
+            if row is None or (device_id is not None and row[0] != device_id):
+                return False
+            if row[1] in FINISHED_STATES:
+                return True
+            if row[1] != LEASED:
+                return False
+            db.execute("UPDATE jobs SET status = ?, message = ?, completed_at = ?, lease_expires = NULL, version = ? "
+                       "WHERE command_id = ?",
+                       (_ack_status(success, tracked), message, now or time.time(), self._bump(db), command_id))
+            return True
+
+    # Record the printer's progress on an acknowledged job; see MemoryJobQueue
+    def update_print_state(self, command_id, status, message, now=None):
+        with self._connect() as db:
+            row = db.execute("SELECT status, message FROM jobs WHERE command_id = ?", (command_id,)).fetchone()
+            if row is None or row[0] not in TRACKED_STATES:
+                return False
+            if tuple(row) != (status, message):
+                completed_at = None if status == PRINTING else (now or time.time())
+                db.execute("UPDATE jobs SET status = ?, message = ?, completed_at = COALESCE(?, completed_at), "
+                           "version = ? WHERE command_id = ?",
+                           (status, message, completed_at, self._bump(db), command_id))
+            return True
+
+    def get_status(self, command_id):
+        with self._connect(write=False) as db:
+            row = db.execute(f"SELECT {_STATUS_COLUMNS} FROM jobs WHERE command_id = ?",
+                             (command_id,)).fetchone()
+        return _status_record(*row) if row else None
+
+    def list_commands(self):
+        with self._connect(write=False) as db:
+            rows = db.execute(f"SELECT {_STATUS_COLUMNS} FROM jobs ORDER BY created_at").fetchall()
+        return [_status_record(*row) for row in rows]
+
+    # One page of history, newest first, optionally filtered by status and
+    # device. before is the id of the last record of the previous page.
+    def query_commands(self, status=None, device_id=None, limit=DEFAULT_PAGE_SIZE, before=None):
+        clauses, params = [], []
+        if before is not None:
+            clauses.append("(created_at, command_id) < (SELECT created_at, command_id FROM jobs WHERE command_id = ?)")
+            params.append(before)
+        if status is not None:
+            clauses.append("status = ?")
+            params.append(status)
+        if device_id is not None:
+            clauses.append("device_id = ?")
+            params.append(device_id)
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+        with self._connect(write=False) as db:
+            rows = db.execute(f"SELECT {_STATUS_COLUMNS} FROM jobs {where}"
+                              "ORDER BY created_at DESC, command_id DESC LIMIT ?", (*params, limit)).fetchall()
+        return [_status_record(*row) for row in rows]
+
+    def current_version(self):
+        with self._connect(write=False) as db:
+            return db.execute("SELECT value FROM counters WHERE name = 'version'").fetchone()[0]
+
+    # Jobs changed since a version, oldest change first, and the version to
+    # ask from next. Jobs changed together are never split across two pages.
+    def changes(self, since, limit=DEFAULT_PAGE_SIZE):
+        with self._connect(write=False) as db:
+            rows = db.execute(f"SELECT {_STATUS_COLUMNS} FROM jobs WHERE version > ? "
+                              "ORDER BY version, command_id LIMIT ?", (since, limit)).fetchall()
+            if len(rows) == limit:
+                rows += db.execute(f"SELECT {_STATUS_COLUMNS} FROM jobs WHERE version = ? AND command_id > ? "
+                                   "ORDER BY command_id", (rows[-1][-1], rows[-1][0])).fetchall()
+            version = rows[-1][-1] if rows else max(since, db.execute(
+                "SELECT value FROM counters WHERE name = 'version'").fetchone()[0])
+        return [_status_record(*row) for row in rows], version
+
+    # Outstanding (pending or leased) jobs and pages per device
+    def device_loads(self):
+        with self._connect(write=False) as db:
+            rows = db.execute("SELECT device_id, COUNT(*), SUM(pages) FROM jobs "
+                              "WHERE status IN (?, ?) GROUP BY device_id", (PENDING, LEASED)).fetchall()
+        return {device_id: (jobs, pages) for device_id, jobs, pages in rows}
+
+    # Outstanding (pending or leased) jobs and document bytes per device
+    def outstanding(self):
+        with self._connect(write=False) as db:
+            rows = db.execute("SELECT device_id, COUNT(*), SUM(size) FROM jobs "
+                              "WHERE status IN (?, ?) GROUP BY device_id", (PENDING, LEASED)).fetchall()
+        return {device_id: (jobs, size) for device_id, jobs, size in rows}
+
+    def referenced_blobs(self):
+        with self._connect(write=False) as db:
+            rows = db.execute("SELECT DISTINCT pdf_hash FROM jobs WHERE status IN (?, ?)",
+                              (PENDING, LEASED)).fetchall()
+        return {row[0] for row in rows}
+
+    # Give up on jobs no device has collected in time; see MemoryJobQueue
+    def expire(self, ttl_seconds, message, now=None):
+        now = now or time.time()
+        with self._connect() as db:
+            rows = db.execute("SELECT command_id FROM jobs WHERE created_at < ? "
+                              "AND (status = ? OR (status = ? AND lease_expires <= ?))",
+                              (now - ttl_seconds, PENDING, LEASED, now)).fetchall()
+            if not rows:
+                return []
+            version = self._bump(db)
+            db.executemany("UPDATE jobs SET status = ?, message = ?, completed_at = ?, lease_expires = NULL, "
+                           "version = ? WHERE command_id = ?",
+                           [(EXPIRED, message, now, version, row[0]) for row in rows])
+            records = db.execute(f"SELECT {_STATUS_COLUMNS} FROM jobs WHERE version = ?", (version,)).fetchall()
+        return [_status_record(*row) for row in records]
+
+    # Move unpinned pending jobs off a device; see MemoryJobQueue
+    def reassign(self, from_device, route, now=None):
+        with self._connect() as db:
+            rows = db.execute("SELECT command_id, payload, pages FROM jobs "
+                              "WHERE device_id = ? AND pinned = 0 AND status = ? ORDER BY created_at",
+                              (from_device, PENDING)).fetchall()
+            moves = []
+            for command_id, payload, pages in rows:
+                target = route(json.loads(payload), pages)
+                if target is not None and target != from_device:
+                    moves.append((target, command_id))
+            if moves:
+                version = self._bump(db)
+                db.executemany("UPDATE jobs SET device_id = ?, status = ?, lease_expires = NULL, version = ? "
+                               "WHERE command_id = ?",
+                               [(target, PENDING, version, command_id) for target, command_id in moves])
+        return len(moves)
+
+    def pending_counts(self):
+        with self._connect(write=False) as db:
+            return dict(db.execute("SELECT device_id, COUNT(*) FROM jobs WHERE status = ? GROUP BY device_id",
+                                   (PENDING,)).fetchall())
+
+    # Drop finished jobs older than the retention window
+    def compact(self, retention_seconds, now=None):
+        cutoff = (now or time.time()) - retention_seconds
+        with self._connect() as db:
+            cursor = db.execute(f"DELETE FROM jobs WHERE status IN ({_FINISHED_PLACEHOLDERS}) AND completed_at < ?",
+                                (*FINISHED_STATES, cutoff))
+        if cursor.rowcount:
+            logger.info(f"Compacted {cursor.rowcount} finished jobs")
+        return cursor.rowcount
+
+
+# Wraps a connection in an explicit transaction
+class _Transaction:
+    def __init__(self, db, begin):
+        self.db = db
+        self.begin = begin
+
+    def __enter__(self):
+        self.db.execute(self.begin)
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
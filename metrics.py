@@ -0,0 +1,174 @@
+# Prometheus-style metrics shared by the server and the polling client:
+# counters, gauges and histograms with labels, rendered in the Prometheus
+# text exposition format. The client pushes its histograms to the server
+# with its polls (see Histogram.snapshot and Histogram.load), so one scrape
+# of the server's /metrics covers both ends.
+import threading
+import time
+from contextlib import contextmanager
+
+# Configuration
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # Seconds
+SIZE_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2)  # Bytes
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.version = 0  # Bumped on every change, so a pusher can tell when there is news
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.version += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_series(key, value))
+        return lines
+
+    def _render_series(self, key, value):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+            self.version += 1
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+            self.version += 1
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            series = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            series[0][index] += 1
+            series[1] += value
+            self.version += 1
+
+    # Context manager observing the seconds spent inside it
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    # Function to export every series as plain JSON, for pushing to another process
+    def snapshot(self):
+        with self._lock:
+            return {
+                "buckets": list(self.buckets),
+                "series": [{"labels": dict(zip(self.label_names, key)), "counts": list(counts), "sum": total}
+                           for key, (counts, total) in self._values.items()]
+            }
+
+    # Function to replace series with a snapshot taken by another process's
+    # histogram with the same buckets. extra_labels fills in the labels this
+    # histogram has and the sender's does not (e.g. which device sent it).
+    def load(self, snapshot, **extra_labels):
+        try:
+            if tuple(snapshot["buckets"]) != self.buckets:
+                raise ValueError(f"{self.name} snapshot has different buckets")
+            loaded = {}
+            for series in snapshot["series"]:
+                counts = [int(count) for count in series["counts"]]
+                if len(counts) != len(self.buckets) + 1 or min(counts) < 0:
+                    raise ValueError(f"{self.name} snapshot has malformed counts")
+                labels = dict(series["labels"], **extra_labels)
+                loaded[self._key(labels)] = [counts, float(series["sum"])]
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"Malformed {self.name} snapshot: {str(e)}")
+
+        with self._lock:
+            self._values.update(loaded)
+            self.version += 1
+
+    def _render_series(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(self.label_names, key, [('le', _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+# A set of metrics rendered together
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._add(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
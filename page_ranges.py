@@ -0,0 +1,100 @@
+# Page selection shared by the server, the kiosk client and app.py.
+# A selection such as "1, 3-5, 4-8" is parsed once into sorted, merged,
+# 1-based inclusive intervals: [(1, 1), (3, 8)].
+from io import BytesIO
+
+
+class PageRangeError(ValueError):
+    pass
+
+
+# Function to parse a page selection. An empty selection means every page.
+# When page_count is given, pages past the end of the document are an error.
+def parse_page_ranges(selected_pages, page_count=None):
+    selected_pages = (selected_pages or '').strip()
+    if not selected_pages:
+        if page_count is None:
+            return []
+        return [(1, page_count)] if page_count else []
+
+    intervals = []
+    for part in selected_pages.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if '-' in part:
+                start, end = (int(value) for value in part.split('-', 1))
+            else:
+                start = end = int(part)
+        except ValueError:
+            raise PageRangeError(f"Invalid page range: '{part}'")
+
+        if start < 1 or end < start:
+            raise PageRangeError(f"Invalid page range: '{part}'")
+        if page_count is not None and end > page_count:
+            raise PageRangeError(f"Page {end} is out of range (document has {page_count} pages)")
+        intervals.append((start, end))
+
+    if not intervals:
+        raise PageRangeError("No pages selected")
+
+    intervals.sort()
+    merged = [intervals[0]]
+    for start, end in intervals[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+# Function to count the pages covered by parsed intervals
+def count_pages(ranges):
+    return sum(end - start + 1 for start, end in ranges)
+
+
+# Function to check whether intervals cover a whole document
+def covers_all(ranges, page_count):
+    return ranges == [(1, page_count)]
+
+
+# Function to format intervals as a CUPS page-ranges value, e.g. "1-3,8"
+def to_cups_page_ranges(ranges):
+    return ','.join(str(start) if start == end else f"{start}-{end}" for start, end in ranges)
+
+
+# Function to decide how a selection reaches the printer, rewriting the PDF
+# only when CUPS cannot do the selection itself. Returns (document, page_ranges):
+#   - document is the original file path, untouched, whenever possible. Any
+#     selection printed one page per sheet is left to CUPS via page-ranges.
+#   - only a partial selection combined with N-up is rewritten, into an
+#     in-memory PDF (bytes), because filters disagree on whether page-ranges
+#     counts input pages or imposed sheets.
+# page_count can be passed in (the server sends it) to avoid opening the file.
+def prepare_document(file_path, selected_pages, pages_per_sheet=1, page_count=None):
+    from PyPDF2 import PdfReader
+
+    reader = None
+    if page_count is None:
+        reader = PdfReader(file_path)
+        page_count = len(reader.pages)
+
+    ranges = parse_page_ranges(selected_pages, page_count)
+    if covers_all(ranges, page_count):
+        return file_path, None
+    if int(pages_per_sheet or 1) <= 1:
+        return file_path, to_cups_page_ranges(ranges)
+
+    from PyPDF2 import PdfWriter
+
+    reader = reader or PdfReader(file_path)
+    writer = PdfWriter()
+    for start, end in ranges:
+        for page_num in range(start - 1, end):  # Pages are zero-indexed
+            writer.add_page(reader.pages[page_num])
+
+    buffer = BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue(), None
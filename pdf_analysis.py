@@ -0,0 +1,101 @@
+import threading
+import logging
+from collections import OrderedDict
+
+from page_ranges import parse_page_ranges
+
+logger = logging.getLogger("PrintServer.Analysis")
+
+# Configuration
+ANALYSIS_CACHE_SIZE = 1024  # Documents whose analysis is kept, least recently used evicted first
+PRICE_PER_SHEET = 2.0  # Price of one printed side of A4 or smaller
+LARGE_PAGE_MULTIPLIER = 2  # Sheets with a page larger than A4 cost this many times more
+A4_POINTS = (595, 842)  # A4 in PDF points, with a little slack applied when comparing
+
+
+# Function to read page count and page sizes from a PDF. PyPDF2 only reads
+# the page tree here, not the page contents.
+def analyze_pdf(path):
+    from PyPDF2 import PdfReader
+
+    reader = PdfReader(path)
+    page_sizes = []
+    for page in reader.pages:
+        box = page.mediabox
+        width, height = round(float(box.width)), round(float(box.height))
+        if int(page.get('/Rotate', 0) or 0) % 180:
+            width, height = height, width
+        page_sizes.append((width, height))
+    return {"page_count": len(page_sizes), "page_sizes": page_sizes}
+
+
+def _is_large(size):
+    short, long = sorted(size)
+    return short > A4_POINTS[0] + 10 or long > A4_POINTS[1] + 10
+
+
+# Function to work out what a job will print and cost from a cached analysis.
+# Raises PageRangeError for a selection that does not fit the document.
+def estimate_cost(analysis, print_options):
+    ranges = parse_page_ranges(print_options.get('selected_pages', ''), analysis["page_count"])
+    pages_per_sheet = max(1, int(print_options.get('pages_per_sheet', 1)))
+    copies = max(1, int(print_options.get('num_copies', 1)))
+
+    selected = [analysis["page_sizes"][n - 1] for start, end in ranges for n in range(start, end + 1)]
+    sheets = 0
+    cost = 0.0
+    for first in range(0, len(selected), pages_per_sheet):
+        group = selected[first:first + pages_per_sheet]
+        sheets += 1
+        cost += PRICE_PER_SHEET * (LARGE_PAGE_MULTIPLIER if any(_is_large(size) for size in group) else 1)
+
+    return {
+        "pages": len(selected),
+        "sheets": sheets * copies,
+        "cost": round(cost * copies, 2),
+        "page_ranges": ranges
+    }
+
+
+# LRU cache of document analyses keyed by content hash, so a document is
+# parsed once no matter how many times it is uploaded, quoted or scheduled
+class AnalysisCache:
+    def __init__(self, max_entries=ANALYSIS_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pdf_hash):
+        with self._lock:
+            analysis = self._entries.get(pdf_hash)
+            if analysis is not None:
+                self._entries.move_to_end(pdf_hash)
+                self.hits += 1
+            return analysis
+
+    def put(self, pdf_hash, analysis):
+        with self._lock:
+            self._entries[pdf_hash] = analysis
+            self._entries.move_to_end(pdf_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    # Return the cached analysis, parsing the document on a miss. Without
+    # PyPDF2 installed, the page count seen while the upload streamed in is
+    # used instead, with every page assumed to be A4.
+    def get_or_analyze(self, pdf_hash, path, page_hint=0):
+        analysis = self.get(pdf_hash)
+        if analysis is None:
+            with self._lock:
+                self.misses += 1
+            try:
+                analysis = analyze_pdf(path)
+            except ImportError:
+                if not page_hint:
+                    raise
+                analysis = {"page_count": page_hint, "page_sizes": [A4_POINTS] * page_hint}
+            self.put(pdf_hash, analysis)
+            logger.info(f"Analyzed {pdf_hash[:12]}: {analysis['page_count']} pages")
+        return analysis
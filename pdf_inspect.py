@@ -0,0 +1,45 @@
+import re
+
+# Configuration
+HEADER_WINDOW = 1024  # The %PDF- header must appear within this many leading bytes
+TRAILER_WINDOW = 1024  # The %%EOF marker must appear within this many trailing bytes
+
+_PAGE_RE = re.compile(rb'/Type\s*/Page(?![A-Za-z])')
+_OVERLAP = 32  # Bytes carried between chunks so a match split across two chunks is still seen
+
+
+# Checks a PDF as it streams past, one chunk at a time, without keeping more
+# than a few kilobytes of it: the header magic, the trailer, and a page count
+# from the /Type /Page objects it sees. Pages stored inside compressed object
+# streams are invisible here, so page_count is a lower bound (0 when unknown).
+class PdfStreamInspector:
+    def __init__(self):
+        self._head = b''
+        self._tail = b''
+        self.page_count = 0
+
+    def update(self, chunk):
+        if len(self._head) < HEADER_WINDOW:
+            self._head += chunk[:HEADER_WINDOW - len(self._head)]
+
+        # Scan the overlap plus the new chunk. A match is counted once it ends in
+        # the new data and has a byte after it (so "/Page" vs "/Pages" is decided);
+        # a match touching the very end is left for the next chunk or finish().
+        window = self._tail[-_OVERLAP:] + chunk
+        offset = len(window) - len(chunk)
+        self.page_count += sum(1 for m in _PAGE_RE.finditer(window) if offset <= m.end() < len(window))
+
+        self._tail = (self._tail + chunk)[-TRAILER_WINDOW:]
+
+    # Count a page object that ends exactly at the end of the stream
+    def finish(self):
+        self.page_count += sum(1 for m in _PAGE_RE.finditer(self._tail[-_OVERLAP:])
+                               if m.end() == len(self._tail[-_OVERLAP:]))
+
+    # Returns an error message, or None when the stream looks like a complete PDF
+    def error(self):
+        if b'%PDF-' not in self._head:
+            return "File is not a PDF"
+        if b'%%EOF' not in self._tail:
+            return "PDF is truncated (no %%EOF trailer)"
+        return None
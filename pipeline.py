@@ -0,0 +1,230 @@
+import queue
+import threading
+import logging
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger("PrinterClient.Pipeline")
+
+# Configuration
+PROCESS_WORKERS = 2  # Processes doing CPU-bound PDF work
+QUEUE_SIZE = 4  # Commands allowed to wait between two stages before the previous stage blocks
+BATCH_SIZE = 1  # Most processed commands handed to submit at once
+MAX_IN_FLIGHT = 16  # Commands taken on before the pipeline reports no spare capacity
+
+_STOP = object()
+
+
+# Runs in a worker process: process a command and time it there, so queueing
+# for a free worker is not counted as processing
+def _timed_process(process, command, file_path):
+    start = time.perf_counter()
+    return process(command, file_path), time.perf_counter() - start
+
+
+# Staged print pipeline for the polling client:
+#
+#   put() -> fetch thread -> process pool -> submit thread -> report thread
+#
+# Stages after fetch are joined by bounded queues, so a slow printer or a
+# large PDF pushes back on the stage before it rather than piling up work in
+# memory. put() itself never blocks, so polling is never held up by the
+# printer; the poller asks the server for no more than capacity() commands
+# instead.
+# PDF processing runs in worker processes in parallel, but the submit thread
+# takes results in arrival order, so jobs reach CUPS in the order they were
+# received and only one thread ever talks to the printer. Commands whose
+# processing has already finished are handed to submit together (up to
+# batch_size), so it can combine them into fewer printer submissions, and
+# results waiting to be reported are likewise handed to finish together.
+#
+# The stages are plain callables supplied by poll.py:
+#   fetch(command) -> local file path, or None to drop the command
+#   process(command, file_path) -> what to print (runs in a worker process, so it must pickle)
+#   submit([(command, processed), ...]) -> [(success, message), or None to drop the command, ...]
+#   finish([(command_id, success, message), ...]) -> records and reports results
+#   cleanup(file_path) -> removes the downloaded file
+#
+# observe(stage, seconds), if given, is told how long each fetch, process,
+# submit and finish call took.
+class PrintPipeline:
+    def __init__(self, fetch, process, submit, finish, cleanup,
+                 process_workers=PROCESS_WORKERS, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, observe=None,
+                 max_in_flight=MAX_IN_FLIGHT):
+        self.fetch = fetch
+        self.process = process
+        self.submit = submit
+        self.finish = finish
+        self.cleanup = cleanup
+        self.observe = observe
+        self.batch_size = max(1, batch_size)
+        self.max_in_flight = max_in_flight
+        self._incoming = queue.Queue()
+        self._processing = queue.Queue(maxsize=queue_size)
+        self._results = queue.Queue(maxsize=queue_size * 4)
+        self._pool = ProcessPoolExecutor(max_workers=process_workers)
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._fetch_loop, name="pipeline-fetch", daemon=True),
+            threading.Thread(target=self._submit_loop, name="pipeline-submit", daemon=True),
+            threading.Thread(target=self._report_loop, name="pipeline-report", daemon=True)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    # Queue a command without blocking; returns False for a command that is
+    # already somewhere in the pipeline (e.g. a redelivery).
+    def put(self, command):
+        command_id = command.get('command_id')
+        with self._lock:
+            if command_id in self._in_flight:
+                return False
+            self._in_flight.add(command_id)
+        self._incoming.put(command)
+        return True
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    # How many more commands the pipeline should be given
+    def capacity(self):
+        return max(0, self.max_in_flight - self.in_flight())
+
+    # Wait for every queued command to be reported, then shut the stages down
+    def stop(self):
+        self._incoming.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._pool.shutdown()
+
+    def _observe(self, stage, seconds):
+        if self.observe is not None:
+            try:
+                self.observe(stage, seconds)
+            except Exception as e:
+                logger.warning(f"Could not record {stage} timing: {str(e)}")
+
+    def _done(self, command_id):
+        with self._lock:
+            self._in_flight.discard(command_id)
+
+    def _fetch_loop(self):
+        while True:
+            command = self._incoming.get()
+            if command is _STOP:
+                self._processing.put(_STOP)
+                return
+
+            command_id = command.get('command_id')
+            start = time.perf_counter()
+            try:
+                file_path = self.fetch(command)
+            except Exception as e:
+                logger.error(f"Fetch failed for {command_id}: {str(e)}")
+                self._results.put((command_id, False, f"Error fetching document: {str(e)}"))
+                continue
+            finally:
+                self._observe('fetch', time.perf_counter() - start)
+
+            if file_path is None:
+                # Dropped without a result; the server will redeliver it
+                self._done(command_id)
+                continue
+
+            future = self._pool.submit(_timed_process, self.process, command, file_path)
+            self._processing.put((command, file_path, future))
+
+    # Take the next batch in arrival order: the oldest command (waiting for its
+    # processing if need be) plus any commands right behind it that are
+    # already processed. Returns None once the pipeline is stopping.
+    def _next_batch(self, ready):
+        if not ready:
+            ready.append(self._processing.get())
+        while len(ready) < self.batch_size:
+            try:
+                ready.append(self._processing.get_nowait())
+            except queue.Empty:
+                break
+
+        batch = []
+        while ready and ready[0] is not _STOP and len(batch) < self.batch_size:
+            if batch and not ready[0][2].done():
+                break
+            batch.append(ready.popleft())
+        return batch or None
+
+    def _submit_loop(self):
+        ready = deque()
+        while True:
+            batch = self._next_batch(ready)
+            if batch is None:
+                self._results.put(_STOP)
+                return
+
+            jobs = []
+            results = {}
+            for command, file_path, future in batch:
+                try:
+                    processed, seconds = future.result()
+                    jobs.append((command, processed))
+                    self._observe('process', seconds)
+                except Exception as e:
+                    logger.error(f"Processing failed for {command.get('command_id')}: {str(e)}")
+                    results[command.get('command_id')] = (False, f"Error processing print command: {str(e)}")
+
+            start = time.perf_counter()
+            try:
+                for (command, _), result in zip(jobs, self.submit(jobs) if jobs else []):
+                    results[command.get('command_id')] = result
+                if jobs:
+                    self._observe('submit', time.perf_counter() - start)
+            except Exception as e:
+                logger.error(f"Printing failed: {str(e)}")
+                for command, _ in jobs:
+                    results[command.get('command_id')] = (False, f"Error while printing: {str(e)}")
+            finally:
+                for command, file_path, _ in batch:
+                    self.cleanup(file_path)
+
+            for command, _, _ in batch:
+                command_id = command.get('command_id')
+                result = results.get(command_id, (False, "Print job was not submitted"))
+                if result is None:
+                    # Dropped without a result, like a command fetch gave up on
+                    self._done(command_id)
+                    continue
+                self._results.put((command_id, *result))
+
+    def _report_loop(self):
+        while True:
+            item = self._results.get()
+            if item is _STOP:
+                return
+
+            # Report everything that is already waiting in one go
+            results = [item]
+            stopping = False
+            while True:
+                try:
+                    item = self._results.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                results.append(item)
+
+            start = time.perf_counter()
+            try:
+                self.finish(results)
+                self._observe('finish', time.perf_counter() - start)
+            except Exception as e:
+                logger.error(f"Reporting failed for {', '.join(str(r[0]) for r in results)}: {str(e)}")
+            finally:
+                for command_id, _, _ in results:
+                    self._done(command_id)
+            if stopping:
+                return
@@ -1,13 +1,22 @@
 import requests
 import time
+import random
 import json
 import os
-import cups
-import tempfile
-from PyPDF2 import PdfReader, PdfWriter
-import base64
-from io import BytesIO
+import hashlib
 import logging
+import math
+import threading
+from collections import OrderedDict
+
+from pipeline import PrintPipeline
+from page_ranges import PageRangeError, count_pages, parse_page_ranges, prepare_document
+from cups_printing import (CupsConnection, JobTracker, PrinterUnavailable, cups_options, submit_document,
+                           submit_documents)
+from imposition import impose_pdf, raster_device, rasterize_pdf, RASTER_RESOLUTION
+from transport import ServerTransport
+from metrics import Histogram
+from spool import CommandSpool, SpoolCache
 
 # Configure logging
 logging.basicConfig(
@@ -22,209 +31,878 @@ logger = logging.getLogger("PrinterClient")
 
 # Configuration
 DEVICE_ID = "pi_printer_001"  # Unique ID for this Raspberry Pi
-SERVER_URL = "https://sukus-vending-printer.onrender.com/api/check_commands"  # Replace with your server URL
-POLL_INTERVAL = 10  # Seconds between polls
+SERVER_BASE_URL = "https://sukus-vending-printer.onrender.com"  # Replace with your server URL
+COMMANDS_PATH = "/api/check_commands"
+BLOBS_PATH = "/api/blobs"
+POLL_INTERVAL = 10  # Seconds between polls when the server does not support long-polling
+LONG_POLL_WAIT = 25  # Seconds the server may hold a poll open waiting for work
 UPLOAD_FOLDER = './downloads'  # Folder to store downloaded PDFs
-RETRY_INTERVAL = 10  # Seconds to wait after a connection error
+RETRY_INTERVAL = 10  # Base seconds to wait after a connection error
+MAX_RETRY_INTERVAL = 120  # Upper bound for the exponential retry backoff
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Bytes read per chunk when downloading a PDF
+DOWNLOAD_ATTEMPTS = 5  # Times an interrupted download is resumed before it is left for a later poll
+DOWNLOAD_RETRY_INTERVAL = 2  # Base seconds to wait before resuming an interrupted download
+DONE_LOG_PATH = os.path.join(UPLOAD_FOLDER, 'completed_commands.json')  # Results of handled commands
+DONE_LOG_SIZE = 1000  # Number of recent command results remembered for de-duplication
+BATCH_MAX_JOBS = 8  # Most ready jobs combined into one CUPS submission
+BATCH_MAX_PAGES = 10  # Only jobs of at most this many pages are combined
+CAPABILITIES_INTERVAL = 600  # Seconds between re-sending printer capabilities with a poll
+SPOOL_FOLDER = os.path.join(UPLOAD_FOLDER, 'spool')  # Cached documents, downloaded and processed
+SPOOL_PATH = os.path.join(UPLOAD_FOLDER, 'spooled_commands.json')  # Commands received but not yet finished
+REPORT_BATCH_SIZE = 100  # Most results sent per request when catching up after being offline
+PREPROCESS = 'cups'  # 'cups' leaves N-up and orientation to the filter chain, 'impose' lays pages out here,
+                     # 'raster' also rasterizes to the printer's native format (needs Ghostscript)
+IMPOSED_NUMBER_UP = [1, 2, 4, 6, 9, 16]  # Pages per sheet offered when pages are laid out here
+TRACK_INTERVAL = 5  # Seconds between reads of submitted jobs' state from CUPS
+PROGRESS_MAX_AGE = 600  # Seconds a progress update is re-sent for before it is given up on
+TRACKED_JOBS_PATH = os.path.join(UPLOAD_FOLDER, 'tracked_jobs.json')  # CUPS jobs still being followed
+PROGRESS_PATH = os.path.join(UPLOAD_FOLDER, 'progress_outbox.json')  # Progress updates the server has not accepted
+PRINTER_ATTRIBUTES_PATH = os.path.join(UPLOAD_FOLDER, 'printer_attributes.json')  # Last known printer attributes
+PRINTER_WAIT = 60  # Seconds a ready job waits for CUPS before it is held and retried from the spool
+PIPELINE_STAGES = {'fetch': 'download', 'process': 'process_pdf', 'submit': 'print', 'finish': 'report'}
 
 # Ensure download directory exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# CUPS connection
-try:
-    conn = cups.Connection()
-    printer_name = conn.getDefault()
-    logger.info(f"Default printer: {printer_name}")
-    if not printer_name:
-        available_printers = conn.getPrinters()
-        if available_printers:
-            printer_name = list(available_printers.keys())[0]
-            logger.info(f"No default printer found, using: {printer_name}")
-        else:
-            logger.error("No printers found")
-            raise Exception("No printers available")
-except Exception as e:
-    logger.error(f"Failed to connect to CUPS: {str(e)}")
-    raise
-
-# Function to handle PDF processing and page selection
-def process_pdf(file_path, print_options):
+# Keep-alive connection pool shared by polling, reporting and downloads
+transport = ServerTransport(SERVER_BASE_URL)
+
+# Documents are kept on disk by content hash so repeats skip download and
+# processing, and received commands are kept until they are finished
+spool_cache = SpoolCache(SPOOL_FOLDER)
+command_spool = CommandSpool(SPOOL_PATH)
+spool_dropped = False  # Set when a spooled command could not be fetched or printed and must be retried
+
+# Time spent in each stage of handling a job, pushed to the server with polls
+stage_seconds = Histogram('print_client_stage_seconds', "Seconds the client spent per job stage", ['stage'])
+
+# Trace IDs of commands being handled, echoed back with their results so the
+# server's and the client's logs for a job can be tied together
+trace_ids = {}
+
+# CUPS is connected to when first needed, and again after it fails, so the
+# client polls and fetches work while CUPS and the printer are coming up
+printer = CupsConnection(cache_path=PRINTER_ATTRIBUTES_PATH)
+
+# Function to read what the printer supports so the server can route jobs it can handle
+def get_capabilities(attributes):
+    capabilities = {}
+    number_up = attributes.get('number-up-supported')
+    if number_up:
+        capabilities['number_up'] = list(number_up) if isinstance(number_up, (list, tuple)) else [number_up]
+    if PREPROCESS != 'cups' and attributes:
+        capabilities['number_up'] = sorted(set(capabilities.get('number_up', [])) | set(IMPOSED_NUMBER_UP))
+    copies = attributes.get('copies-supported')
+    if copies:
+        capabilities['max_copies'] = copies[-1] if isinstance(copies, (list, tuple)) else copies
+    return capabilities
+
+# Function to pick the Ghostscript device jobs are pre-rasterized with, if any
+def get_raster_device(attributes):
+    if PREPROCESS != 'raster':
+        return None
+    device = raster_device(attributes.get('document-format-supported'))
+    if device is None:
+        logger.warning("Cannot rasterize for this printer (no Ghostscript or no shared raster format), "
+                       "laying pages out as PDF instead")
+    return device
+
+raster_devices = {}  # Formats the printer supports -> device picked for them
+
+# Function to pick the raster device for the printer as last known. Runs in
+# worker processes too, so it never contacts CUPS itself.
+def current_raster_device():
+    if PREPROCESS != 'raster':
+        return None
+    formats = printer.attributes(connect=False).get('document-format-supported')
+    key = tuple(formats) if isinstance(formats, (list, tuple)) else formats
+    if key not in raster_devices:
+        raster_devices[key] = get_raster_device({'document-format-supported': formats})
+    return raster_devices[key]
+
+# Follows submitted jobs in CUPS on a connection of its own
+job_tracker = JobTracker(CupsConnection(), TRACKED_JOBS_PATH)
+
+# Function to load the progress updates the server had not accepted before
+# a restart. CUPS jobs stop being followed once they finish, so these are
+# all that is left of their final state.
+def load_progress_outbox():
+    try:
+        with open(PROGRESS_PATH) as f:
+            return {update['command_id']: (update, first_tried) for update, first_tried in json.load(f)}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable progress outbox: {str(e)}")
+        return {}
+
+def save_progress_outbox():
+    temp_path = f"{PROGRESS_PATH}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(list(progress_outbox.values()), f)
+    os.replace(temp_path, PROGRESS_PATH)
+
+# Progress updates waiting to be accepted by the server: command_id -> (update, first tried)
+progress_outbox = load_progress_outbox()
+
+# Function to decide whether a job's pages are laid out on their sheets here
+# rather than by the CUPS filter chain
+def lays_out(print_options):
+    if PREPROCESS == 'cups':
+        return False
+    return (current_raster_device() is not None or int(print_options.get('pages_per_sheet', 1) or 1) > 1
+            or print_options.get('layout') == 'landscape')
+
+# Function to handle PDF processing and page selection. Returns
+# (document, page_ranges, laid_out): the document to print (the original
+# path, a rewritten PDF as bytes, or raster_path once rasterized), the CUPS
+# page-ranges to apply to it, if any, and whether N-up and orientation have
+# already been applied.
+def process_pdf(file_path, print_options, page_count=None, raster_path=None):
     logger.info(f"Processing PDF: {file_path}")
-    reader = PdfReader(file_path)
-    writer = PdfWriter()
-    
-    # Handle selected pages
     selected_pages = print_options.get('selected_pages', '')
-    if selected_pages:
-        pages = []
-        for page_range in selected_pages.split(','):
-            if '-' in page_range:
-                start, end = map(int, page_range.split('-'))
-                pages.extend(range(start - 1, end))  # Pages are zero-indexed
-            else:
-                pages.append(int(page_range) - 1)
-
-        for page_num in pages:
-            if 0 <= page_num < len(reader.pages):
-                writer.add_page(reader.pages[page_num])
-    else:
-        # If no pages are selected, print the entire document
-        for page_num in range(len(reader.pages)):
-            writer.add_page(reader.pages[page_num])
-
-    # Create temporary file to store the new PDF with selected pages
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-    with open(temp_file.name, 'wb') as f:
-        writer.write(f)
-
-    return temp_file.name
-
-# Function to send a PDF to the printer
-def print_pdf(pdf_path, print_options):
-    logger.info(f"Sending PDF to printer: {pdf_path}")
-    
-    # Get print options
-    num_copies = int(print_options.get('num_copies', 1))
-    layout = print_options.get('layout', 'portrait')
-    pages_per_sheet = int(print_options.get('pages_per_sheet', 1))
-    
-    # Set up CUPS printing options
-    cups_options = {}
-    if layout == 'landscape':
-        cups_options['orientation-requested'] = '4'  # Landscape
-    else:
-        cups_options['orientation-requested'] = '3'  # Portrait
-    
-    if pages_per_sheet > 1:
-        cups_options['number-up'] = str(pages_per_sheet)
+    pages_per_sheet = int(print_options.get('pages_per_sheet', 1) or 1)
+    landscape = print_options.get('layout') == 'landscape'
+    device = current_raster_device()
+    if not lays_out(print_options):
+        document, page_ranges = prepare_document(file_path, selected_pages, pages_per_sheet, page_count)
+        return document, page_ranges, False
+    
+    if pages_per_sheet == 1 and not landscape and device and raster_path:
+        # Nothing to lay out; rasterize the selected pages as they are
+        document, page_ranges = prepare_document(file_path, selected_pages, 1, page_count)
+        rasterize_pdf(document, raster_path, device, RASTER_RESOLUTION, page_ranges)
+        return raster_path, None, True
+    
+    imposed = impose_pdf(file_path, selected_pages, pages_per_sheet, landscape, page_count)
+    if not (device and raster_path):
+        return imposed, None, True
+    
+    imposed_path = f"{raster_path}.pdf"
+    try:
+        with open(imposed_path, 'wb') as f:
+            f.write(imposed)
+        rasterize_pdf(imposed_path, raster_path, device, RASTER_RESOLUTION)
+    finally:
+        os.remove(imposed_path)
+    return raster_path, None, True
+
+# Function to name the cache entry for a command's processed document
+def processed_key(command):
+    print_options = command.get('print_options', {})
+    selection = json.dumps([command.get('pdf_hash'), str(print_options.get('selected_pages', '')).replace(' ', ''),
+                            int(print_options.get('pages_per_sheet', 1) or 1)]
+                           + ([print_options.get('layout'), PREPROCESS, current_raster_device(), RASTER_RESOLUTION]
+                              if lays_out(print_options) else []))
+    return hashlib.sha256(selection.encode()).hexdigest()
+
+# Function to process a command's downloaded document (runs in a worker process).
+# Rewritten, imposed and rasterized documents are kept in the spool cache
+# under the content hash and options, and printed from there, so the same
+# document with the same options is only ever processed once.
+def process_command(command, file_path):
+    print_options = command.get('print_options', {})
+    key = processed_key(command)
+    laid_out = lays_out(print_options)
+    if laid_out or (int(print_options.get('pages_per_sheet', 1) or 1) > 1 and print_options.get('selected_pages')):
+        cached = spool_cache.get(key)
+        if cached:
+            logger.info(f"Using cached processed PDF for {command.get('command_id')}")
+            return cached, None, laid_out
+    
+    raster_path = spool_cache.temp_path(key)
+    try:
+        document, page_ranges, laid_out = process_pdf(file_path, print_options, command.get('page_count'),
+                                                      raster_path)
+    except BaseException:
+        cleanup_files(raster_path)
+        raise
+    if document == raster_path:
+        document = spool_cache.put_file(key, raster_path)
+    elif isinstance(document, bytes):
+        document = spool_cache.put_bytes(key, document)
+    return document, page_ranges, laid_out
+
+# Function to estimate the sheet sides a command will print, for when CUPS
+# does not count them itself
+def expected_pages(command):
+    print_options = command.get('print_options', {})
+    try:
+        pages = count_pages(parse_page_ranges(print_options.get('selected_pages', ''), command.get('page_count')))
+        per_sheet = max(1, int(print_options.get('pages_per_sheet', 1) or 1))
+        copies = max(1, int(print_options.get('num_copies', 1) or 1))
+    except (PageRangeError, TypeError, ValueError):
+        return 0
+    return math.ceil(pages / per_sheet) * copies
+
+# Function to send a PDF to the printer as a single CUPS job, copies included.
+# track lists the (command_id, expected pages) to follow the CUPS job for.
+def print_pdf(document, print_options, title="Print Job", page_ranges=None, track=None, laid_out=False):
+    logger.info(f"Sending PDF to printer: {document if isinstance(document, str) else 'in-memory PDF'}")
     
+    command_ids = [command_id for command_id, _ in track or []]
     try:
-        job_id = conn.printFile(printer_name, pdf_path, "Print Job", cups_options)
+        if command_ids:
+            job_tracker.begin(command_ids)
+        job_id = printer.run(lambda conn, printer_name: submit_document(
+            conn, printer_name, document, title, cups_options(print_options, page_ranges, laid_out)))
         logger.info(f"Print job submitted with ID: {job_id}")
+        if track:
+            job_tracker.track(job_id, track)
         return True, f"Print job submitted with ID: {job_id}"
     except Exception as e:
         error_msg = f"Error while printing: {str(e)}"
         logger.error(error_msg)
+        if command_ids:
+            job_tracker.abandon(command_ids)
         return False, error_msg
 
-# Function to handle a print command
-def handle_print_command(command):
-    logger.info(f"Processing print command: {command.get('command_id', 'unknown')}")
+# Function to check whether a command already reached CUPS, e.g. before a
+# crash lost its result. Returns its (success, message) without printing it
+# again, or None if it still has to be printed.
+def already_submitted(command_id):
+    job_id = job_tracker.submitted_job(command_id)
+    if job_id is None:
+        return None
+    logger.warning(f"Command {command_id} was already sent to the printer as job {job_id}, not printing it again")
+    return True, f"Print job submitted with ID: {job_id}"
+
+class ChunkChecksumError(ValueError):
+    pass
+
+# Function to fetch a blob's per-chunk SHA-256 digests, or None from a
+# server that does not offer them
+def fetch_chunk_manifest(pdf_hash):
+    with transport.get(f"{BLOBS_PATH}/{pdf_hash}/chunks", timeout=30) as response:
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+# Function to work out how much of a partial download can be kept: every
+# whole chunk that matches its digest (everything, without digests). The
+# file is cut back to that length. Returns (length, SHA-256 of the kept data).
+def verified_prefix(file_path, manifest):
+    digest = hashlib.sha256()
+    length = 0
+    if not os.path.exists(file_path):
+        return length, digest
     
-    try:
-        # Extract PDF data and options from command
-        pdf_data_base64 = command.get('pdf_data')
-        print_options = command.get('print_options', {})
-        command_id = command.get('command_id')
-        
-        if not pdf_data_base64:
-            return False, "No PDF data in command"
+    chunk_size = manifest["chunk_size"] if manifest else DOWNLOAD_CHUNK_SIZE
+    with open(file_path, 'r+b') as f:
+        index = 0
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            if manifest and (index >= len(manifest["sha256"])
+                             or hashlib.sha256(data).hexdigest() != manifest["sha256"][index]):
+                break
+            digest.update(data)
+            length += len(data)
+            index += 1
+        f.truncate(length)
+    return length, digest
+
+# Function to stream a blob to disk from where the partial file leaves off,
+# checking each chunk against its digest as it completes
+def download_rest(pdf_hash, file_path, manifest):
+    offset, digest = verified_prefix(file_path, manifest)
+    if manifest and offset == manifest["size"]:
+        return digest
+    
+    headers = {'Range': f"bytes={offset}-"} if offset else {}
+    with transport.get(f"{BLOBS_PATH}/{pdf_hash}", stream=True, timeout=30, headers=headers) as response:
+        if response.status_code == 416:
+            return digest  # Nothing left to fetch
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            logger.info(f"Server cannot resume {pdf_hash[:12]}, downloading it again")
+            offset, digest = 0, hashlib.sha256()
         
-        # Decode PDF data
-        pdf_data = base64.b64decode(pdf_data_base64)
+        chunk_size = manifest["chunk_size"] if manifest else None
+        chunk_digest = hashlib.sha256()
+        filled = 0
+        with open(file_path, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            for data in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(data)
+                digest.update(data)
+                if chunk_size is None:
+                    continue
+                view = memoryview(data)
+                while view:
+                    take = min(len(view), chunk_size - filled)
+                    chunk_digest.update(view[:take])
+                    filled += take
+                    view = view[take:]
+                    if filled == chunk_size:
+                        check_chunk(f, manifest, offset, chunk_digest)
+                        offset += chunk_size
+                        chunk_digest, filled = hashlib.sha256(), 0
+            if filled:
+                check_chunk(f, manifest, offset, chunk_digest)
+    return digest
+
+# Function to compare a finished chunk with its digest. A bad chunk is cut
+# off the file, so the next attempt fetches it again.
+def check_chunk(f, manifest, offset, chunk_digest):
+    index = offset // manifest["chunk_size"]
+    if index < len(manifest["sha256"]) and chunk_digest.hexdigest() == manifest["sha256"][index]:
+        return
+    f.truncate(offset)
+    raise ChunkChecksumError(f"Chunk {index} failed its checksum")
+
+# Function to download a document from the server's blob store straight to
+# disk, in constant memory. An interrupted download is resumed with a Range
+# request from its last good chunk rather than started over, and the partial
+# file stays on disk so a later poll, or a restart, picks it up too.
+def download_blob(pdf_hash, file_path):
+    manifest = fetch_chunk_manifest(pdf_hash)
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        try:
+            digest = download_rest(pdf_hash, file_path, manifest)
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout, ChunkChecksumError) as e:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+            logger.warning(f"Download of {pdf_hash[:12]} interrupted, resuming: {str(e)}")
+            time.sleep(backoff_delay(DOWNLOAD_RETRY_INTERVAL, attempt, MAX_RETRY_INTERVAL))
+    
+    if digest.hexdigest() != pdf_hash:
+        os.remove(file_path)
+        raise ValueError(f"Checksum mismatch for blob {pdf_hash}")
+
+# Function to tell a request the server has refused for good, such as a
+# document removed after its job expired, from trouble worth retrying
+def is_final_error(error):
+    response = getattr(error, 'response', None)
+    return (isinstance(error, requests.exceptions.HTTPError) and response is not None
+            and 400 <= response.status_code < 500 and response.status_code not in (408, 429))
+
+# Function to get a command's document into the spool cache, returning its
+# local path. A document already in the cache is not downloaded again.
+def fetch_command(command):
+    pdf_hash = command.get('pdf_hash')
+    command_id = command.get('command_id')
+    
+    if not pdf_hash:
+        raise ValueError("No PDF in command")
+    
+    cached = spool_cache.get(pdf_hash)
+    if cached:
+        logger.info(f"Using cached {pdf_hash[:12]} for {command_id} (trace {command.get('trace_id')})")
+        return cached
+    
+    # Download the PDF straight to disk, carrying on from any earlier attempt
+    logger.info(f"Downloading {pdf_hash[:12]} for {command_id} (trace {command.get('trace_id')})")
+    partial_path = spool_cache.partial_path(pdf_hash)
+    download_blob(pdf_hash, partial_path)
+    return spool_cache.put_file(pdf_hash, partial_path)
+
+# Function to send a processed document to the printer
+def submit_print(command, processed):
+    document, page_ranges, laid_out = processed
+    return print_pdf(document, command.get('print_options', {}),
+                     f"Print Job {command.get('command_id')}", page_ranges,
+                     track=[(command.get('command_id'), expected_pages(command))], laid_out=laid_out)
+
+# Function to decide whether a processed job can share a CUPS submission.
+# Returns the job's CUPS options as a hashable key, or None for a job that
+# must be printed on its own: large, held in memory, page-ranged, or with
+# several copies (CUPS repeats a multi-document job as a whole, which would
+# interleave one customer's copies with another's).
+def batch_key(command, processed):
+    document, page_ranges, laid_out = processed
+    if not isinstance(document, str) or page_ranges:
+        return None
+    if int(command.get('page_count') or BATCH_MAX_PAGES + 1) > BATCH_MAX_PAGES:
+        return None
+    options = cups_options(command.get('print_options', {}), laid_out=laid_out)
+    if options['copies'] != '1':
+        return None
+    return tuple(sorted(options.items()))
+
+# Function to send processed documents to the printer, in order. Runs of
+# small jobs with identical options go to CUPS together through printFiles,
+# so the spooler sees one submission for the run. Returns one
+# (success, message) per job, or None for each job while CUPS cannot be
+# reached: those are held in the spool and queued again later.
+def submit_prints(jobs):
+    global spool_dropped
+    if not printer.wait(PRINTER_WAIT):
+        logger.warning(f"Printer not available, holding {len(jobs)} job(s) until it is")
+        spool_dropped = True
+        return [None] * len(jobs)
+    
+    results = {}
+    waiting = []
+    for command, processed in jobs:
+        command_id = command.get('command_id')
+        try:
+            results[command_id] = already_submitted(command_id)
+        except Exception as e:
+            logger.warning(f"Could not check whether {command_id} was already printed, holding it: {str(e)}")
+            spool_dropped = True
+            results[command_id] = None
+            continue
+        if results[command_id] is None:
+            waiting.append((command, processed))
+    
+    index = 0
+    while index < len(waiting):
+        command, processed = waiting[index]
+        key = batch_key(command, processed)
+        run = [waiting[index]]
+        while (key is not None and len(run) < BATCH_MAX_JOBS and index + len(run) < len(waiting)
+               and batch_key(*waiting[index + len(run)]) == key):
+            run.append(waiting[index + len(run)])
+        index += len(run)
         
-        # Save PDF to a temporary file
-        filename = f"print_job_{command_id}_{int(time.time())}.pdf"
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
+        if len(run) == 1:
+            results[command.get('command_id')] = submit_print(command, processed)
+            continue
         
-        with open(file_path, 'wb') as f:
-            f.write(pdf_data)
+        command_ids = [c.get('command_id') for c, _ in run]
+        logger.info(f"Sending {len(run)} PDFs to printer as one job: {', '.join(command_ids)}")
+        try:
+            job_tracker.begin(command_ids)
+            job_id = printer.run(lambda conn, printer_name: submit_documents(
+                conn, printer_name, [p[0] for _, p in run], f"Print Jobs {' '.join(command_ids)}", dict(key)))
+            logger.info(f"Print job submitted with ID: {job_id}")
+            job_tracker.track(job_id, [(c.get('command_id'), expected_pages(c)) for c, _ in run])
+            result = (True, f"Print job submitted with ID: {job_id}")
+        except Exception as e:
+            error_msg = f"Error while printing: {str(e)}"
+            logger.error(error_msg)
+            job_tracker.abandon(command_ids)
+            result = (False, error_msg)
+        for command_id in command_ids:
+            results[command_id] = result
+    return [results[command.get('command_id')] for command, _ in jobs]
+
+# Function to remove a job's temporary files; documents in the spool cache are kept
+def cleanup_files(*paths):
+    for path in set(paths):
+        if path and os.path.exists(path) and not spool_cache.owns(path):
+            try:
+                os.remove(path)
+            except Exception as e:
+                logger.warning(f"Failed to clean up temporary file {path}: {str(e)}")
+
+# Function to handle a print command from start to finish on the calling thread
+def handle_print_command(command):
+    logger.info(f"Processing print command: {command.get('command_id', 'unknown')}")
+    
+    submitted = already_submitted(command.get('command_id'))
+    if submitted is not None:
+        return submitted
+    
+    file_path = None
+    try:
+        with stage_seconds.time(stage='download'):
+            file_path = fetch_command(command)
         
         # Process the PDF based on the selected options
-        processed_pdf_path = process_pdf(file_path, print_options)
+        with stage_seconds.time(stage='process_pdf'):
+            processed = process_command(command, file_path)
         
         # Send to printer
-        success, message = print_pdf(processed_pdf_path, print_options)
-        
-        # Clean up temporary files
-        try:
-            os.remove(processed_pdf_path)
-            os.remove(file_path)
-        except Exception as e:
-            logger.warning(f"Failed to clean up temporary files: {str(e)}")
-        
-        return success, message
+        with stage_seconds.time(stage='print'):
+            return submit_print(command, processed)
+    
+    except requests.exceptions.RequestException as e:
+        # Network trouble is not the job's fault; leave it unacked so it is redelivered
+        if not is_final_error(e):
+            raise
+        error_msg = f"Error fetching document: {str(e)}"
+        logger.error(error_msg)
+        return False, error_msg
     
     except Exception as e:
         error_msg = f"Error processing print command: {str(e)}"
         logger.error(error_msg)
         return False, error_msg
+    
+    finally:
+        cleanup_files(file_path)
+
+# Function used by the pipeline's fetch stage; network errors drop the
+# command from the pipeline, and it is queued again from the spool. A
+# document the server no longer has fails the command instead.
+def pipeline_fetch(command):
+    global spool_dropped
+    try:
+        return fetch_command(command)
+    except requests.exceptions.RequestException as e:
+        if is_final_error(e):
+            raise
+        logger.warning(f"Could not fetch command {command.get('command_id')}, it will be retried: {str(e)}")
+        spool_dropped = True
+        return None
+
+# Function to record a command's result and report it to the server
+def finish_command(command_id, success, message):
+    with stage_seconds.time(stage='report'):
+        finish_commands([(command_id, success, message)])
+
+# Function to record several commands' results and report them in one request.
+# Results that cannot be reported now (e.g. while offline) stay marked as
+# unreported in the done log and go up with flush_unreported later.
+def finish_commands(results):
+    record_done(results)
+    command_spool.remove([command_id for command_id, _, _ in results])
+    if report_command_results(results):
+        mark_reported([command_id for command_id, _, _ in results])
 
-# Function to report command results back to server
+# Function to report every result still waiting in the done log, in bulk
+def flush_unreported():
+    with done_lock:
+        unreported = [(command_id, entry[0], entry[1]) for command_id, entry in done_log.items() if not entry[2]]
+    for start in range(0, len(unreported), REPORT_BATCH_SIZE):
+        batch = unreported[start:start + REPORT_BATCH_SIZE]
+        logger.info(f"Sending {len(batch)} result(s) recorded while the server was unreachable")
+        if not report_command_results(batch):
+            return
+        mark_reported([command_id for command_id, _, _ in batch])
+
+# Function to queue spooled commands again, e.g. after a reboot or after
+# their documents could not be fetched. Only commands the server confirms
+# are still leased to this device are resumed; the rest may have been
+# expired or finished meanwhile and are dropped. If the server cannot be
+# asked, nothing is resumed until the next successful poll.
+def resume_spool(print_pipeline):
+    global spool_dropped
+    commands = [c for c in command_spool.commands() if done_entry(c.get('command_id')) is None]
+    if not commands:
+        spool_dropped = False
+        return
+    
+    held = renew_leases([command.get('command_id') for command in commands])
+    if held is None:
+        spool_dropped = True
+        return
+    spool_dropped = False
+    
+    dropped = [command.get('command_id') for command in commands if command.get('command_id') not in held]
+    if dropped:
+        logger.warning(f"Dropping {len(dropped)} spooled command(s) the server no longer leases to this device")
+        command_spool.remove(dropped)
+    commands = [command for command in commands if command.get('command_id') in held]
+    if commands:
+        logger.info(f"Resuming {len(commands)} spooled command(s)")
+    for command in commands:
+        print_pipeline.put(command)
+
+# Function to ask the server which of some commands this device still holds,
+# renewing their leases. Returns a set of command ids, or None when the
+# server could not be asked.
+def renew_leases(command_ids):
+    try:
+        status_code, data = transport.post_json(f"{COMMANDS_PATH}/leases",
+                                                {'device_id': DEVICE_ID, 'command_ids': command_ids}, timeout=10)
+    except Exception as e:
+        logger.warning(f"Could not check spooled commands with the server: {str(e)}")
+        return None
+    if status_code != 200 or not isinstance(data, dict):
+        logger.warning(f"Could not check spooled commands with the server: {status_code}")
+        return None
+    return set(data.get('held', []))
+
+# Function to report a command result back to server
 def report_command_result(command_id, success, message):
-    logger.info(f"Reporting result for command {command_id}: {'Success' if success else 'Failed'}")
+    return report_command_results([(command_id, success, message)])
+
+# Function to report command results back to server, several per request
+def report_command_results(results):
+    for command_id, success, message in results:
+        logger.info(f"Reporting result for command {command_id}: {'Success' if success else 'Failed'}")
     
     try:
-        payload = {
-            'device_id': DEVICE_ID,
-            'command_id': command_id,
-            'success': success,
-            'message': message
-        }
+        payload = {'device_id': DEVICE_ID, 'results': []}
+        for command_id, success, message in results:
+            result = {'command_id': command_id, 'success': success, 'message': message}
+            if command_id in trace_ids:
+                result['trace_id'] = trace_ids.pop(command_id)
+            if success and job_tracker.tracking(command_id):
+                result['state'] = 'submitted'
+            payload['results'].append(result)
         
-        response = requests.post(
-            f"{SERVER_URL}/report",
-            json=payload,
-            timeout=10
-        )
+        status_code, _ = transport.post_json(f"{COMMANDS_PATH}/report", payload, timeout=10)
         
-        if response.status_code == 200:
-            logger.info(f"Successfully reported result for command {command_id}")
+        if status_code == 200:
+            logger.info(f"Successfully reported {len(results)} result(s)")
             return True
         else:
-            logger.warning(f"Failed to report result for command {command_id}: {response.status_code}")
+            logger.warning(f"Failed to report {len(results)} result(s): {status_code}")
             return False
     
     except Exception as e:
         logger.error(f"Error reporting command result: {str(e)}")
         return False
 
+# Function to read the state of submitted jobs from CUPS once and send any
+# changes to the server. Updates the server could not apply yet (it has not
+# seen the job's ack) are kept and re-sent on the next pass.
+def track_jobs():
+    try:
+        updates = job_tracker.poll()
+    except Exception as e:
+        logger.warning(f"Could not read job states from CUPS: {str(e)}")
+        updates = []
+    
+    now = time.time()
+    for command_id, state, pages, message in updates:
+        logger.info(f"Command {command_id} is {state} in CUPS: {message}")
+        first_tried = progress_outbox.get(command_id, (None, now))[1]
+        progress_outbox[command_id] = ({'command_id': command_id, 'state': state, 'pages': pages,
+                                        'message': message}, first_tried)
+    if updates:
+        save_progress_outbox()
+    if not progress_outbox:
+        return
+    
+    try:
+        status_code, data = transport.post_json(f"{COMMANDS_PATH}/progress", {
+            'device_id': DEVICE_ID,
+            'updates': [update for update, _ in progress_outbox.values()]
+        }, timeout=10)
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Could not send print progress: {str(e)}")
+        status_code, data = None, None
+    
+    pending = len(progress_outbox)
+    if status_code == 200 and data:
+        for command_id in data.get('applied', []) + data.get('rejected', []):
+            progress_outbox.pop(command_id, None)
+    for command_id, (_, first_tried) in list(progress_outbox.items()):
+        if now - first_tried > PROGRESS_MAX_AGE:
+            logger.warning(f"Giving up on sending progress for command {command_id}")
+            del progress_outbox[command_id]
+    if len(progress_outbox) != pending:
+        save_progress_outbox()
+
+# Function to follow submitted jobs in the background
+def track_loop():
+    while True:
+        time.sleep(TRACK_INTERVAL)
+        if len(job_tracker) or progress_outbox:
+            track_jobs()
+
+# Function to load the results of recently handled commands from disk.
+# The server redelivers any command it has not seen an ack for, so this log
+# is what stops a redelivered command from being printed twice. Each entry
+# is [success, message, reported].
+def load_done_log():
+    try:
+        with open(DONE_LOG_PATH) as f:
+            return OrderedDict((command_id, (entry + [True])[:3]) for command_id, entry in json.load(f))
+    except FileNotFoundError:
+        return OrderedDict()
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable done log: {str(e)}")
+        return OrderedDict()
+
+def save_done_log():
+    temp_path = f"{DONE_LOG_PATH}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(list(done_log.items()), f)
+    os.replace(temp_path, DONE_LOG_PATH)
+
+# Function to remember commands' results before they are reported
+def record_done(results):
+    with done_lock:
+        for command_id, success, message in results:
+            done_log[command_id] = [success, message, False]
+        while len(done_log) > DONE_LOG_SIZE:
+            done_log.popitem(last=False)
+        save_done_log()
+
+# Function to read a command's entry in the done log, or None. The log is
+# changed by the pipeline's report thread, so it is only read under the lock.
+def done_entry(command_id):
+    with done_lock:
+        entry = done_log.get(command_id)
+        return list(entry) if entry is not None else None
+
+# Function to note that the server has the results of some commands
+def mark_reported(command_ids):
+    with done_lock:
+        for command_id in command_ids:
+            if command_id in done_log:
+                done_log[command_id][2] = True
+        save_done_log()
+
+done_log = load_done_log()
+done_lock = threading.Lock()
+
+# Function to compute a jittered exponential backoff delay
+def backoff_delay(base, failures, limit):
+    delay = min(limit, base * (2 ** max(failures - 1, 0)))
+    return random.uniform(delay / 2, delay)
+
+# Function to run each command received from the server. With a pipeline the
+# commands are queued and handled in the background; without one they are
+# handled one at a time on the calling thread.
+def run_commands(commands, print_pipeline=None):
+    for command in commands:
+        command_id = command.get('command_id', 'unknown')
+        logger.info(f"Received command: {command_id} (trace {command.get('trace_id')})")
+        if command.get('trace_id'):
+            trace_ids[command_id] = command['trace_id']
+        
+        # A redelivered command means our earlier report was lost; re-send it
+        done = done_entry(command_id)
+        if done is not None:
+            logger.info(f"Command {command_id} already handled, re-sending its result")
+            success, message, _ = done
+            if report_command_result(command_id, success, message):
+                mark_reported([command_id])
+            continue
+        
+        if command.get('type') != 'print':
+            logger.warning(f"Unknown command type: {command.get('type')}")
+            finish_command(command_id, False, "Unknown command type")
+            continue
+        
+        # Kept on disk until finished, so it survives a reboot or a dropped link
+        command_spool.add(command)
+        
+        if print_pipeline is not None:
+            if not print_pipeline.put(command):
+                logger.info(f"Command {command_id} is already being processed")
+            continue
+        
+        try:
+            success, message = handle_print_command(command)
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Could not fetch command {command_id}, it will be redelivered: {str(e)}")
+            continue
+        except PrinterUnavailable as e:
+            logger.warning(f"Printer not available for command {command_id}, it will be redelivered: {str(e)}")
+            continue
+        finish_command(command_id, success, message)
+
+# Function to record how long a pipeline stage took
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=PIPELINE_STAGES.get(stage, stage))
+
+# Function to poll the server for commands once. Returns (status_code, data).
+# Capabilities rarely change, so they ride along only every so often, and
+# stage timings and measured print speed only when they have changed. With
+# capacity the server sends at most that many commands.
+def poll_server(long_poll, capacity=None):
+    global capabilities_sent, metrics_sent, pages_per_minute_sent
+    logger.info("Polling server for commands...")
+    
+    payload = {'device_id': DEVICE_ID}
+    if time.time() - capabilities_sent >= CAPABILITIES_INTERVAL:
+        # Left out until the printer's attributes are known, so they go with the first poll after
+        capabilities = get_capabilities(printer.attributes())
+        if capabilities:
+            payload['capabilities'] = capabilities
+    metrics_version = stage_seconds.version
+    if metrics_version != metrics_sent:
+        payload['metrics'] = {'stage_seconds': stage_seconds.snapshot()}
+    pages_per_minute = job_tracker.pages_per_minute()
+    if pages_per_minute and (pages_per_minute != pages_per_minute_sent or 'capabilities' in payload):
+        payload['pages_per_minute'] = pages_per_minute
+    if capacity is not None:
+        payload['capacity'] = capacity
+    if long_poll:
+        payload['wait'] = LONG_POLL_WAIT
+    
+    status_code, data = transport.post_json(
+        COMMANDS_PATH,
+        payload,
+        timeout=(LONG_POLL_WAIT if long_poll else 0) + 10,
+        conditional=True
+    )
+    if status_code == 200 and 'capabilities' in payload:
+        capabilities_sent = time.time()
+    if status_code == 200 and 'metrics' in payload:
+        metrics_sent = metrics_version
+    if status_code == 200 and 'pages_per_minute' in payload:
+        pages_per_minute_sent = pages_per_minute
+    return status_code, data
+
+capabilities_sent = 0
+metrics_sent = 0
+pages_per_minute_sent = None
+
 # Main polling loop
 def main_loop():
     logger.info(f"Starting polling client with device ID: {DEVICE_ID}")
     
+    # Downloads, PDF processing, printing and reporting run in the background
+    # so a large document never holds up polling
+    print_pipeline = PrintPipeline(pipeline_fetch, process_command, submit_prints,
+                                   finish_commands, cleanup_files, batch_size=BATCH_MAX_JOBS,
+                                   observe=observe_stage)
+    
+    # Submitted jobs are followed in CUPS until they have actually printed
+    threading.Thread(target=track_loop, name="job-tracker", daemon=True).start()
+    
+    # Pick up where we left off before a restart
+    resume_spool(print_pipeline)
+    
+    # Assume long-polling until the server shows it does not support it
+    long_poll = True
+    failures = 0
+    
     while True:
         try:
-            # Poll the server for commands
-            logger.info("Polling server for commands...")
-            
-            response = requests.post(
-                SERVER_URL,
-                json={'device_id': DEVICE_ID},
-                timeout=10
-            )
+            # While the pipeline is full, check in without waiting for work
+            # so the server still sees the device as alive
+            capacity = print_pipeline.capacity()
+            status_code, data = poll_server(long_poll and capacity > 0, capacity)
             
-            if response.status_code == 200:
-                data = response.json()
+            if status_code == 200:
+                failures = 0
+                data = data or {}
+                
+                # The server is reachable: catch up on anything left over from being offline
+                flush_unreported()
+                if spool_dropped:
+                    resume_spool(print_pipeline)
+                
+                if long_poll and not data.get('long_poll'):
+                    logger.info("Server does not support long-polling, falling back to plain polling")
+                    long_poll = False
                 
                 if 'commands' in data and data['commands']:
-                    for command in data['commands']:
-                        command_id = command.get('command_id', 'unknown')
-                        logger.info(f"Received command: {command_id}")
-                        
-                        if command.get('type') == 'print':
-                            success, message = handle_print_command(command)
-                            report_command_result(command_id, success, message)
-                        else:
-                            logger.warning(f"Unknown command type: {command.get('type')}")
-                            report_command_result(command_id, False, "Unknown command type")
+                    run_commands(data['commands'], print_pipeline)
                 else:
                     logger.info("No commands received")
             
             else:
-                logger.warning(f"Server returned non-200 status code: {response.status_code}")
+                failures += 1
+                logger.warning(f"Server returned non-200 status code: {status_code}")
+                time.sleep(backoff_delay(RETRY_INTERVAL, failures, MAX_RETRY_INTERVAL))
+                continue
             
-            time.sleep(POLL_INTERVAL)
+            # A long-poll returns as soon as work arrives, so poll again straight
+            # away, unless the server was too busy to hold it open
+            if data.get('retry_after'):
+                time.sleep(backoff_delay(float(data['retry_after']), 1, MAX_RETRY_INTERVAL))
+            elif not long_poll or capacity == 0:
+                time.sleep(backoff_delay(POLL_INTERVAL, 1, POLL_INTERVAL))
         
         except requests.exceptions.RequestException as e:
+            failures += 1
+            delay = backoff_delay(RETRY_INTERVAL, failures, MAX_RETRY_INTERVAL)
             logger.error(f"Connection error: {str(e)}")
-            logger.info(f"Retrying in {RETRY_INTERVAL} seconds...")
-            time.sleep(RETRY_INTERVAL)
+            logger.info(f"Retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
         
         except Exception as e:
+            failures += 1
+            delay = backoff_delay(RETRY_INTERVAL, failures, MAX_RETRY_INTERVAL)
             logger.error(f"Unexpected error: {str(e)}")
-            logger.info(f"Continuing in {RETRY_INTERVAL} seconds...")
-            time.sleep(RETRY_INTERVAL)
+            logger.info(f"Continuing in {delay:.1f} seconds...")
+            time.sleep(delay)
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,124 @@
+import heapq
+import threading
+import time
+import logging
+
+logger = logging.getLogger("PrintServer.Scheduler")
+
+# Configuration
+LIVENESS_TIMEOUT = 60  # Seconds without a check-in before a device is considered offline
+JOB_OVERHEAD_PAGES = 2  # Fixed cost of a job (warm-up, spooling) expressed in pages
+DEFAULT_PAGES_PER_MINUTE = 10  # Assumed printer speed until a device reports its own
+
+
+# Function to check a job's print options against what a device says it can do
+def supports(capabilities, print_options):
+    number_up = capabilities.get('number_up')
+    if number_up and int(print_options.get('pages_per_sheet', 1)) not in number_up:
+        return False
+    max_copies = capabilities.get('max_copies')
+    if max_copies and int(print_options.get('num_copies', 1)) > max_copies:
+        return False
+    return True
+
+
+# Routes jobs to the device expected to finish them soonest.
+# Devices sit in a min-heap keyed by estimated minutes of queued work; an
+# update pushes a fresh entry and bumps the device's version, and stale
+# entries are discarded lazily when they reach the top. Picking a device is
+# therefore O(log n) instead of a scan over every device.
+class Scheduler:
+    def __init__(self, liveness_timeout=LIVENESS_TIMEOUT):
+        self.liveness_timeout = liveness_timeout
+        self._lock = threading.Lock()
+        self._devices = {}  # Map of device_id -> load dict
+        self._heap = []     # Entries of (score, version, device_id)
+
+    def _device(self, device_id):
+        device = self._devices.get(device_id)
+        if device is None:
+            device = {"last_seen": 0, "jobs": 0, "pages": 0, "capabilities": {},
+                      "pages_per_minute": DEFAULT_PAGES_PER_MINUTE, "version": 0}
+            self._devices[device_id] = device
+        return device
+
+    def _push(self, device_id, device):
+        device["version"] += 1
+        score = (device["pages"] + device["jobs"] * JOB_OVERHEAD_PAGES) / device["pages_per_minute"]
+        heapq.heappush(self._heap, (score, device["version"], device_id))
+        # Rebuild once stale entries dominate so the heap stays proportional to the fleet
+        if len(self._heap) > 4 * len(self._devices) + 64:
+            self._heap = [(s, v, d) for s, v, d in self._heap if self._devices[d]["version"] == v]
+            heapq.heapify(self._heap)
+
+    def _alive(self, device, now):
+        return now - device["last_seen"] < self.liveness_timeout
+
+    # Record a check-in, optionally with the device's reported capabilities and speed
+    def seen(self, device_id, capabilities=None, pages_per_minute=None, now=None):
+        with self._lock:
+            device = self._device(device_id)
+            device["last_seen"] = now or time.time()
+            if capabilities is not None:
+                device["capabilities"] = capabilities
+            if pages_per_minute:
+                device["pages_per_minute"] = pages_per_minute
+            self._push(device_id, device)
+
+    # Adjust a device's outstanding work by a number of jobs and pages
+    def adjust(self, device_id, jobs, pages):
+        with self._lock:
+            device = self._device(device_id)
+            device["jobs"] = max(0, device["jobs"] + jobs)
+            device["pages"] = max(0, device["pages"] + pages)
+            self._push(device_id, device)
+
+    # Replace outstanding work with the authoritative figures from the job queue
+    def refresh(self, loads):
+        with self._lock:
+            for device_id, device in self._devices.items():
+                jobs, pages = loads.get(device_id, (0, 0))
+                if (device["jobs"], device["pages"]) != (jobs, pages):
+                    device["jobs"], device["pages"] = jobs, pages
+                    self._push(device_id, device)
+
+    # Pick the live device with the least queued work that can handle the job,
+    # and charge the job to it. Returns None when no live device qualifies.
+    def pick_device(self, print_options, pages, now=None):
+        now = now or time.time()
+        with self._lock:
+            skipped = []
+            chosen = None
+            while self._heap:
+                entry = heapq.heappop(self._heap)
+                device_id = entry[2]
+                device = self._devices[device_id]
+                if device["version"] != entry[1] or not self._alive(device, now):
+                    # Stale entries are dropped; an offline device is re-pushed on its next check-in
+                    continue
+                if supports(device["capabilities"], print_options):
+                    chosen = device_id
+                    break
+                skipped.append(entry)
+
+            for entry in skipped:
+                heapq.heappush(self._heap, entry)
+
+            if chosen is not None:
+                device = self._devices[chosen]
+                device["jobs"] += 1
+                device["pages"] += pages
+                self._push(chosen, device)
+            return chosen
+
+    # Devices that have not checked in within the liveness timeout
+    def silent_devices(self, now=None):
+        now = now or time.time()
+        with self._lock:
+            return [device_id for device_id, device in self._devices.items()
+                    if not self._alive(device, now)]
+
+    def load(self, device_id):
+        with self._lock:
+            device = self._devices.get(device_id)
+            return (device["jobs"], device["pages"]) if device else (0, 0)
@@ -1,12 +1,26 @@
-from flask import Flask, request, render_template, jsonify, send_from_directory
+from flask import Flask, Request, Response, request, render_template, jsonify, send_from_directory, send_file
+from werkzeug.exceptions import BadRequest
+from werkzeug.utils import secure_filename
 import os
-import base64
 import uuid
+import hashlib
 import time
 import json
 import logging
+import threading
 from datetime import datetime
 
+from blob_store import BlobStore, is_valid_hash
+from job_queue import (create_queue, UNASSIGNED, FINISHED_STATES, DEFAULT_PAGE_SIZE,
+                       COMPLETED, FAILED, PRINTING)
+from scheduler import Scheduler
+from admission import AdmissionControl, DEVICE_MAX_QUEUED_BYTES, DEVICE_MAX_QUEUED_JOBS
+from pdf_inspect import PdfStreamInspector
+from pdf_analysis import AnalysisCache, estimate_cost
+from page_ranges import PageRangeError
+from compression import COMPRESS_MIN_BYTES, CompressionError, choose_encoding, compress, decompress
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, SIZE_BUCKETS, Registry
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -18,21 +32,139 @@ logging.basicConfig(
 )
 logger = logging.getLogger("PrintServer")
 
+# Uploaded files are streamed chunk by chunk straight into the blob store,
+# hashed and checked on the way, instead of being spooled and read back
+class StreamingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return blob_store.writer(PdfStreamInspector())
+    
+    # Devices compress larger JSON bodies (e.g. batched reports)
+    def get_data(self, cache=True, as_text=False, parse_form_data=False):
+        data = super().get_data(cache=cache, parse_form_data=parse_form_data)
+        if self.content_encoding:
+            try:
+                data = decompress(data, self.content_encoding.strip().lower())
+            except CompressionError as e:
+                raise BadRequest(str(e))
+        return data.decode('utf-8', 'replace') if as_text else data
+
 app = Flask(__name__)
+app.request_class = StreamingRequest
+
+# Printer states devices report for jobs they have handed to CUPS. A job goes
+# back to pending when CUPS stops the printer on an error such as a jam.
+PRINT_STATES = {'pending': PRINTING, 'processing': PRINTING, 'stopped': PRINTING, 'held': PRINTING,
+                'completed': COMPLETED, 'aborted': FAILED, 'canceled': FAILED}
 
 # Configuration
 UPLOAD_FOLDER = './uploads'
 ALLOWED_EXTENSIONS = {'pdf'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Limit file size to 16MB
+LONG_POLL_MAX_WAIT = 25  # Longest a device may hold /api/check_commands open, in seconds
+QUEUE_URL = os.environ.get('PRINT_QUEUE_URL', 'sqlite:///print_queue.db')  # 'memory://' for tests
+JOB_RETENTION_SECONDS = 7 * 24 * 3600  # Finished jobs older than this are compacted away
+COMPACT_INTERVAL = 600  # Seconds between compaction passes
+LEASE_SECONDS = 300  # Unacknowledged commands are redelivered after this many seconds
+MAX_COMMANDS_PER_POLL = 10  # Most commands handed to a device per check-in, so one kiosk cannot take the whole backlog
+REBALANCE_INTERVAL = 30  # Seconds between passes that move work off silent devices
+SERVER_MODE = os.environ.get('PRINT_SERVER_MODE', 'development')  # 'production' serves with waitress
+PORT = int(os.environ.get('PORT', 5000))
+SERVER_THREADS = 256  # Request threads in production mode; each held long-poll occupies one
+LONG_POLL_SLOTS = SERVER_THREADS - 32  # Long-polls held at once, leaving threads for uploads and short requests
+LONG_POLL_BUSY_RETRY = 10  # Seconds a device is told to wait when every long-poll slot is taken
+CONNECTION_LIMIT = 4096  # Open client connections accepted in production mode
+MAX_PAGE_SIZE = 1000  # Most records one /api/commands request may ask for
+FEED_SLOTS = 16  # Live admin feeds held open at once; each occupies a request thread
+FEED_HEARTBEAT = 15  # Seconds between keep-alive comments on an idle feed
+FEED_MAX_SECONDS = 300  # A feed is closed after this long; the browser reconnects where it left off
+UPLOAD_RECV_BYTES = 256 * 1024  # Bytes read per socket read in production mode, so large uploads take few I/O passes
+UPLOAD_SPILL_BYTES = 512 * 1024  # Request bodies larger than this are buffered in a temporary file, not memory
+MAX_QUEUED_JOBS = int(os.environ.get('PRINT_MAX_QUEUED_JOBS', 5000))  # Jobs waiting for devices before uploads are refused
+MAX_QUEUED_MB = int(os.environ.get('PRINT_MAX_QUEUED_MB', 2048))  # Megabytes of documents waiting for devices
+ADMISSION_RETRY_AFTER = 30  # Seconds a refused upload is told to wait before trying again
+JOB_TTL_SECONDS = int(os.environ.get('PRINT_JOB_TTL_SECONDS', 6 * 3600))  # Jobs no device collects in time expire
+EXPIRE_INTERVAL = 60  # Seconds between expiry passes
+BLOB_GRACE_SECONDS = 3600  # Stored documents no job needs are deleted once they are this old
+BLOB_CHUNK_SIZE = 1024 * 1024  # Bytes per checksummed chunk of a device download
+
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')
 
 # Ensure upload directory exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# In-memory storage for pending commands and registered devices
-pending_commands = {}  # Map of device_id -> list of commands
-device_status = {}     # Map of device_id -> last seen timestamp
-command_status = {}    # Map of command_id -> status information
+# Uploaded documents are stored once by SHA-256 and fetched by devices on demand
+blob_store = BlobStore(BLOB_FOLDER)
+
+# Page counts and sizes per document, parsed once per content hash
+analysis_cache = AnalysisCache()
+
+# Persistent storage for pending commands, command status and registered devices
+job_queue = create_queue(QUEUE_URL)
+last_compaction = 0
+
+# Load-aware routing of new jobs, seeded with what the queue already knows
+scheduler = Scheduler()
+for known_device, known_last_seen in job_queue.devices().items():
+    scheduler.seen(known_device, now=known_last_seen)
+scheduler.refresh(job_queue.device_loads())
+last_rebalance = 0
+
+# Budgets on queued work; a job that does not fit is refused with a 429.
+# The check and the enqueue happen under one lock so concurrent uploads
+# cannot overshoot a budget together.
+admission = AdmissionControl(MAX_QUEUED_JOBS, MAX_QUEUED_MB * 1024 ** 2,
+                             DEVICE_MAX_QUEUED_JOBS, DEVICE_MAX_QUEUED_BYTES)
+admission_lock = threading.Lock()
+last_expiry = 0
+
+# Woken whenever a command is enqueued so long-polling devices return immediately.
+# Wakeups are counted per device (UNASSIGNED counts for everyone), so a woken
+# device only goes back to the queue when something may be there for it.
+commands_available = threading.Condition()
+wakeups = {}
+long_poll_slots = threading.BoundedSemaphore(LONG_POLL_SLOTS)
+
+# Compaction, expiry and rebalancing run on whichever request finds them due, one at a time
+maintenance_lock = threading.Lock()
+
+# Woken whenever jobs change so the admin feed can push them. change_count
+# only ever grows, which lets a feed tell whether it missed a wakeup.
+job_changes = threading.Condition()
+change_count = 0
+feed_slots = threading.BoundedSemaphore(FEED_SLOTS)
+
+# Metrics served at /metrics, including the stage timings devices push with their polls
+metrics = Registry()
+upload_bytes = metrics.histogram('print_upload_bytes', "Size of accepted print uploads", buckets=SIZE_BUCKETS)
+dispatch_delay = metrics.histogram('print_dispatch_delay_seconds',
+                                   "Seconds from upload until a job is handed to a device")
+poll_seconds = metrics.histogram('print_poll_seconds', "Seconds taken to answer a device poll", ['kind'])
+queue_depth = metrics.gauge('print_queue_depth', "Jobs waiting to be handed to each device", ['device_id'])
+report_outcomes = metrics.counter('print_reports_total', "Job results reported by devices", ['outcome'])
+printer_speed = metrics.gauge('print_device_pages_per_minute', "Print speed each device measured from CUPS",
+                              ['device_id'])
+printed_pages = metrics.counter('print_printed_pages_total', "Pages CUPS reported printed", ['device_id'])
+uploads_rejected = metrics.counter('print_uploads_rejected_total', "Uploads refused because a queue budget was full",
+                                   ['budget'])
+jobs_expired = metrics.counter('print_jobs_expired_total', "Jobs expired because no device collected them")
+client_stage_seconds = metrics.histogram('print_client_stage_seconds', "Seconds devices spent per job stage",
+                                         ['device_id', 'stage'])
+
+# Compress JSON replies for clients that accept it; devices poll over slow links
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers):
+        return response
+    
+    data = response.get_data()
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding and len(data) >= COMPRESS_MIN_BYTES:
+        response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
 
 # Function to check allowed file types
 def allowed_file(filename):
@@ -44,175 +176,651 @@ def index():
 
 @app.route('/admin')
 def admin():
-    return render_template('admin.html', 
-                          devices=device_status, 
-                          commands=command_status,
-                          pending=pending_commands)
+    # Job history is loaded page by page by the dashboard itself
+    return render_template('admin.html',
+                          pending=job_queue.pending_counts())
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
+# Function to read the print options submitted with a document. Raises
+# ValueError for options that cannot be printed as priced.
+def get_print_options(form):
+    print_options = {
+        "selected_pages": form.get('selected_pages', ''),  # e.g., '1, 2-4'
+        "num_copies": int(form.get('num_copies', 1)),  # default 1 copy
+        "layout": form.get('layout', 'portrait'),  # 'portrait' or 'landscape'
+        "pages_per_sheet": int(form.get('pages_per_sheet', 1))  # Default 1 page per sheet
+    }
+    if print_options["num_copies"] < 1 or print_options["pages_per_sheet"] < 1:
+        raise ValueError("num_copies and pages_per_sheet must be at least 1")
+    return print_options
+
+# Function to validate an uploaded file and store it in the blob store.
+# With keep=False it is only read, and left to be deleted with the request.
+# Returns (upload, error_response).
+def store_upload(keep=True):
     if 'file' not in request.files:
-        return jsonify({"status": "error", "message": "No file part"}), 400
+        return None, (jsonify({"status": "error", "message": "No file part"}), 400)
     
     file = request.files['file']
     if file.filename == '':
-        return jsonify({"status": "error", "message": "No selected file"}), 400
+        return None, (jsonify({"status": "error", "message": "No selected file"}), 400)
     
     if not file or not allowed_file(file.filename):
-        return jsonify({"status": "error", "message": "Invalid file format"}), 400
+        return None, (jsonify({"status": "error", "message": "Invalid file format"}), 400)
+    
+    # The upload has already been streamed into the blob store; check it
+    # looks like a whole PDF before keeping it under its content hash
+    writer = file.stream
+    pdf_error = writer.inspector.error()
+    if pdf_error:
+        return None, (jsonify({"status": "error", "message": pdf_error}), 400)
+    
+    if keep:
+        pdf_hash, pdf_size, _ = writer.commit()
+        path = blob_store.path_for(pdf_hash)
+    else:
+        (pdf_hash, pdf_size), path = writer.finish(), writer.temp_path
+    return {
+        "pdf_hash": pdf_hash,
+        "pdf_size": pdf_size,
+        "path": path,
+        "filename": secure_filename(file.filename),
+        "page_hint": writer.inspector.page_count
+    }, None
 
+# Function to price a stored document, using the cached analysis when there is one.
+# Returns (quote, error_response).
+def quote_document(upload, print_options):
+    pdf_hash = upload["pdf_hash"]
+    try:
+        analysis = analysis_cache.get_or_analyze(pdf_hash, upload["path"], upload["page_hint"])
+    except Exception as e:
+        logger.warning(f"Could not analyze {pdf_hash[:12]}: {str(e)}")
+        return None, (jsonify({"status": "error", "message": "Could not read PDF"}), 400)
+    
+    try:
+        quote = estimate_cost(analysis, print_options)
+    except PageRangeError as e:
+        return None, (jsonify({"status": "error", "message": str(e)}), 400)
+    
+    quote["page_count"] = analysis["page_count"]
+    return quote, None
+
+# Prices a document without queueing it. The document is analyzed where it
+# was streamed to and then deleted, not kept in the blob store, so quotes
+# take no lasting disk space; its analysis stays cached for the upload.
+@app.route('/api/quote', methods=['POST'])
+def quote():
+    rejected = admit(request.content_length or 0)
+    if rejected:
+        return rejected
+    
+    try:
+        print_options = get_print_options(request.form)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid print options"}), 400
+    
+    upload, error = store_upload(keep=False)
+    if error:
+        return error
+    
+    quote, error = quote_document(upload, print_options)
+    if error:
+        return error
+    
+    return jsonify({"status": "success", "page_count": quote["page_count"], "pages": quote["pages"],
+                    "sheets": quote["sheets"], "cost": quote["cost"]})
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    expire_if_due()
+    compact_if_due()
+    
+    # Refuse before the form is read when the queue is already full, so an
+    # overload costs no disk space or PDF parsing
+    rejected = admit(request.content_length or 0)
+    if rejected:
+        return rejected
+    
     # Get print options from form
-    selected_pages = request.form.get('selected_pages', '')  # e.g., '1, 2-4'
-    num_copies = int(request.form.get('num_copies', 1))  # default 1 copy
-    layout = request.form.get('layout', 'portrait')  # 'portrait' or 'landscape'
-    pages_per_sheet = int(request.form.get('pages_per_sheet', 1))  # Default 1 page per sheet
+    try:
+        print_options = get_print_options(request.form)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid print options"}), 400
     upi_method = request.form.get('upi_method', '')
+    pinned_device = request.form.get('device_id') or None  # Optionally force a specific kiosk
+    
+    if pinned_device and pinned_device not in job_queue.devices():
+        return jsonify({"status": "error", "message": "Unknown device"}), 400
     
     # Validate payment method (this would be replaced with actual payment processing)
     if upi_method != 'success':
         return jsonify({"status": "error", "message": "Payment failed"}), 400
     
     try:
-        # Generate unique filename
-        filename = f"print_{int(time.time())}_{str(uuid.uuid4())[:8]}.pdf"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
+        upload, error = store_upload()
+        if error:
+            return error
         
-        # Read the file back as base64
-        with open(file_path, 'rb') as f:
-            pdf_data = base64.b64encode(f.read()).decode('utf-8')
+        # Page count, selection and price come from the analysis cache
+        quote, error = quote_document(upload, print_options)
+        if error:
+            return error
         
-        # Create command for all available printers
+        # Create command for all available printers. The trace ID follows the
+        # job through the device's logs and back in its report.
         command_id = str(uuid.uuid4())
+        trace_id = uuid.uuid4().hex[:16]
         command = {
             "command_id": command_id,
+            "trace_id": trace_id,
             "type": "print",
-            "pdf_data": pdf_data,
-            "print_options": {
-                "selected_pages": selected_pages,
-                "num_copies": num_copies,
-                "layout": layout,
-                "pages_per_sheet": pages_per_sheet
-            },
+            "pdf_hash": upload["pdf_hash"],
+            "pdf_size": upload["pdf_size"],
+            "page_count": quote["page_count"],
+            "print_options": print_options,
             "timestamp": datetime.now().isoformat(),
             "status": "pending"
         }
         
-        # Select the most recently seen device (or the first one if none)
-        target_device = None
-        latest_time = 0
-        
-        for device_id, last_seen in device_status.items():
-            if last_seen > latest_time:
-                latest_time = last_seen
-                target_device = device_id
-        
-        if not target_device and not device_status:
-            # No devices seen yet, store command for the first device that registers
-            if "default" not in pending_commands:
-                pending_commands["default"] = []
-            pending_commands["default"].append(command)
-        else:
-            # Send to the selected device
-            device_id = target_device if target_device else list(device_status.keys())[0]
-            if device_id not in pending_commands:
-                pending_commands[device_id] = []
-            pending_commands[device_id].append(command)
-        
-        # Store command status
-        command_status[command_id] = {
-            "id": command_id,
-            "device_id": target_device if target_device else "pending assignment",
-            "timestamp": datetime.now().isoformat(),
-            "status": "pending",
-            "file": filename
-        }
-        
-        # Clean up the original file since we've encoded it
-        os.remove(file_path)
+        # Route to the live device with the least queued work, unless pinned,
+        # and queue the job there if that queue has room for it
+        pages = quote["sheets"]
+        with admission_lock:
+            target_device = pinned_device or scheduler.pick_device(print_options, pages)
+            rejected = admit(upload["pdf_size"], target_device or UNASSIGNED)
+            if rejected:
+                if target_device and not pinned_device:
+                    scheduler.adjust(target_device, -1, -pages)  # Undo pick_device's estimate
+                return rejected
+            if pinned_device:
+                scheduler.adjust(target_device, 1, pages)
+            
+            # With no live device, the first device that checks in picks it up
+            job_queue.enqueue(command, target_device or UNASSIGNED, file=upload["filename"],
+                              pages=pages, pinned=bool(pinned_device))
+        notify_commands(target_device or UNASSIGNED)
+        notify_job_changes()
+        upload_bytes.observe(upload["pdf_size"])
         
-        logger.info(f"Print job {command_id} submitted successfully")
-        return jsonify({"status": "success", "message": "Print job submitted"})
+        logger.info(f"Print job {command_id} submitted successfully (trace {trace_id})")
+        return jsonify({"status": "success", "message": "Print job submitted", "command_id": command_id,
+                        "pages": quote["pages"], "sheets": quote["sheets"], "cost": quote["cost"]})
     
     except Exception as e:
         logger.error(f"Error processing upload: {str(e)}")
         return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
 
+# Function to check one more job of size bytes against the queue budgets,
+# in total and, given a device, for that device. Returns a 429 response to
+# send when it does not fit, or None.
+def admit(size, device_id=None):
+    budget = admission.check(job_queue.outstanding(), size, device_id)
+    if budget is None:
+        return None
+    uploads_rejected.inc(budget=budget)
+    logger.warning(f"Refusing upload of {size} bytes: {budget} budget exhausted")
+    response = jsonify({"status": "error", "message": "The print queue is full, please try again shortly",
+                        "retry_after": ADMISSION_RETRY_AFTER})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER)
+    return response
+
 @app.route('/api/check_commands', methods=['POST'])
 def check_commands():
+    start = time.perf_counter()
     data = request.json
     if not data or 'device_id' not in data:
         return jsonify({"error": "Missing device_id"}), 400
     
     device_id = data['device_id']
     
+    # Devices may ask the server to hold the request open until work arrives
+    try:
+        wait = min(max(float(data.get('wait', 0)), 0), LONG_POLL_MAX_WAIT)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid wait"}), 400
+    
+    # Devices say how many more commands they can take on; older ones do not
+    try:
+        limit = min(max(int(data.get('capacity', MAX_COMMANDS_PER_POLL)), 0), MAX_COMMANDS_PER_POLL)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid capacity"}), 400
+    
     # Update device status
-    device_status[device_id] = time.time()
-    
-    # Check if there are any pending commands for this device
-    commands_to_send = []
-    
-    # Check device-specific commands
-    if device_id in pending_commands and pending_commands[device_id]:
-        commands_to_send.extend(pending_commands[device_id])
-        pending_commands[device_id] = []  # Clear the commands being sent
-    
-    # Check for default commands (device not specified)
-    if "default" in pending_commands and pending_commands["default"]:
-        # Assign default commands to this device
-        for command in pending_commands["default"]:
-            command_id = command["command_id"]
-            if command_id in command_status:
-                command_status[command_id]["device_id"] = device_id
-        
-        commands_to_send.extend(pending_commands["default"])
-        pending_commands["default"] = []  # Clear the default commands
+    job_queue.touch_device(device_id)
+    pages_per_minute = device_speed(device_id, data.get('pages_per_minute'))
+    scheduler.seen(device_id, device_capabilities(device_id, data.get('capabilities')), pages_per_minute)
+    if 'metrics' in data:
+        record_device_metrics(device_id, data['metrics'])
+    if pages_per_minute:
+        printer_speed.set(pages_per_minute, device_id=device_id)
+    compact_if_due()
+    expire_if_due()
+    rebalance_if_due()
+    
+    reply = {"long_poll": True}
+    commands_to_send = job_queue.dequeue(device_id, LEASE_SECONDS, limit=limit) if limit else []
+    if not commands_to_send and wait > 0 and limit:
+        # A held long-poll ties up a request thread, so only so many are held at once
+        if long_poll_slots.acquire(blocking=False):
+            try:
+                commands_to_send = wait_for_commands(device_id, wait, limit)
+            finally:
+                long_poll_slots.release()
+            job_queue.touch_device(device_id)
+        else:
+            reply["retry_after"] = LONG_POLL_BUSY_RETRY
     
     logger.info(f"Device {device_id} checked in, sending {len(commands_to_send)} commands")
-    return jsonify({"commands": commands_to_send})
+    if commands_to_send:
+        notify_job_changes()
+        record_dispatch(device_id, commands_to_send)
+    
+    # A device that already holds this exact reply (typically "no commands")
+    # gets an empty 304 instead of the body
+    reply["commands"] = commands_to_send
+    response = jsonify(reply)
+    etag = hashlib.blake2b(response.get_data(), digest_size=8).hexdigest()
+    response.set_etag(etag)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+    poll_seconds.observe(time.perf_counter() - start, kind='long' if wait > 0 else 'short')
+    return response
+
+# Function to log and time commands handed to a device
+def record_dispatch(device_id, commands):
+    now = time.time()
+    for command in commands:
+        logger.info(f"Dispatched {command.get('command_id')} to {device_id} (trace {command.get('trace_id')})")
+        try:
+            dispatch_delay.observe(now - datetime.fromisoformat(command['timestamp']).timestamp())
+        except (KeyError, TypeError, ValueError):
+            pass
+
+# Function to keep the latest stage timings a device pushed with its poll
+def record_device_metrics(device_id, device_metrics):
+    try:
+        client_stage_seconds.load(device_metrics['stage_seconds'], device_id=device_id)
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning(f"Ignoring metrics from {device_id}: {str(e)}")
+
+# Function to check the capabilities a device reports: number_up, a list of
+# pages-per-sheet values, and max_copies. Bad values are left out; returns
+# None when there is nothing usable.
+def device_capabilities(device_id, capabilities):
+    if capabilities is None:
+        return None
+    if not isinstance(capabilities, dict):
+        logger.warning(f"Ignoring capabilities from {device_id}: {str(capabilities)[:200]}")
+        return None
+    checked = {}
+    number_up = capabilities.get('number_up')
+    if isinstance(number_up, list) and number_up and all(
+            isinstance(n, int) and not isinstance(n, bool) and n > 0 for n in number_up):
+        checked['number_up'] = number_up
+    max_copies = capabilities.get('max_copies')
+    if isinstance(max_copies, int) and not isinstance(max_copies, bool) and max_copies > 0:
+        checked['max_copies'] = max_copies
+    if len(checked) != len(capabilities):
+        logger.warning(f"Ignoring some capabilities from {device_id}: {str(capabilities)[:200]}")
+    return checked
+
+# Function to check the print speed a device reports, a positive number of
+# pages per minute. Returns None for anything else.
+def device_speed(device_id, pages_per_minute):
+    if pages_per_minute is None:
+        return None
+    if (isinstance(pages_per_minute, (int, float)) and not isinstance(pages_per_minute, bool)
+            and 0 < pages_per_minute < float('inf')):
+        return pages_per_minute
+    logger.warning(f"Ignoring print speed from {device_id}: {str(pages_per_minute)[:200]}")
+    return None
+
+# Function to wake long-polls waiting on a device (UNASSIGNED wakes every device)
+def notify_commands(device_id):
+    with commands_available:
+        wakeups[device_id] = wakeups.get(device_id, 0) + 1
+        commands_available.notify_all()
+
+# Function to wake admin feeds after jobs change
+def notify_job_changes():
+    global change_count
+    with job_changes:
+        change_count += 1
+        job_changes.notify_all()
+
+def wakeup_count(device_id):
+    return wakeups.get(device_id, 0) + wakeups.get(UNASSIGNED, 0)
+
+# Function to hold a long-poll until commands arrive for the device or the
+# wait runs out. The queue is read outside the lock; the wakeup count taken
+# before each read means a notify that lands in between is never missed.
+def wait_for_commands(device_id, wait, limit=MAX_COMMANDS_PER_POLL):
+    deadline = time.monotonic() + wait
+    while True:
+        with commands_available:
+            seen = wakeup_count(device_id)
+        commands = job_queue.dequeue(device_id, LEASE_SECONDS, limit=limit)
+        if commands:
+            return commands
+        with commands_available:
+            while wakeup_count(device_id) == seen:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                commands_available.wait(remaining)
+
+# Function to drop old finished jobs so history does not grow without bound
+def compact_if_due():
+    global last_compaction
+    now = time.time()
+    if now - last_compaction < COMPACT_INTERVAL or not maintenance_lock.acquire(blocking=False):
+        return
+    try:
+        last_compaction = now
+        job_queue.compact(JOB_RETENTION_SECONDS)
+        blob_store.collect(job_queue.referenced_blobs(), BLOB_GRACE_SECONDS)
+    finally:
+        maintenance_lock.release()
+
+# Function to give up on jobs no device has collected in time, so work left
+# for kiosks that went offline stops holding the queue budgets
+def expire_if_due():
+    global last_expiry
+    now = time.time()
+    if now - last_expiry < EXPIRE_INTERVAL or not maintenance_lock.acquire(blocking=False):
+        return
+    try:
+        last_expiry = now
+        expired = job_queue.expire(JOB_TTL_SECONDS,
+                                   f"Expired: not collected by a printer within {JOB_TTL_SECONDS / 3600:g} hours")
+    finally:
+        maintenance_lock.release()
+    
+    if expired:
+        logger.warning(f"Expired {len(expired)} jobs no device collected")
+        jobs_expired.inc(len(expired))
+        scheduler.refresh(job_queue.device_loads())
+        notify_job_changes()
+
+# Function to move queued work off devices that have gone silent
+def rebalance_if_due():
+    global last_rebalance
+    now = time.time()
+    if now - last_rebalance < REBALANCE_INTERVAL or not maintenance_lock.acquire(blocking=False):
+        return
+    try:
+        last_rebalance = now
+        rebalance()
+    finally:
+        maintenance_lock.release()
+
+def rebalance():
+    def route(command, pages):
+        return scheduler.pick_device(command.get('print_options', {}), pages)
+    
+    moved = 0
+    for silent_device in scheduler.silent_devices() + [UNASSIGNED]:
+        moved += job_queue.reassign(silent_device, route)
+    
+    # Resync estimated load with the queue, which is the source of truth
+    scheduler.refresh(job_queue.device_loads())
+    
+    if moved:
+        logger.info(f"Moved {moved} queued jobs to healthy devices")
+        notify_commands(UNASSIGNED)
+        notify_job_changes()
 
 @app.route('/api/check_commands/report', methods=['POST'])
 def report_command():
     data = request.json
-    if not data or not all(k in data for k in ['device_id', 'command_id', 'success']):
+    if not data or 'device_id' not in data:
+        return jsonify({"error": "Missing required fields"}), 400
+    
+    # Devices send either one result or a batch under 'results'
+    batched = 'results' in data
+    results = data['results'] if batched else [data]
+    if not isinstance(results, list) or not all(
+            isinstance(r, dict) and 'command_id' in r and 'success' in r for r in results):
         return jsonify({"error": "Missing required fields"}), 400
     
     device_id = data['device_id']
-    command_id = data['command_id']
-    success = data['success']
-    message = data.get('message', '')
+    acked, rejected = [], []
+    for result in results:
+        command_id = result['command_id']
+        success = result['success']
+        message = result.get('message', '')
+        
+        # Acknowledge the command so its lease is released and it is not redelivered.
+        # A device that follows the job in CUPS reports it as only submitted
+        # and sends its progress to /api/check_commands/progress. Only the
+        # device holding the job may acknowledge it.
+        status = job_queue.get_status(command_id)
+        if not job_queue.complete(command_id, success, message, tracked=result.get('state') == 'submitted',
+                                  device_id=device_id):
+            rejected.append(command_id)
+            report_outcomes.inc(outcome='rejected')
+            logger.warning(f"Rejected result for {command_id} from {device_id}, which does not hold it")
+            continue
+        acked.append(command_id)
+        if status and status["status"] not in FINISHED_STATES:
+            scheduler.adjust(device_id, -1, -status["pages"])
+            report_outcomes.inc(outcome='success' if success else 'failure')
+        else:
+            report_outcomes.inc(outcome='duplicate')
+        
+        logger.info(f"Command {command_id} reported as {'successful' if success else 'failed'} by {device_id} "
+                    f"(trace {result.get('trace_id')})")
     
-    # Update command status
-    if command_id in command_status:
-        command_status[command_id].update({
-            "status": "completed" if success else "failed",
-            "message": message,
-            "completed_at": datetime.now().isoformat()
-        })
+    if acked:
+        notify_job_changes()
     
-    logger.info(f"Command {command_id} reported as {'successful' if success else 'failed'}")
-    return jsonify({"status": "success"})
+    if batched:
+        return jsonify({"status": "success", "acked": acked, "rejected": rejected})
+    return jsonify({"status": "success", "acked": bool(acked)})
+
+# A device about to resume commands it spooled before a restart or a lost
+# connection asks which of them it still holds: {"device_id": ...,
+# "command_ids": [...]}. Their leases are renewed and the reply lists them
+# under "held"; the device drops the rest, which the server has since
+# expired or finished.
+@app.route('/api/check_commands/leases', methods=['POST'])
+def renew_leases():
+    data = request.json
+    command_ids = data.get('command_ids') if data else None
+    if not data or 'device_id' not in data or not isinstance(command_ids, list) \
+            or not all(isinstance(c, str) for c in command_ids):
+        return jsonify({"error": "Missing required fields"}), 400
+    
+    device_id = data['device_id']
+    job_queue.touch_device(device_id)
+    held = job_queue.renew(device_id, command_ids, LEASE_SECONDS)
+    if len(held) < len(command_ids):
+        logger.warning(f"Device {device_id} no longer holds {len(command_ids) - len(held)} spooled command(s)")
+    return jsonify({"status": "success", "held": held})
+
+# Function to check one progress update from a device
+def valid_progress(update):
+    if not isinstance(update, dict) or 'command_id' not in update or update.get('state') not in PRINT_STATES:
+        return False
+    pages = update.get('pages', 0)
+    return isinstance(pages, int) and not isinstance(pages, bool) and pages >= 0
+
+# Devices report how CUPS is getting on with jobs they have submitted:
+# {"device_id": ..., "updates": [{"command_id", "state", "pages", "message"}]}.
+# Updates for jobs whose ack has not arrived yet are not applied; the reply
+# lists the ones that were, and the device re-sends the rest. Malformed
+# updates are listed as rejected, so the device stops re-sending them,
+# without holding up the others.
+@app.route('/api/check_commands/progress', methods=['POST'])
+def report_progress():
+    data = request.json
+    updates = data.get('updates') if data else None
+    if not data or 'device_id' not in data or not isinstance(updates, list):
+        return jsonify({"error": "Missing required fields"}), 400
+    
+    device_id = data['device_id']
+    applied = []
+    rejected = []
+    for update in updates:
+        if not valid_progress(update):
+            logger.warning(f"Ignoring malformed progress update from {device_id}: {str(update)[:200]}")
+            if isinstance(update, dict) and 'command_id' in update:
+                rejected.append(update['command_id'])
+            continue
+        command_id = update['command_id']
+        status = PRINT_STATES[update['state']]
+        message = update.get('message', '')
+        before = job_queue.get_status(command_id)
+        if job_queue.update_print_state(command_id, status, message):
+            applied.append(command_id)
+            if (before["status"], before.get("message")) == (status, message):
+                continue  # Re-sent after the reply was lost
+            if update['state'] == 'completed' and update.get('pages'):
+                printed_pages.inc(int(update['pages']), device_id=device_id)
+            logger.info(f"Command {command_id} is {update['state']} on {device_id}")
+    
+    if applied:
+        notify_job_changes()
+    return jsonify({"status": "success", "applied": applied, "rejected": rejected})
+
+@app.route('/api/blobs/<blob_hash>', methods=['GET'])
+def get_blob(blob_hash):
+    if not is_valid_hash(blob_hash) or not blob_store.exists(blob_hash):
+        return jsonify({"error": "Blob not found"}), 404
+    
+    # conditional=True streams the file and honours Range / If-None-Match headers
+    return send_file(blob_store.path_for(blob_hash),
+                     mimetype='application/pdf',
+                     conditional=True,
+                     etag=blob_hash,
+                     max_age=3600)
+
+# Per-chunk SHA-256 digests of a blob, so a device can check a download
+# chunk by chunk and resume it from the last good chunk
+@app.route('/api/blobs/<blob_hash>/chunks', methods=['GET'])
+def get_blob_chunks(blob_hash):
+    if not is_valid_hash(blob_hash) or not blob_store.exists(blob_hash):
+        return jsonify({"error": "Blob not found"}), 404
+    
+    return jsonify({"chunk_size": BLOB_CHUNK_SIZE, "size": blob_store.size(blob_hash),
+                    "sha256": blob_store.chunk_digests(blob_hash, BLOB_CHUNK_SIZE)})
 
 @app.route('/api/devices', methods=['GET'])
 def get_devices():
     # Convert timestamps to readable format
     readable_devices = {}
-    for device_id, timestamp in device_status.items():
+    for device_id, timestamp in job_queue.devices().items():
         last_seen = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        queued_jobs, queued_pages = scheduler.load(device_id)
         readable_devices[device_id] = {
             "last_seen": last_seen,
-            "active": (time.time() - timestamp) < 60  # Consider active if seen in last minute
+            "active": (time.time() - timestamp) < 60,  # Consider active if seen in last minute
+            "queued_jobs": queued_jobs,
+            "queued_pages": queued_pages
         }
     
     return jsonify({"devices": readable_devices})
 
+# Function to read a non-negative integer query parameter
+def int_arg(name, default):
+    try:
+        return max(0, int(request.args.get(name, default)))
+    except (TypeError, ValueError):
+        return default
+
+# One page of job history, newest first. Filter with ?status= and
+# ?device_id=, and pass the returned "next" as ?before= for the next page.
+# "version" is where to start following /api/commands/changes from.
 @app.route('/api/commands', methods=['GET'])
 def get_commands():
-    return jsonify({"commands": list(command_status.values())})
+    limit = min(int_arg('limit', DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE) or DEFAULT_PAGE_SIZE
+    device_id = request.args.get('device_id') or None
+    if device_id == "pending assignment":
+        device_id = UNASSIGNED
+    version = job_queue.current_version()
+    commands = job_queue.query_commands(status=request.args.get('status') or None, device_id=device_id,
+                                        limit=limit, before=request.args.get('before') or None)
+    return jsonify({
+        "commands": commands,
+        "version": version,
+        "next": commands[-1]["id"] if len(commands) == limit else None
+    })
+
+# Jobs changed since ?since=<version>, oldest change first. Keep passing the
+# returned version back to follow changes without re-reading history.
+@app.route('/api/commands/changes', methods=['GET'])
+def get_command_changes():
+    limit = min(int_arg('limit', DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE) or DEFAULT_PAGE_SIZE
+    commands, version = job_queue.changes(int_arg('since', 0), limit)
+    return jsonify({"commands": commands, "version": version})
+
+# The same changes pushed as server-sent events. Each event carries a batch
+# of changed jobs and its version as the event id, so a reconnecting browser
+# resumes from Last-Event-ID.
+@app.route('/api/commands/stream', methods=['GET'])
+def stream_command_changes():
+    if not feed_slots.acquire(blocking=False):
+        return jsonify({"error": "Too many live feeds"}), 503
+    
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+    except ValueError:
+        since = 0
+    
+    def events(cursor):
+        yield "retry: 5000\n\n"
+        deadline = time.monotonic() + FEED_MAX_SECONDS
+        while time.monotonic() < deadline:
+            with job_changes:
+                seen = change_count
+            commands, cursor = job_queue.changes(cursor, MAX_PAGE_SIZE)
+            if commands:
+                payload = json.dumps({"commands": commands, "version": cursor})
+                yield f"id: {cursor}\ndata: {payload}\n\n"
+                continue
+            with job_changes:
+                if change_count == seen:
+                    job_changes.wait(FEED_HEARTBEAT)
+                idle = change_count == seen
+            if idle:
+                yield ": keep-alive\n\n"
+    
+    response = Response(events(since), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(feed_slots.release)
+    return response
+
+# Prometheus scrape endpoint
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    queue_depth.clear()
+    for device_id, count in job_queue.pending_counts().items():
+        queue_depth.set(count, device_id="pending assignment" if device_id == UNASSIGNED else device_id)
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
 
 @app.route('/static/<path:path>')
 def serve_static(path):
     return send_from_directory('static', path)
 
+# Production mode: one process serving requests from a pool of threads.
+# It stays a single process on purpose, because long-poll wakeups and the
+# scheduler's load estimates live in memory; the job queue is safe to share
+# between threads. waitress reads each request body in full before handing
+# it to a thread, so a slow upload never holds a thread while it trickles in;
+# bodies past UPLOAD_SPILL_BYTES wait in a temporary file rather than memory.
+def run_production(host, port):
+    from waitress import serve
+    logger.info(f"Serving on {host}:{port} with {SERVER_THREADS} threads")
+    serve(app, host=host, port=port, threads=SERVER_THREADS,
+          connection_limit=CONNECTION_LIMIT, channel_timeout=LONG_POLL_MAX_WAIT + 60,
+          asyncore_use_poll=True,  # select() stops at 1024 connections
+          recv_bytes=UPLOAD_RECV_BYTES, inbuf_overflow=UPLOAD_SPILL_BYTES,
+          max_request_body_size=app.config['MAX_CONTENT_LENGTH'] + 1024 * 1024)  # Room for the form fields
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    if SERVER_MODE == 'production':
+        run_production('0.0.0.0', PORT)
+    else:
+        app.run(host='0.0.0.0', port=PORT, debug=True, threaded=True)
\ No newline at end of file
@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger("PrinterClient.Spool")
+
+# Configuration
+CACHE_MAX_BYTES = 512 * 1024 * 1024  # Disk the document cache may use before old entries are evicted
+CACHE_PIN_SECONDS = 600  # Entries used this recently are never evicted; a job may still be reading them
+ENTRY_SUFFIX = '.spool'  # Entries hold PDFs or raster data; CUPS tells them apart by content
+PARTIAL_SUFFIX = '.partial'  # Downloads in progress, kept so an interrupted one can be resumed
+PARTIAL_MAX_AGE = 24 * 3600  # Seconds an untouched partial download is kept before it is given up on
+
+
+# Bounded on-disk cache of documents for the polling client, keyed by content
+# hash (downloads) or by hash plus print options (processed documents). Files are
+# written to a temporary name and renamed into place, and an entry's mtime is
+# its last use, so the cache can be shared with the PDF worker processes and
+# survives restarts. Once the cache is over max_bytes, least recently used
+# entries are evicted.
+class SpoolCache:
+    def __init__(self, root, max_bytes=CACHE_MAX_BYTES, pin_seconds=CACHE_PIN_SECONDS):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.pin_seconds = pin_seconds
+        os.makedirs(self.root, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.root, f"{key}{ENTRY_SUFFIX}")
+
+    # Function to check whether a path is a cache entry (rather than a file being written)
+    def owns(self, path):
+        return os.path.dirname(os.path.abspath(path)) == self.root and path.endswith(ENTRY_SUFFIX)
+
+    # Function to look up an entry, marking it used. Returns its path or None.
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    # Path a download of key is written to, the same on every attempt so
+    # an interrupted download can carry on where it stopped
+    def partial_path(self, key):
+        return os.path.join(self.root, f".{key}{PARTIAL_SUFFIX}")
+
+    # Path to write a new entry to before handing it to put_file
+    def temp_path(self, key):
+        return os.path.join(self.root, f".{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+    # Move a finished file into the cache and return its path
+    def put_file(self, key, temp_path):
+        path = self.path_for(key)
+        os.replace(temp_path, path)
+        self.evict()
+        return path
+
+    def put_bytes(self, key, data):
+        temp_path = self.temp_path(key)
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        return self.put_file(key, temp_path)
+
+    # Function to remove least recently used entries until the cache fits,
+    # and partial downloads nobody has resumed in a long time
+    def evict(self):
+        entries = []
+        total = 0
+        abandoned_before = time.time() - PARTIAL_MAX_AGE
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(PARTIAL_SUFFIX) and entry.stat().st_mtime < abandoned_before:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+            elif entry.name.endswith(ENTRY_SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+
+        pinned_after = time.time() - self.pin_seconds
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes or mtime > pinned_after:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                logger.info(f"Evicted {os.path.basename(path)} from the spool cache")
+            except FileNotFoundError:
+                pass
+
+
+# Commands the client has received but not yet finished, saved to disk so
+# they are picked up again after a reboot or while the server is unreachable
+class CommandSpool:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._commands = OrderedDict()
+        try:
+            with open(path) as f:
+                self._commands = OrderedDict((c['command_id'], c) for c in json.load(f))
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable command spool: {str(e)}")
+
+    def _save(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(list(self._commands.values()), f)
+        os.replace(temp_path, self.path)
+
+    def add(self, command):
+        with self._lock:
+            if command.get('command_id') not in self._commands:
+                self._commands[command.get('command_id')] = command
+                self._save()
+
+    def remove(self, command_ids):
+        with self._lock:
+            removed = [c for c in command_ids if self._commands.pop(c, None) is not None]
+            if removed:
+                self._save()
+
+    def commands(self):
+        with self._lock:
+            return list(self._commands.values())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._commands)
@@ -0,0 +1,76 @@
+import json
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from compression import COMPRESS_MIN_BYTES, compress, supported_encodings
+
+# Configuration
+POOL_SIZE = 4  # Keep-alive connections held open to the server (poll, reports, downloads)
+USER_AGENT = "print-client/1"
+
+
+# HTTP transport for the polling client. One pooled keep-alive session is
+# shared by polling, reporting and downloads, so the TCP and TLS handshakes
+# are paid once rather than on every request. JSON bodies are compressed
+# once they are big enough to benefit, responses are accepted compressed,
+# and conditional requests let the server answer an unchanged poll with an
+# empty 304.
+class ServerTransport:
+    def __init__(self, base_url, pool_size=POOL_SIZE):
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Every poll carries these, so keep them to what the server needs
+        self.session.headers.clear()
+        self.session.headers.update({
+            'User-Agent': USER_AGENT,
+            'Accept-Encoding': ', '.join(supported_encodings())
+        })
+        self._etags = {}  # Map of path -> (etag, last decoded body)
+        self._lock = threading.Lock()
+
+    def url(self, path):
+        return f"{self.base_url}{path}"
+
+    # POST a JSON payload and return (status_code, decoded body or None).
+    # With conditional=True the last reply from this path is remembered by its
+    # ETag, and a 304 from the server is answered from that copy.
+    def post_json(self, path, payload, timeout, conditional=False):
+        body = json.dumps(payload, separators=(',', ':')).encode()
+        headers = {'Content-Type': 'application/json'}
+        if len(body) >= COMPRESS_MIN_BYTES:
+            body = compress(body, 'gzip')
+            headers['Content-Encoding'] = 'gzip'
+
+        cached = None
+        if conditional:
+            with self._lock:
+                cached = self._etags.get(path)
+            if cached:
+                headers['If-None-Match'] = cached[0]
+
+        response = self.session.post(self.url(path), data=body, headers=headers, timeout=timeout)
+        if response.status_code == 304 and cached:
+            return 200, cached[1]
+
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+
+        etag = response.headers.get('ETag')
+        if conditional and response.status_code == 200 and etag:
+            with self._lock:
+                self._etags[path] = (etag, data)
+        return response.status_code, data
+
+    # GET a path; the response is returned as-is for streaming downloads
+    def get(self, path, **kwargs):
+        return self.session.get(self.url(path), **kwargs)
+
+    def close(self):
+        self.session.close()